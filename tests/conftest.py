@@ -8,9 +8,16 @@ from ubi_manifest.app.factory import create_app
 @pytest.fixture
 def client():
     app = create_app()
-    yield TestClient(app)
+    with TestClient(app) as client:
+        yield client
 
 
 @pytest.fixture(name="pulp")
 def fake_pulp():
     yield FakeController()
+
+
+@pytest.fixture
+def anyio_backend():
+    # redis asyncio client runs on asyncio only
+    return "asyncio"
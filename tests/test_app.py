@@ -1,15 +1,32 @@
 import json
 from unittest import mock
 
-from attr import define
+import fakeredis
+import pytest
+from redis import Redis
+from redis import asyncio as aioredis
 
-from .utils import MockedRedis
+from ubi_manifest.app.api import _stream_manifest, get_redis, get_sync_redis
+from ubi_manifest.worker.tasks.celery import app
+from ubi_manifest.worker.tasks.manifest_store import manifest_etag, save_manifests
 
+from .utils import MockAsyncResult, fake_redis_clients
 
-@define
-class MockAsyncResult:
-    task_id: str
-    state: str
+
+@pytest.fixture(name="redis")
+def fake_redis(client):
+    """sync client writing data read by the app via asyncio client"""
+    redis, async_redis = fake_redis_clients()
+    client.app.dependency_overrides[get_redis] = lambda: async_redis
+    yield redis
+
+
+def _locks(redis):
+    """returns holders of all locks in redis"""
+    return {
+        key.decode("utf-8"): redis.get(key).decode("utf-8")
+        for key in redis.keys("ubi_manifest:lock:*")
+    }
 
 
 def test_status(client):
@@ -19,37 +36,119 @@ def test_status(client):
     assert response.json() == {"status": "OK"}
 
 
-def test_task_state(client):
+def test_lifespan(client):
+    """test that app shares redis clients created at startup"""
+    assert isinstance(client.app.state.redis, aioredis.Redis)
+    assert isinstance(client.app.state.sync_redis, Redis)
+
+    with mock.patch.object(client.app.state, "redis", fakeredis.FakeAsyncRedis()):
+        response = client.get("/api/v1/task/some-task-id")
+        assert response.json()["state"] == "PENDING"
+
+
+def test_task_state(client, redis):
     """test getting state of given celery task_id"""
-    with mock.patch("ubi_manifest.app.api.app.AsyncResult") as task_mock:
-        task_id = "some-task-id"
-        task_mock.return_value = MockAsyncResult(task_id=task_id, state="PENDING")
+    task_id = "some-task-id"
+    redis.set(
+        app.backend.get_key_for_task(task_id),
+        app.backend.encode({"status": "STARTED", "result": None}),
+    )
 
-        response = client.get(f"/api/v1/task/{task_id}")
+    response = client.get(f"/api/v1/task/{task_id}")
 
-        # 200 status code is expected
-        assert response.status_code == 200
-        json_data = response.json()
-        # task_id and state are properly set in response
-        assert json_data["task_id"] == task_id
-        assert json_data["state"] == "PENDING"
+    # 200 status code is expected
+    assert response.status_code == 200
+    json_data = response.json()
+    # task_id and state are properly set in response
+    assert json_data["task_id"] == task_id
+    assert json_data["state"] == "STARTED"
+
+
+def test_task_state_progress(client, redis):
+    """test getting progress of running task and its subtasks"""
+    progress = {"phase": "depsolving", "depsolvers": {"rpm": {"unsolved": 10}}}
+    for task_id, state, result in [
+        ("task-id", "STARTED", {"subtasks": ["sub-1", "sub-2", "sub-3"]}),
+        ("sub-1", "STARTED", {"progress": progress}),
+        # result of finished subtask is not reported as progress
+        ("sub-2", "SUCCESS", {"progress": ["some-unit"]}),
+    ]:
+        redis.set(
+            app.backend.get_key_for_task(task_id),
+            app.backend.encode({"status": state, "result": result}),
+        )
 
+    response = client.get("/api/v1/task/task-id")
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "task_id": "task-id",
+        "state": "STARTED",
+        "subtasks": [
+            {"task_id": "sub-1", "state": "STARTED", "progress": progress},
+            {"task_id": "sub-2", "state": "SUCCESS"},
+            {"task_id": "sub-3", "state": "PENDING"},
+        ],
+    }
+
+
+def test_tasks_states(client, redis):
+    """test getting states of multiple tasks at once"""
+    for task_id, state, result in [
+        ("task-1", "SUCCESS", None),
+        ("task-2", "STARTED", {"progress": {"phase": "depsolving"}}),
+    ]:
+        redis.set(
+            app.backend.get_key_for_task(task_id),
+            app.backend.encode({"status": state, "result": result}),
+        )
+
+    async_redis = client.app.dependency_overrides[get_redis]()
+    with mock.patch.object(async_redis, "mget", wraps=async_redis.mget) as mget:
+        response = client.get(
+            "/api/v1/tasks", params={"ids": ["task-1,task-missing", "task-2", "task-1"]}
+        )
 
-def test_task_state_not_found(client):
+    assert response.status_code == 200
+    assert response.json() == [
+        {"task_id": "task-1", "state": "SUCCESS"},
+        {"task_id": "task-missing", "state": "PENDING"},
+        {
+            "task_id": "task-2",
+            "state": "STARTED",
+            "progress": {"phase": "depsolving"},
+        },
+    ]
+    # all states are read at once
+    mget.assert_called_once()
+
+
+def test_tasks_states_invalid(client, redis):
+    """test getting states of no tasks or too many of them"""
+    response = client.get("/api/v1/tasks", params={"ids": ","})
+    assert response.status_code == 200
+    assert response.json() == []
+
+    response = client.get("/api/v1/tasks")
+    assert response.status_code == 422
+
+    ids = ",".join(f"task-{index}" for index in range(1001))
+    response = client.get("/api/v1/tasks", params={"ids": ids})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "At most 1000 tasks can be requested"
+
+
+def test_task_state_unknown(client, redis):
     """test getting state of given celery task when task is not found"""
-    with mock.patch("ubi_manifest.app.api.app.AsyncResult") as task_mock:
-        task_id = "some-task-id"
-        task_mock.return_value = None
+    task_id = "some-task-id"
 
-        response = client.get(f"/api/v1/task/{task_id}")
-        # 404 is expected status code
-        assert response.status_code == 404
-        json_data = response.json()
-        # proper detail is set in the response
-        assert json_data["detail"] == f"Task {task_id} not found"
+    response = client.get(f"/api/v1/task/{task_id}")
+    # unknown tasks are reported as pending, same as by celery
+    assert response.status_code == 200
+    assert response.json() == {"task_id": task_id, "state": "PENDING"}
 
 
-def test_manifest_get(client):
+def test_manifest_get(client, redis):
     """test getting depsolved content for repository"""
     depsolver_result_item = [
         {
@@ -68,72 +167,82 @@ def test_manifest_get(client):
 
     depsolver_result_item_json_str = json.dumps(depsolver_result_item)
 
-    redis_data = {"ubi_repo_id": depsolver_result_item_json_str}
+    redis.set("ubi_repo_id", depsolver_result_item_json_str)
 
-    with mock.patch("ubi_manifest.app.api.redis.from_url") as mock_redis_from_url:
-        mock_redis_from_url.return_value = MockedRedis(data=redis_data)
-        response = client.get(f"/api/v1/manifest/ubi_repo_id")
+    response = client.get(f"/api/v1/manifest/ubi_repo_id")
 
-        # expected status code in 200
-        assert response.status_code == 200
-        json_data = response.json()
-        # repo_id is set to the one we requested
-        assert json_data["repo_id"] == "ubi_repo_id"
-
-        content = sorted(json_data["content"], key=lambda x: x["value"])
-        # there are two units in the content
-        assert len(content) == 2
-        content_item = content[0]
-        # details of unit are set properly
-        assert content_item["src_repo_id"] == "source-foo-bar-repo-1"
-        assert content_item["unit_type"] == "RpmUnit"
-        assert content_item["unit_attr"] == "filename"
-        assert content_item["value"] == "some-filename.rpm"
-
-        content_item = content[1]
-        # details of unit are set properly
-        assert content_item["src_repo_id"] == "source-foo-bar-repo-2"
-        assert content_item["unit_type"] == "RpmUnit"
-        assert content_item["unit_attr"] == "filename"
-        assert content_item["value"] == "some-other-filename.rpm"
-
-
-def test_manifest_get_empty(client):
+    # expected status code in 200
+    assert response.status_code == 200
+    json_data = response.json()
+    # repo_id is set to the one we requested
+    assert json_data["repo_id"] == "ubi_repo_id"
+
+    content = sorted(json_data["content"], key=lambda x: x["value"])
+    # there are two units in the content
+    assert len(content) == 2
+    content_item = content[0]
+    # details of unit are set properly
+    assert content_item["src_repo_id"] == "source-foo-bar-repo-1"
+    assert content_item["unit_type"] == "RpmUnit"
+    assert content_item["unit_attr"] == "filename"
+    assert content_item["value"] == "some-filename.rpm"
+
+    content_item = content[1]
+    # details of unit are set properly
+    assert content_item["src_repo_id"] == "source-foo-bar-repo-2"
+    assert content_item["unit_type"] == "RpmUnit"
+    assert content_item["unit_attr"] == "filename"
+    assert content_item["value"] == "some-other-filename.rpm"
+
+
+def test_manifest_get_stored_content(client, redis):
+    """test that manifest stored as json is served with the same content"""
+    stored = '[{"src_repo_id": "src", "unit_type": "RpmUnit", "unit_attr": "filename", "value": "a.rpm"}]'
+    redis.set("ubi_repo_id", stored)
+
+    response = client.get("/api/v1/manifest/ubi_repo_id")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    # content is wrapped in the envelope as it is
+    assert response.text == f'{{"repo_id": "ubi_repo_id", "content": {stored}}}'
+
+
+def test_manifest_get_empty(client, redis):
     """test getting empty manifest for repository"""
     depsolver_result_item = []
     depsolver_result_item_json_str = json.dumps(depsolver_result_item)
 
-    redis_data = {"ubi_repo_id": depsolver_result_item_json_str}
+    redis.set("ubi_repo_id", depsolver_result_item_json_str)
 
-    with mock.patch("ubi_manifest.app.api.redis.from_url") as mock_redis_from_url:
-        mock_redis_from_url.return_value = MockedRedis(data=redis_data)
-        response = client.get(f"/api/v1/manifest/ubi_repo_id")
+    response = client.get(f"/api/v1/manifest/ubi_repo_id")
 
-        # expected status code in 200
-        assert response.status_code == 200
-        json_data = response.json()
-        # repo_id is set to the one we requested
-        assert json_data["repo_id"] == "ubi_repo_id"
+    # expected status code in 200
+    assert response.status_code == 200
+    json_data = response.json()
+    # repo_id is set to the one we requested
+    assert json_data["repo_id"] == "ubi_repo_id"
 
-        content = sorted(json_data["content"], key=lambda x: x["value"])
-        # the content is empty
-        assert len(content) == 0
+    content = sorted(json_data["content"], key=lambda x: x["value"])
+    # the content is empty
+    assert len(content) == 0
 
 
-def test_manifest_get_not_found(client):
+def test_manifest_get_not_found(client, redis):
     """test getting depsolved content when the cotent is not available for given repo_id"""
-    with mock.patch("ubi_manifest.app.api.redis.from_url") as mock_redis_from_url:
-        mock_redis_from_url.return_value = MockedRedis(data={})
-        response = client.get("/api/v1/manifest/ubi_repo_id")
-        # expected status code is 404
-        assert response.status_code == 404
-        json_data = response.json()
-        # response detail is properly set
-        assert json_data["detail"] == "Content for ubi_repo_id not found"
+    response = client.get("/api/v1/manifest/ubi_repo_id")
+    # expected status code is 404
+    assert response.status_code == 404
+    json_data = response.json()
+    # response detail is properly set
+    assert json_data["detail"] == "Content for ubi_repo_id not found"
 
 
 def test_manifest_post(client):
     """test request for depsolving for given repo ids"""
+    redis = fakeredis.FakeRedis()
+    client.app.dependency_overrides[get_sync_redis] = lambda: redis
+
     with mock.patch("celery.app.task.Task.apply_async") as mocked_apply_async:
         mocked_apply_async.return_value = MockAsyncResult(
             task_id="foo-bar-id", state="PENDING"
@@ -155,8 +264,12 @@ def test_manifest_post(client):
         # 'repo_not_allowed' is skipped completely
         # the content config url is also determined from default conf and passed as arg
         mocked_apply_async.assert_called_once_with(
-            args=[["repo_1", "repo_2"], "url_to_config_repository"]
+            args=[["repo_1", "repo_2"], "url_to_config_repository"],
+            task_id=mock.ANY,
         )
+        # the task holds lock of the repo group
+        task_id = mocked_apply_async.call_args.kwargs["task_id"]
+        assert _locks(redis) == {"ubi_manifest:lock:group:group_prefix1": task_id}
 
         # expected status code is 200
         assert response.status_code == 201
@@ -187,3 +300,256 @@ def test_manifest_post_not_allowed(client):
             json_data["detail"]
             == "None of ['repo_not_allowed_1', 'repo_not_allowed_2'] are allowed for depsolving."
         )
+
+
+def test_manifest_post_duplicate(client):
+    """test that depsolving of repo group is not requested while it's in progress"""
+    redis = fakeredis.FakeRedis()
+    redis.set("ubi_manifest:lock:group:group_prefix1", "running-id")
+
+    client.app.dependency_overrides[get_sync_redis] = lambda: redis
+
+    with mock.patch(
+        "celery.app.task.Task.apply_async"
+    ) as mocked_apply_async, mock.patch(
+        "ubi_manifest.app.api.app.AsyncResult"
+    ) as task_mock:
+        task_mock.return_value = MockAsyncResult(task_id="running-id", state="STARTED")
+
+        response = client.post("/api/v1/manifest", json={"repo_ids": ["repo_2"]})
+
+        # no new task is enqueued
+        mocked_apply_async.assert_not_called()
+        task_mock.assert_called_with("running-id")
+        # the task already running is returned instead
+        assert response.status_code == 201
+        assert response.json() == [{"task_id": "running-id", "state": "STARTED"}]
+
+
+def test_manifest_post_finished_duplicate(client):
+    """test that lock of finished task doesn't prevent depsolving of repo group"""
+    redis = fakeredis.FakeRedis()
+    redis.set("ubi_manifest:lock:group:group_prefix1", "failed-id")
+
+    client.app.dependency_overrides[get_sync_redis] = lambda: redis
+
+    with mock.patch(
+        "celery.app.task.Task.apply_async"
+    ) as mocked_apply_async, mock.patch(
+        "ubi_manifest.app.api.app.AsyncResult"
+    ) as task_mock:
+        task_mock.return_value = MockAsyncResult(task_id="failed-id", state="FAILURE")
+        mocked_apply_async.return_value = MockAsyncResult(
+            task_id="new-id", state="PENDING"
+        )
+
+        response = client.post("/api/v1/manifest", json={"repo_ids": ["repo_1"]})
+
+        # new task is enqueued and it takes over the lock
+        mocked_apply_async.assert_called_once()
+        task_id = mocked_apply_async.call_args.kwargs["task_id"]
+        assert _locks(redis) == {"ubi_manifest:lock:group:group_prefix1": task_id}
+        assert response.json() == [{"task_id": "new-id", "state": "PENDING"}]
+
+
+def test_manifest_post_enqueue_failed(client):
+    """test that lock of repo group is released if the task can't be enqueued"""
+    redis = fakeredis.FakeRedis()
+
+    client.app.dependency_overrides[get_sync_redis] = lambda: redis
+
+    with mock.patch("celery.app.task.Task.apply_async") as mocked_apply_async:
+        mocked_apply_async.side_effect = ConnectionError("broker unavailable")
+
+        with pytest.raises(ConnectionError):
+            client.post("/api/v1/manifest", json={"repo_ids": ["repo_1"]})
+
+        # the group is not locked
+        assert _locks(redis) == {}
+
+
+def test_manifest_get_page(client, redis):
+    """test getting filtered manifest page by page"""
+    items = [
+        {
+            "src_repo_id": "rhel_repo",
+            "unit_type": "RpmUnit",
+            "unit_attr": "filename",
+            "value": value,
+        }
+        for value in ("gcc-1.rpm", "gcc-devel-1.rpm", "bind-1.rpm")
+    ]
+    save_manifests(redis, {"ubi_repo_id": items}, ttl=60)
+
+    params = {"unit_type": "RpmUnit", "value_prefix": "gcc", "limit": 1}
+    response = client.get("/api/v1/manifest/ubi_repo_id", params=params)
+
+    assert response.status_code == 200
+    json_data = response.json()
+    assert json_data["repo_id"] == "ubi_repo_id"
+    assert json_data["content"] == [items[0]]
+    assert json_data["next_cursor"]
+
+    params["cursor"] = json_data["next_cursor"]
+    response = client.get("/api/v1/manifest/ubi_repo_id", params=params)
+    json_data = response.json()
+    assert json_data["content"] == [items[1]]
+
+    params["cursor"] = json_data["next_cursor"]
+    response = client.get("/api/v1/manifest/ubi_repo_id", params=params)
+    # there are no more items
+    assert response.json()["content"] == []
+    assert response.json()["next_cursor"] is None
+
+
+def test_manifest_get_page_errors(client, redis):
+    """test getting page of missing manifest or with invalid cursor"""
+    response = client.get("/api/v1/manifest/ubi_repo_id", params={"limit": 10})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Content for ubi_repo_id not found"
+
+    response = client.get("/api/v1/manifest/ubi_repo_id", params={"cursor": "foo"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor: foo"
+
+    response = client.get("/api/v1/manifest/ubi_repo_id", params={"limit": 0})
+    assert response.status_code == 422
+
+
+def test_manifest_diff(client, redis):
+    """test getting changes of manifest since the ETag of older one"""
+    items = [
+        {
+            "src_repo_id": "rhel_repo",
+            "unit_type": "RpmUnit",
+            "unit_attr": "filename",
+            "value": value,
+        }
+        for value in ("gcc-1.rpm", "gcc-2.rpm")
+    ]
+    save_manifests(redis, {"ubi_repo_id": items[:1]}, ttl=60)
+    etag = client.get("/api/v1/manifest/ubi_repo_id").headers["etag"]
+    save_manifests(redis, {"ubi_repo_id": items[1:]}, ttl=60)
+
+    response = client.get("/api/v1/manifest/ubi_repo_id/diff", params={"since": etag})
+
+    assert response.status_code == 200
+    assert response.json() == {
+        "repo_id": "ubi_repo_id",
+        "generation": 2,
+        "etag": manifest_etag(items[1:]),
+        "added": items[1:],
+        "removed": items[:1],
+    }
+
+
+def test_manifest_diff_errors(client, redis):
+    """test getting diff of missing manifest or since expired one"""
+    response = client.get("/api/v1/manifest/ubi_repo_id/diff", params={"since": "1"})
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Content for ubi_repo_id not found"
+
+    for _ in range(3):
+        save_manifests(redis, {"ubi_repo_id": []}, ttl=60)
+    response = client.get("/api/v1/manifest/ubi_repo_id/diff", params={"since": "1"})
+    assert response.status_code == 410
+    assert (
+        response.json()["detail"] == "Manifest of ubi_repo_id since 1 is not available"
+    )
+
+    response = client.get("/api/v1/manifest/ubi_repo_id/diff")
+    assert response.status_code == 422
+
+
+def test_stream_manifest():
+    """test that serialized manifest is streamed wrapped in envelope"""
+    content = [{"value": str(index)} for index in range(5)]
+    body = json.dumps(content).encode("utf-8")
+    chunks = list(_stream_manifest("ubi_repo_id", [body[:10], body[10:]]))
+
+    # envelope and chunks of the manifest
+    assert len(chunks) == 4
+    assert json.loads(b"".join(chunks)) == {
+        "repo_id": "ubi_repo_id",
+        "content": content,
+    }
+
+
+def test_manifests_batch(client, redis):
+    """test getting manifests of multiple repositories at once"""
+    items = [
+        {
+            "src_repo_id": "rhel_repo",
+            "unit_type": "RpmUnit",
+            "unit_attr": "filename",
+            "value": value,
+        }
+        for value in ("gcc-1.rpm", "bind-1.rpm")
+    ]
+    save_manifests(redis, {"ubi_repo_1": items, "ubi_repo_2": []}, ttl=60)
+
+    response = client.post(
+        "/api/v1/manifests:batch",
+        json={"repo_ids": ["ubi_repo_1", "ubi_repo_missing", "ubi_repo_2"]},
+    )
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "repo_id": "ubi_repo_1",
+            "found": True,
+            "content": sorted(items, key=lambda d: d["value"]),
+        },
+        {"repo_id": "ubi_repo_missing", "found": False, "content": None},
+        {"repo_id": "ubi_repo_2", "found": True, "content": []},
+    ]
+
+
+def test_manifests_batch_too_many(client, redis):
+    """test that number of repositories requested at once is limited"""
+    repo_ids = [f"ubi_repo_{index}" for index in range(101)]
+
+    response = client.post("/api/v1/manifests:batch", json={"repo_ids": repo_ids})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "At most 100 repositories can be requested"
+
+    # duplicate ids are requested once
+    response = client.post(
+        "/api/v1/manifests:batch", json={"repo_ids": repo_ids[:1] * 101}
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"repo_id": "ubi_repo_0", "found": False, "content": None}
+    ]
+
+
+def test_manifest_get_etag(client, redis):
+    """test conditional requests for manifest"""
+    with mock.patch("ubi_manifest.worker.tasks.manifest_store.time") as time:
+        time.time.return_value = 1000.0
+        save_manifests(redis, {"ubi_repo_id": []}, ttl=60)
+    etag = f'"{manifest_etag([])}"'
+
+    response = client.get("/api/v1/manifest/ubi_repo_id")
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+    assert response.headers["last-modified"] == "Thu, 01 Jan 1970 00:16:40 GMT"
+
+    with mock.patch("ubi_manifest.app.api.load_manifest_body") as load_body:
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            response = client.get(
+                "/api/v1/manifest/ubi_repo_id",
+                headers={"If-None-Match": if_none_match},
+            )
+            assert response.status_code == 304
+            assert response.headers["etag"] == etag
+            assert response.content == b""
+
+        # content of manifest is not loaded for unchanged manifest
+        load_body.assert_not_called()
+
+    response = client.get(
+        "/api/v1/manifest/ubi_repo_id", headers={"If-None-Match": '"other"'}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"repo_id": "ubi_repo_id", "content": []}
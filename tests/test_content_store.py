@@ -0,0 +1,110 @@
+from datetime import datetime
+
+from pubtools.pulplib import Distributor, RpmDependency, RpmUnit, YumRepository
+
+from ubi_manifest.worker.tasks.depsolver import content_store
+from ubi_manifest.worker.tasks.depsolver.content_store import (
+    ContentStore,
+    get_content_store,
+    repo_revision,
+)
+from ubi_manifest.worker.tasks.depsolver.models import UbiUnit
+
+
+def _make_units(repo_id):
+    unit_1 = RpmUnit(
+        name="gcc",
+        version="10",
+        release="200",
+        arch="x86_64",
+        filename="gcc-10-200.x86_64.rpm",
+        provides=[RpmDependency(name="gcc")],
+        requires=[RpmDependency(name="lib.a", version="1", flags="GE")],
+    )
+    unit_2 = RpmUnit(
+        name="jq",
+        version="1",
+        release="1",
+        arch="x86_64",
+        filename="jq-1-1.x86_64.rpm",
+    )
+    return [UbiUnit(unit, repo_id) for unit in (unit_1, unit_2)]
+
+
+def test_put_and_get(tmp_path):
+    """test storing content of repository and loading it back"""
+    store = ContentStore(str(tmp_path))
+    store.put("test_repo", "rev-1", _make_units("test_repo"))
+
+    units = store.get("test_repo", "rev-1")
+    # all units are loaded with proper associate_source_repo_id
+    assert sorted(unit.filename for unit in units) == [
+        "gcc-10-200.x86_64.rpm",
+        "jq-1-1.x86_64.rpm",
+    ]
+    assert {unit.associate_source_repo_id for unit in units} == {"test_repo"}
+    gcc = [unit for unit in units if unit.name == "gcc"][0]
+    assert gcc.requires == [RpmDependency(name="lib.a", version="1", flags="GE")]
+
+    # content is persisted, another instance of the store can read it
+    assert len(ContentStore(str(tmp_path)).get("test_repo", "rev-1")) == 2
+
+
+def test_get_stale_or_missing(tmp_path):
+    """test that stale or missing content is not returned"""
+    store = ContentStore(str(tmp_path))
+    store.put("test_repo", "rev-1", _make_units("test_repo"))
+
+    # revision of repository changed
+    assert store.get("test_repo", "rev-2") is None
+    # unknown repository
+    assert store.get("other_repo", "rev-1") is None
+
+
+def test_put_replaces_content(tmp_path):
+    """test that refreshing content of repository replaces the old content"""
+    store = ContentStore(str(tmp_path))
+    store.put("test_repo", "rev-1", _make_units("test_repo"))
+    store.put("test_repo", "rev-2", _make_units("test_repo")[:1])
+
+    assert store.get("test_repo", "rev-1") is None
+    assert [unit.name for unit in store.get("test_repo", "rev-2")] == ["gcc"]
+
+
+def test_repo_revision():
+    """test getting revision marker of repository"""
+    repo = YumRepository(
+        id="test_repo",
+        distributors=[
+            Distributor(
+                id="yum_distributor",
+                type_id="yum_distributor",
+                last_publish=datetime(2023, 1, 1, 10, 0),
+            ),
+            Distributor(
+                id="cdn_distributor",
+                type_id="rpm_rsync_distributor",
+                last_publish=datetime(2023, 1, 2, 10, 0),
+            ),
+            Distributor(id="other_distributor", type_id="iso_distributor"),
+        ],
+    )
+    # the latest publish is used as revision
+    assert repo_revision(repo) == "2023-01-02T10:00:00"
+    # never published repository has no revision
+    assert repo_revision(YumRepository(id="test_repo")) is None
+
+
+def test_get_content_store(tmp_path, monkeypatch):
+    """test that content store is available only when configured"""
+    monkeypatch.setattr(content_store, "CONTENT_STORE_DIR", "")
+    assert get_content_store() is None
+
+    monkeypatch.setattr(content_store, "CONTENT_STORE_DIR", str(tmp_path))
+    store = get_content_store()
+    assert isinstance(store, ContentStore)
+    # the store is created only once per directory
+    assert get_content_store() is store
+
+    monkeypatch.setattr(content_store, "CONTENT_STORE_DIR", str(tmp_path / "other"))
+    assert get_content_store() is not store
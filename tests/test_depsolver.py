@@ -1,5 +1,8 @@
+from concurrent.futures import Future
+
 import pytest
-from pubtools.pulplib import ModulemdUnit, RpmDependency, RpmUnit
+from more_executors.futures import f_return
+from pubtools.pulplib import ModulemdUnit, RpmDependency, RpmUnit, YumRepository
 from testfixtures import LogCapture
 
 from ubi_manifest.worker.tasks.depsolver.models import (
@@ -7,8 +10,10 @@ from ubi_manifest.worker.tasks.depsolver.models import (
     PackageToExclude,
     UbiUnit,
 )
+from ubi_manifest.worker.tasks.depsolver import rpm_depsolver
 from ubi_manifest.worker.tasks.depsolver.rpm_depsolver import (
     BATCH_SIZE_RESOLVER,
+    MAX_BATCHES_IN_FLIGHT,
     Depsolver,
 )
 
@@ -82,6 +87,48 @@ def test_extract_and_resolve():
     assert depsolver._unsolved == rpmdeps_from_names("pkg_a", "pkg_f", "pkg_g", "pkg_h")
 
 
+def test_extract_and_resolve_incremental():
+    """test that requires are resolved by provides seen in previous iterations"""
+    depsolver = Depsolver(None, None, None)
+
+    unit_1 = RpmUnit(
+        name="test",
+        version="10",
+        release="200",
+        epoch="1",
+        arch="x86_64",
+        provides=[RpmDependency(name="pkg_a", version="1.0", flags="EQ")],
+        requires=[RpmDependency(name="pkg_b")],
+    )
+    depsolver.extract_and_resolve([unit_1])
+    # pkg_a is indexed by its name
+    assert list(depsolver._provides_index) == ["pkg_a"]
+    assert depsolver._unsolved == rpmdeps_from_names("pkg_b")
+
+    unit_2 = RpmUnit(
+        name="test-2",
+        version="10",
+        release="200",
+        epoch="1",
+        arch="x86_64",
+        provides=[RpmDependency(name="pkg_b")],
+        requires=[
+            RpmDependency(name="pkg_a", version="0.5", flags="GE"),
+            RpmDependency(name="pkg_a", version="2.0", flags="GE"),
+        ],
+    )
+    depsolver.extract_and_resolve([unit_2])
+    # pkg_b is resolved by new provide, pkg_a >= 0.5 is resolved by
+    # provide from previous iteration, pkg_a >= 2.0 remains unsolved
+    assert depsolver._unsolved == {
+        RpmDependency(name="pkg_a", version="2.0", flags="GE")
+    }
+
+    # already visited provides are not indexed again
+    depsolver.extract_and_resolve([unit_1])
+    assert len(depsolver._provides_index["pkg_a"]) == 1
+
+
 def test_get_base_packages(pulp):
     """test queries for input packages for given repo"""
     depsolver = Depsolver(None, None, None)
@@ -177,6 +224,43 @@ def test_get_pkgs_from_all_modules(pulp):
     assert result == expected_filenames
 
 
+def test_get_snapshot(monkeypatch):
+    """test that snapshot of repo is loaded once, outside the lock"""
+    depsolver = Depsolver(None, None, None)
+    repo = YumRepository(id="test_repo")
+    unit = RpmUnit(name="test", version="1", release="1", arch="x86_64")
+    loads = []
+
+    def search_all_rpms(repo):
+        # snapshots of other repos can be loaded meanwhile
+        assert not depsolver._snapshots_lock.locked()
+        loads.append(repo.id)
+        return f_return({UbiUnit(unit, repo.id)})
+
+    monkeypatch.setattr(rpm_depsolver, "search_all_rpms", search_all_rpms)
+
+    snapshot_ft = depsolver._get_snapshot(repo)
+    assert depsolver._get_snapshot(repo) is snapshot_ft
+    assert len(snapshot_ft.result()) == 1
+    assert loads == ["test_repo"]
+
+
+def test_get_snapshot_failed(monkeypatch):
+    """test that failure of loading of snapshot is propagated to all callers"""
+    depsolver = Depsolver(None, None, None)
+    repo = YumRepository(id="test_repo")
+
+    def search_all_rpms(repo):
+        raise RuntimeError("content store unavailable")
+
+    monkeypatch.setattr(rpm_depsolver, "search_all_rpms", search_all_rpms)
+
+    with pytest.raises(RuntimeError):
+        depsolver._get_snapshot(repo)
+    with pytest.raises(RuntimeError):
+        depsolver._get_snapshot(repo).result()
+
+
 @pytest.mark.parametrize(
     "items, expected_batch_size",
     [
@@ -194,8 +278,45 @@ def test_batch_size(items, expected_batch_size):
     assert batch_size == expected_batch_size
 
 
-def test_run(pulp):
+def test_progress_queries():
+    """test counting of queries in flight and units fetched by them"""
+    depsolver = Depsolver(None, None, None)
+    assert depsolver.progress() == {
+        "phase": "pending",
+        "unsolved": 0,
+        "iteration": 0,
+        "queries_in_flight": 0,
+        "units_fetched": 0,
+    }
+
+    query_1, query_2 = Future(), Future()
+    assert depsolver._track_query(query_1) is query_1
+    depsolver._track_query(query_2)
+    assert depsolver.progress()["queries_in_flight"] == 2
+
+    query_1.set_result({"unit_1", "unit_2"})
+    query_2.set_exception(RuntimeError("search failed"))
+    progress = depsolver.progress()
+    assert progress["queries_in_flight"] == 0
+    # units of failed queries are not counted
+    assert progress["units_fetched"] == 2
+
+
+@pytest.mark.parametrize(
+    "batch_size, batches_in_flight, snapshot",
+    [
+        (BATCH_SIZE_RESOLVER, MAX_BATCHES_IN_FLIGHT, False),
+        (1, 1, False),
+        (1, 4, False),
+        (BATCH_SIZE_RESOLVER, MAX_BATCHES_IN_FLIGHT, True),
+    ],
+)
+def test_run(pulp, monkeypatch, batch_size, batches_in_flight, snapshot):
     """test the main method of depsolver"""
+    # the result should be the same regardless how many batches are resolved at once
+    # and whether depsolving is done locally on snapshots of repos
+    monkeypatch.setattr(rpm_depsolver, "BATCH_SIZE_RESOLVER", batch_size)
+    monkeypatch.setattr(rpm_depsolver, "MAX_BATCHES_IN_FLIGHT", batches_in_flight)
     repos, repo_srpm, expected_output_set = _prepare_test_data(pulp)
 
     blacklist_1 = [
@@ -231,9 +352,18 @@ def test_run(pulp):
     }
 
     with LogCapture() as mock_log:
-        with Depsolver([dep_item_1, dep_item_2], [repo_srpm], module_rpms) as depsolver:
+        with Depsolver(
+            [dep_item_1, dep_item_2], [repo_srpm], module_rpms, snapshot=snapshot
+        ) as depsolver:
             depsolver.run()
 
+            # progress reports finished depsolving
+            progress = depsolver.progress()
+            assert progress["phase"] == "done"
+            assert progress["unsolved"] == 0
+            assert progress["iteration"] > 0
+            assert progress["units_fetched"] > 0
+
             # check internal state of depsolver object
             # provides set holds all capabilities that we went through during depsolving
             assert depsolver._provides == rpmdeps_from_names(
@@ -951,3 +1081,141 @@ def test_log_missing_base_pkgs(pulp):
                 for item in depsolver.output_set | depsolver.srpm_output_set
             ]
             assert output == [("gcc", "test_repo_rpm")]
+
+
+def test_run_with_open_whitelist(pulp):
+    """test streaming of output of one depsolver to whitelist of another one"""
+    repo_rpm = create_and_insert_repo(id="test_repo_rpm", pulp=pulp)
+    repo_debug = create_and_insert_repo(id="test_repo_debug", pulp=pulp)
+    pulp.insert_units(
+        repo_rpm,
+        [
+            RpmUnit(
+                name="gcc",
+                version="10",
+                release="200",
+                arch="x86_64",
+                sourcerpm="gcc-10-200.src.rpm",
+                requires=[RpmDependency(name="lib.a")],
+                provides=[],
+            ),
+            RpmUnit(
+                name="lib-a",
+                version="1",
+                release="1",
+                arch="x86_64",
+                sourcerpm="lib-a-1-1.src.rpm",
+                requires=[],
+                provides=[RpmDependency(name="lib.a")],
+            ),
+        ],
+    )
+    pulp.insert_units(
+        repo_debug,
+        [
+            RpmUnit(
+                name=f"{name}-debuginfo",
+                version="1",
+                release="1",
+                arch="x86_64",
+                requires=[],
+                provides=[],
+            )
+            for name in ("gcc", "lib-a")
+        ],
+    )
+
+    dep_item = DepsolverItem(whitelist={"gcc"}, blacklist=[], in_pulp_repos=[repo_rpm])
+    debug_item = DepsolverItem(
+        whitelist=set(), blacklist=[], in_pulp_repos=[repo_debug]
+    )
+
+    with Depsolver([dep_item], [], []) as depsolver, Depsolver(
+        [debug_item], [], [], open_whitelist=True
+    ) as debug_depsolver:
+        published = []
+
+        def feed(units):
+            published.extend(unit.name for unit in units)
+            debug_depsolver.extend_whitelist(
+                debug_item, {f"{unit.name}-debuginfo" for unit in units}
+            )
+
+        depsolver.subscribe(feed)
+        debug_ft = depsolver._executor.submit(debug_depsolver.run)
+        depsolver.run()
+        # debug depsolver waits for more packages until the whitelist is closed
+        assert not debug_ft.done()
+        # packages already whitelisted are not searched again
+        debug_depsolver.extend_whitelist(debug_item, {"gcc-debuginfo"})
+        debug_depsolver.close_whitelist()
+        debug_ft.result()
+
+    # both base package and its dependency are streamed
+    assert sorted(published) == ["gcc", "lib-a"]
+    assert sorted(unit.name for unit in debug_depsolver.output_set) == [
+        "gcc-debuginfo",
+        "lib-a-debuginfo",
+    ]
+    assert debug_item.whitelist == {"gcc-debuginfo", "lib-a-debuginfo"}
+
+    # whitelist can't be extended if it's not open
+    with pytest.raises(RuntimeError):
+        depsolver.extend_whitelist(dep_item, {"jq"})
+
+
+def test_run_modular_deps_future(pulp):
+    """test that modular dependencies can be passed as a future"""
+    repo_rpm = create_and_insert_repo(id="test_repo_rpm", pulp=pulp)
+    repo_srpm = create_and_insert_repo(id="test_repo_srpm", pulp=pulp)
+    pulp.insert_units(
+        repo_rpm,
+        [
+            RpmUnit(
+                name=name,
+                version="1",
+                release="1",
+                arch="x86_64",
+                filename=f"{name}-1-1.x86_64.rpm",
+                sourcerpm=f"{name}-1-1.src.rpm",
+                requires=[],
+                provides=[],
+            )
+            for name in ("gcc", "modular-pkg")
+        ],
+    )
+    pulp.insert_units(
+        repo_srpm,
+        [
+            RpmUnit(
+                name="modular-pkg",
+                version="1",
+                release="1",
+                arch="src",
+                filename="modular-pkg-1-1.src.rpm",
+                content_type_id="srpm",
+            )
+        ],
+    )
+
+    dep_item = DepsolverItem(whitelist={"gcc"}, blacklist=[], in_pulp_repos=[repo_rpm])
+    modulemd_deps = Future()
+
+    with Depsolver([dep_item], [repo_srpm], modulemd_deps) as depsolver:
+        run_ft = depsolver._executor.submit(depsolver.run)
+        # base packages don't wait for modular dependencies
+        # but the depsolver can't finish without them
+        assert not run_ft.done()
+        modulemd_deps.set_result(
+            {"modular-pkg-1-1.x86_64.rpm", "modular-pkg-1-1.src.rpm"}
+        )
+        run_ft.result()
+
+    assert sorted(unit.filename for unit in depsolver.output_set) == [
+        "gcc-1-1.x86_64.rpm",
+        "modular-pkg-1-1.x86_64.rpm",
+    ]
+    # srpm is found both as modular dependency and source of the binary rpm
+    assert {unit.filename for unit in depsolver.srpm_output_set} == {
+        "modular-pkg-1-1.src.rpm"
+    }
@@ -0,0 +1,41 @@
+import fakeredis
+import pytest
+
+from ubi_manifest.worker.tasks.depsolver.item_memo import ItemMemo
+
+
+@pytest.fixture(name="item_memo")
+def fake_item_memo():
+    yield ItemMemo(fakeredis.FakeRedis(), ttl=60)
+
+
+def test_item_memo(item_memo):
+    """test that memoized items are returned only for the same fingerprint"""
+    result = {
+        "ubi_repo": [
+            {
+                "src_repo_id": "rhel_repo",
+                "unit_type": "RpmUnit",
+                "unit_attr": "filename",
+                "value": "gcc-1-1.x86_64.rpm",
+            }
+        ]
+    }
+
+    assert item_memo.get("ubi_repo", "cs_in", "fingerprint") is None
+
+    item_memo.put("ubi_repo", "cs_in", "fingerprint", result)
+    assert item_memo.get("ubi_repo", "cs_in", "fingerprint") == result
+    # inputs changed
+    assert item_memo.get("ubi_repo", "cs_in", "other-fingerprint") is None
+    # items are memoized per depsolver item
+    assert item_memo.get("ubi_repo", "cs_in_other", "fingerprint") is None
+
+
+def test_item_memo_expiration():
+    """test that memoized items expire"""
+    redis = fakeredis.FakeRedis()
+    item_memo = ItemMemo(redis, ttl=60)
+    item_memo.put("ubi_repo", "cs_in", "fingerprint", {})
+
+    assert 0 < redis.ttl(ItemMemo.make_key("ubi_repo", "cs_in")) <= 60
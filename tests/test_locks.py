@@ -0,0 +1,81 @@
+from unittest import mock
+
+import fakeredis
+
+from ubi_manifest.worker.tasks.locks import (
+    acquire_lock,
+    acquire_locks,
+    release_lock,
+    repo_lock_key,
+)
+
+from .utils import MockAsyncResult
+
+
+def test_acquire_lock():
+    """test that lock is held by one unfinished task at a time"""
+    redis = fakeredis.FakeRedis()
+
+    with mock.patch("ubi_manifest.worker.tasks.locks.app.AsyncResult") as task_mock:
+        task_mock.return_value = MockAsyncResult(task_id="task-1", state="STARTED")
+
+        assert acquire_lock(redis, "lock", "task-1", 60) is None
+        assert 0 < redis.ttl("lock") <= 60
+        # the same task can acquire the lock again, e.g. when it's retried
+        assert acquire_lock(redis, "lock", "task-1", 60) is None
+        # other task can't acquire the lock
+        assert acquire_lock(redis, "lock", "task-2", 60) == "task-1"
+
+        # lock of finished task is taken over
+        task_mock.return_value = MockAsyncResult(task_id="task-1", state="SUCCESS")
+        assert acquire_lock(redis, "lock", "task-2", 60) is None
+        assert redis.get("lock") == b"task-2"
+
+
+def test_acquire_lock_takeover_race():
+    """test that lock is not taken over if it changed during the takeover"""
+    redis = fakeredis.FakeRedis()
+    redis.set("lock", "task-1")
+
+    def task_state(task_id):
+        # another task takes over the lock while the state of the holder is checked
+        if task_id == "task-1":
+            redis.set("lock", "task-2")
+            return MockAsyncResult(task_id=task_id, state="FAILURE")
+        return MockAsyncResult(task_id=task_id, state="STARTED")
+
+    with mock.patch(
+        "ubi_manifest.worker.tasks.locks.app.AsyncResult", side_effect=task_state
+    ):
+        assert acquire_lock(redis, "lock", "task-3", 60) == "task-2"
+
+    assert redis.get("lock") == b"task-2"
+
+
+def test_release_lock():
+    """test that only the holder of lock can release it"""
+    redis = fakeredis.FakeRedis()
+    acquire_lock(redis, "lock", "task-1", 60)
+
+    release_lock(redis, "lock", "task-2")
+    assert redis.get("lock") == b"task-1"
+
+    release_lock(redis, "lock", "task-1")
+    assert redis.get("lock") is None
+
+
+def test_acquire_locks():
+    """test that either all locks or none of them are acquired"""
+    redis = fakeredis.FakeRedis()
+    redis.set(repo_lock_key("repo-2"), "task-1")
+    keys = [repo_lock_key(repo_id) for repo_id in ("repo-1", "repo-2", "repo-3")]
+
+    with mock.patch("ubi_manifest.worker.tasks.locks.app.AsyncResult") as task_mock:
+        task_mock.return_value = MockAsyncResult(task_id="task-1", state="PENDING")
+
+        assert acquire_locks(redis, keys, "task-2", 60) == "task-1"
+        assert sorted(redis.keys()) == [b"ubi_manifest:lock:repo:repo-2"]
+
+        release_lock(redis, repo_lock_key("repo-2"), "task-1")
+        assert acquire_locks(redis, keys, "task-2", 60) is None
+        assert {redis.get(key) for key in keys} == {b"task-2"}
@@ -0,0 +1,483 @@
+import json
+from unittest import mock
+
+import fakeredis
+import pytest
+
+from ubi_manifest.worker.tasks.manifest_store import (
+    GENERATION_KEY,
+    GenerationExpired,
+    InvalidCursor,
+    current_key,
+    current_generation,
+    get_meta,
+    decode_cursor,
+    decode_manifest,
+    encode_cursor,
+    encode_manifest,
+    get_page,
+    load_diff,
+    load_manifest,
+    load_manifest_bodies,
+    load_manifest_body,
+    manifest_body,
+    manifest_etag,
+    save_manifests,
+)
+
+from .utils import fake_redis_clients
+
+
+def _item(value, src_repo_id="rhel_repo", unit_type="RpmUnit", unit_attr="filename"):
+    return {
+        "src_repo_id": src_repo_id,
+        "unit_type": unit_type,
+        "unit_attr": unit_attr,
+        "value": value,
+    }
+
+
+ITEMS = [
+    _item("gcc-1.rpm"),
+    _item("bind-1.rpm"),
+    _item("gcc-devel-1.rpm"),
+    _item("gdb-1.rpm", src_repo_id="rhel_other_repo"),
+    _item("perl:5.30", unit_type="ModulemdDefaultsUnit", unit_attr="name:stream"),
+]
+
+
+def _stored(items):
+    """items in the order of stored manifest - by unit type, source repo and value"""
+    return sorted(
+        items,
+        key=lambda item: (
+            item["unit_type"],
+            item["unit_attr"],
+            item["src_repo_id"],
+            item["value"],
+        ),
+    )
+
+
+@pytest.fixture(name="async_redis", params=["partitioned", "chunked", "legacy"])
+def fake_async_redis(request, monkeypatch):
+    redis, async_redis = fake_redis_clients()
+    if request.param == "chunked":
+        # values of partitions are spread over more chunks
+        monkeypatch.setattr("ubi_manifest.worker.tasks.manifest_store.CHUNK_SIZE", 1)
+    if request.param in ("partitioned", "chunked"):
+        save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+    else:
+        # manifest saved before partitions were introduced
+        redis.set("ubi_repo", json.dumps(ITEMS))
+    yield async_redis
+
+
+async def _read_all(redis, limit, **filters):
+    items, cursor, pages = [], None, 0
+    while True:
+        page, cursor = await get_page(
+            redis, "ubi_repo", cursor=cursor, limit=limit, **filters
+        )
+        items.extend(page)
+        pages += 1
+        if cursor is None:
+            return items, pages
+
+
+@pytest.mark.anyio
+async def test_save_manifests():
+    """test that manifests are saved as new generations with expiration"""
+    redis, async_redis = fake_redis_clients()
+    # manifest saved before generations were introduced
+    redis.set("ubi_repo", json.dumps([_item("legacy-1.rpm")]))
+
+    generation = save_manifests(
+        redis, {"ubi_repo": ITEMS, "ubi_empty_repo": []}, ttl=60
+    )
+
+    assert generation == 1
+    assert await load_manifest(async_redis, "ubi_repo") == _stored(ITEMS)
+    assert await load_manifest(async_redis, "ubi_empty_repo") == []
+    assert await current_generation(async_redis, "ubi_repo") == 1
+    assert all(
+        0 < redis.ttl(key) <= 60
+        for key in redis.keys()
+        if key != GENERATION_KEY.encode()
+    )
+    # legacy manifest is replaced
+    assert redis.get("ubi_repo") is None
+
+
+@pytest.mark.anyio
+async def test_save_manifests_meta():
+    """test that hash and time of last change are stored with manifests"""
+    redis, async_redis = fake_redis_clients()
+    with mock.patch("ubi_manifest.worker.tasks.manifest_store.time") as time:
+        time.time.return_value = 1000.0
+        save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+
+    meta = await get_meta(async_redis, "ubi_repo")
+    assert meta.generation == 1
+    assert meta.etag == manifest_etag(ITEMS)
+    assert meta.last_modified == 1000.0
+    assert await get_meta(async_redis, "ubi_missing_repo") is None
+
+    # the same content in different order
+    with mock.patch("ubi_manifest.worker.tasks.manifest_store.time") as time:
+        time.time.return_value = 2000.0
+        save_manifests(redis, {"ubi_repo": ITEMS[::-1]}, ttl=60)
+
+    meta = await get_meta(async_redis, "ubi_repo")
+    assert meta.generation == 2
+    assert meta.etag == manifest_etag(ITEMS)
+    # content didn't change since the first generation
+    assert meta.last_modified == 1000.0
+
+    with mock.patch("ubi_manifest.worker.tasks.manifest_store.time") as time:
+        time.time.return_value = 3000.0
+        save_manifests(redis, {"ubi_repo": ITEMS[1:]}, ttl=60)
+
+    meta = await get_meta(async_redis, "ubi_repo")
+    assert meta.etag != manifest_etag(ITEMS)
+    assert meta.last_modified == 3000.0
+
+
+@pytest.mark.anyio
+async def test_save_manifests_generations():
+    """test that only the latest generations of manifests are kept"""
+    redis, async_redis = fake_redis_clients()
+    for value in ("a.rpm", "b.rpm", "c.rpm"):
+        save_manifests(redis, {"ubi_repo": [_item(value)]}, ttl=60)
+
+    assert await load_manifest(async_redis, "ubi_repo") == [_item("c.rpm")]
+    assert await get_page(async_redis, "ubi_repo") == ([_item("c.rpm")], None)
+    # the previous generation is still available
+    previous = await load_manifest(async_redis, "ubi_repo", generation=2)
+    assert previous == [_item("b.rpm")]
+    # older generations are removed with all their keys
+    assert await load_manifest(async_redis, "ubi_repo", generation=1) is None
+    assert redis.keys("ubi_manifest:manifest:ubi_repo:1:*") == []
+    assert redis.zrange("ubi_manifest:manifest:ubi_repo:generations", 0, -1) == [
+        b"2",
+        b"3",
+    ]
+
+
+def test_save_manifests_atomic():
+    """test that manifests of all repos become current at once"""
+    redis = fakeredis.FakeRedis()
+    save_manifests(redis, {"ubi_repo": ITEMS, "ubi_debug_repo": ITEMS}, ttl=60)
+
+    execute = redis.pipeline().__class__.execute
+    generations = []
+
+    def execute_and_check(pipe, *args, **kwargs):
+        # all repos have the same generation whenever a pipeline is executed
+        generations.append(
+            {
+                json.loads(redis.get(current_key(repo)))["generation"]
+                for repo in ("ubi_repo", "ubi_debug_repo")
+            }
+        )
+        return execute(pipe, *args, **kwargs)
+
+    with mock.patch.object(redis.pipeline().__class__, "execute", execute_and_check):
+        save_manifests(redis, {"ubi_repo": [], "ubi_debug_repo": []}, ttl=60)
+
+    assert all(len(generation) == 1 for generation in generations)
+
+
+@pytest.mark.anyio
+async def test_get_page(async_redis):
+    """test that items are ordered by unit type, source repo and value"""
+    items, cursor = await get_page(async_redis, "ubi_repo")
+    assert cursor is None
+    assert [item["value"] for item in items] == [
+        "perl:5.30",
+        "gdb-1.rpm",
+        "bind-1.rpm",
+        "gcc-1.rpm",
+        "gcc-devel-1.rpm",
+    ]
+    assert items[0] == ITEMS[4]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("limit", [1, 2, 5])
+async def test_get_page_cursor(async_redis, limit):
+    """test reading manifest page by page"""
+    items, pages = await _read_all(async_redis, limit)
+
+    assert sorted(items, key=lambda item: item["value"]) == sorted(
+        ITEMS, key=lambda item: item["value"]
+    )
+    # all pages are full, the last one may be empty
+    assert pages == len(ITEMS) // limit + 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "filters,expected",
+    [
+        (
+            {"unit_type": "RpmUnit"},
+            ["gdb-1.rpm", "bind-1.rpm", "gcc-1.rpm", "gcc-devel-1.rpm"],
+        ),
+        ({"unit_type": "ModulemdUnit"}, []),
+        ({"src_repo_id": "rhel_other_repo"}, ["gdb-1.rpm"]),
+        ({"value_prefix": "gcc"}, ["gcc-1.rpm", "gcc-devel-1.rpm"]),
+        (
+            {"value_prefix": "g", "src_repo_id": "rhel_repo"},
+            ["gcc-1.rpm", "gcc-devel-1.rpm"],
+        ),
+    ],
+)
+async def test_get_page_filters(async_redis, filters, expected):
+    """test filtering of manifest items on all pages"""
+    items, _ = await _read_all(async_redis, 1, **filters)
+    assert [item["value"] for item in items] == expected
+
+
+@pytest.mark.anyio
+async def test_get_page_missing():
+    """test that None is returned for missing manifest"""
+    assert await get_page(fakeredis.FakeAsyncRedis(), "ubi_repo") is None
+
+
+@pytest.mark.anyio
+async def test_load_manifest_bodies():
+    """test loading manifests of multiple repos at once"""
+    redis, async_redis = fake_redis_clients()
+    save_manifests(redis, {"ubi_repo": ITEMS[:1]}, ttl=60)
+    save_manifests(redis, {"ubi_repo": ITEMS, "ubi_empty_repo": []}, ttl=60)
+    redis.set("ubi_legacy_repo", json.dumps(ITEMS[:1]))
+
+    with mock.patch.object(
+        async_redis, "pipeline", wraps=async_redis.pipeline
+    ) as pipeline, mock.patch.object(async_redis, "mget") as mget, mock.patch.object(
+        async_redis, "get"
+    ) as get, mock.patch(
+        "ubi_manifest.worker.tasks.manifest_store.manifest_body",
+        wraps=manifest_body,
+    ) as body:
+        bodies = await load_manifest_bodies(
+            async_redis,
+            [
+                "ubi_repo",
+                "ubi_missing_repo",
+                "ubi_legacy_repo",
+                "ubi_repo",
+                "ubi_empty_repo",
+            ],
+        )
+        # manifests are decompressed only when they're consumed
+        body.assert_not_called()
+        manifests = {
+            repo_id: None if chunks is None else json.loads(b"".join(chunks))
+            for repo_id, chunks in bodies.items()
+        }
+
+    assert manifests == {
+        "ubi_repo": _stored(ITEMS),
+        "ubi_missing_repo": None,
+        "ubi_legacy_repo": ITEMS[:1],
+        "ubi_empty_repo": [],
+    }
+    # all manifests are read in one transaction
+    pipeline.assert_called_once_with(transaction=True)
+    mget.assert_not_called()
+    get.assert_not_called()
+
+    missing = await load_manifest_bodies(async_redis, ["ubi_missing_repo"])
+    assert missing == {"ubi_missing_repo": None}
+
+
+@pytest.mark.anyio
+async def test_get_page_generation():
+    """test that all pages are read from the same generation of manifest"""
+    redis, async_redis = fake_redis_clients()
+    save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+    first_page, cursor = await get_page(async_redis, "ubi_repo", limit=2)
+
+    save_manifests(redis, {"ubi_repo": [_item("zsh-1.rpm")]}, ttl=60)
+    # pages of the previous generation are still returned
+    second_page, _ = await get_page(async_redis, "ubi_repo", cursor=cursor, limit=2)
+    assert [item["value"] for item in first_page + second_page] == [
+        "perl:5.30",
+        "gdb-1.rpm",
+        "bind-1.rpm",
+        "gcc-1.rpm",
+    ]
+
+    # the generation was removed
+    save_manifests(redis, {"ubi_repo": [_item("zsh-1.rpm")]}, ttl=60)
+    with pytest.raises(InvalidCursor):
+        await get_page(async_redis, "ubi_repo", cursor=cursor, limit=2)
+
+
+@pytest.mark.anyio
+async def test_get_page_expired():
+    """test that no items are returned when the manifest expires while it's read"""
+    redis, async_redis = fake_redis_clients()
+    save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+
+    with mock.patch.object(async_redis, "getrange", mock.AsyncMock(return_value=b"")):
+        items, cursor = await get_page(async_redis, "ubi_repo")
+
+    assert items == []
+    assert cursor is None
+
+
+@pytest.mark.anyio
+async def test_get_page_legacy_migrated():
+    """test that cursor of legacy manifest expires when the manifest is replaced"""
+    redis, async_redis = fake_redis_clients()
+    redis.set("ubi_repo", json.dumps(ITEMS))
+    _, cursor = await get_page(async_redis, "ubi_repo", limit=2)
+
+    save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+    with pytest.raises(InvalidCursor):
+        await get_page(async_redis, "ubi_repo", cursor=cursor, limit=2)
+
+
+@pytest.mark.anyio
+async def test_load_diff():
+    """test getting changes of manifest since older generation"""
+    redis, async_redis = fake_redis_clients()
+    save_manifests(redis, {"ubi_repo": ITEMS[:3]}, ttl=60)
+    save_manifests(redis, {"ubi_repo": ITEMS[1:]}, ttl=60)
+    etag = manifest_etag(ITEMS[1:])
+
+    for since in ("1", manifest_etag(ITEMS[:3]), f'W/"{manifest_etag(ITEMS[:3])}"'):
+        diff = await load_diff(async_redis, "ubi_repo", since)
+        assert diff.generation == 2
+        assert diff.etag == etag
+        assert diff.added == _stored(ITEMS[3:])
+        assert diff.removed == ITEMS[:1]
+
+    # no changes since the current generation
+    for since in ("2", etag):
+        diff = await load_diff(async_redis, "ubi_repo", since)
+        assert (diff.added, diff.removed) == ([], [])
+
+    # the first generation is removed
+    save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+    for since in ("1", manifest_etag(ITEMS[:3]), "4", "unknown"):
+        with pytest.raises(GenerationExpired):
+            await load_diff(async_redis, "ubi_repo", since)
+
+    diff = await load_diff(async_redis, "ubi_repo", etag)
+    assert diff.added == ITEMS[:1]
+    assert diff.removed == []
+    assert await load_diff(async_redis, "ubi_missing_repo", "1") is None
+
+
+@pytest.mark.anyio
+async def test_load_diff_same_content():
+    """test that the latest generation with given ETag is diffed"""
+    redis, async_redis = fake_redis_clients()
+    for items in (ITEMS, ITEMS[::-1], ITEMS[1:]):
+        save_manifests(redis, {"ubi_repo": items}, ttl=60)
+
+    # the first generation with the same ETag is removed already
+    diff = await load_diff(async_redis, "ubi_repo", manifest_etag(ITEMS))
+    assert diff.removed == ITEMS[:1]
+
+    # manifest expired meanwhile
+    redis.delete("ubi_manifest:manifest:ubi_repo:3:content")
+    assert await load_diff(async_redis, "ubi_repo", manifest_etag(ITEMS)) is None
+
+
+def test_cursor():
+    """test encoding and decoding of cursors"""
+    partition = ("RpmUnit", "filename", "rhel_repo")
+    assert decode_cursor(encode_cursor(1, partition, "gcc.rpm")) == (
+        1,
+        partition,
+        "gcc.rpm",
+    )
+    assert decode_cursor(encode_cursor(None, partition, "gcc.rpm"))[0] is None
+
+    for cursor in [
+        "not-base64!",
+        "bm90LWpzb24=",
+        encode_cursor(1, partition[:2], "a"),
+        encode_cursor("x", partition, "a"),
+    ]:
+        with pytest.raises(InvalidCursor):
+            decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_encode_manifest(compression, monkeypatch):
+    """test that encoded manifests are decoded to the same items"""
+    monkeypatch.setattr("ubi_manifest.worker.tasks.manifest_store.CHUNK_SIZE", 2)
+    data = encode_manifest(ITEMS, compression)
+
+    assert data.startswith(b"UBIM\x01")
+    assert decode_manifest(data) == _stored(ITEMS)
+    assert decode_manifest(encode_manifest([], compression)) == []
+
+
+def test_encode_manifest_dictionary():
+    """test that partitions of items are stored once, not with every item"""
+    items = [_item(f"gcc-{num}.rpm") for num in range(100)]
+    data = encode_manifest(items, "none")
+
+    assert data.count(b"rhel_repo") == 1
+    assert data.count(b"RpmUnit") == 1
+    assert len(data) < len(json.dumps(items)) / 3
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_manifest_body(compression, monkeypatch):
+    """test that manifest is serialized chunk by chunk"""
+    monkeypatch.setattr("ubi_manifest.worker.tasks.manifest_store.CHUNK_SIZE", 2)
+    data = encode_manifest(ITEMS, compression)
+
+    chunks = list(manifest_body(data))
+    assert json.loads(b"".join(chunks)) == _stored(ITEMS)
+    # one part for each chunk of each partition and the closing bracket
+    assert len(chunks) == 5
+    assert json.loads(b"".join(manifest_body(encode_manifest([], compression)))) == []
+
+
+def test_manifest_body_legacy():
+    """test that manifests in legacy format are serialized again"""
+    items = json.loads(b"".join(manifest_body(json.dumps(ITEMS))))
+    assert items == ITEMS
+
+
+@pytest.mark.anyio
+async def test_load_manifest_body():
+    """test loading serialized manifest of current or given generation"""
+    redis, async_redis = fake_redis_clients()
+    save_manifests(redis, {"ubi_repo": ITEMS}, ttl=60)
+    save_manifests(redis, {"ubi_repo": ITEMS[:1]}, ttl=60)
+
+    body = await load_manifest_body(async_redis, "ubi_repo")
+    assert json.loads(b"".join(body)) == ITEMS[:1]
+    body = await load_manifest_body(async_redis, "ubi_repo", generation=1)
+    assert json.loads(b"".join(body)) == _stored(ITEMS)
+    assert await load_manifest_body(async_redis, "ubi_missing_repo") is None
+
+
+def test_decode_manifest_legacy():
+    """test that manifests saved as json lists are still readable"""
+    assert decode_manifest(json.dumps(ITEMS)) == ITEMS
+    assert decode_manifest(json.dumps(ITEMS).encode("utf-8")) == ITEMS
+
+
+def test_manifest_format_unsupported():
+    """test that unknown versions of format and compressions are refused"""
+    with pytest.raises(ValueError):
+        encode_manifest(ITEMS, "lzma")
+
+    data = encode_manifest(ITEMS, "none")
+    with pytest.raises(ValueError):
+        decode_manifest(b"UBIM\x09" + data[5:])
+    with pytest.raises(ValueError):
+        decode_manifest(b"UBIM\x01\x09" + data[6:])
+    with pytest.raises(ValueError):
+        manifest_body(b"UBIM\x01\x09" + data[6:])
@@ -117,8 +117,17 @@ def test_run(pulp):
     mod_dep_item2 = ModularDepsolverItem(modulelist2, repo2, in_pulp_repos2)
 
     with ModularDepsolver([mod_dep_item1, mod_dep_item2]) as depsolver:
+        assert depsolver.progress()["phase"] == "pending"
         depsolver.run()
 
+        progress = depsolver.progress()
+        assert progress["phase"] == "done"
+        assert progress["unsolved"] == 0
+        assert progress["iteration"] > 1
+        assert progress["units_fetched"] == len(depsolver.modules) + len(
+            depsolver.default_modulemds
+        )
+
         # all the modules should be searched
         assert depsolver._searched_modules["with_stream"] == set(
             f"{x[0]}:{x[1]}"
@@ -0,0 +1,83 @@
+import time
+from unittest import mock
+
+from testfixtures import LogCapture
+
+from ubi_manifest.worker.tasks.depsolver.progress import ProgressReporter, use_progress
+
+
+def test_snapshot():
+    """test that progress of the task and all tracked depsolvers is reported"""
+    reports = []
+    reporter = ProgressReporter(reports.append, interval=60)
+    reporter.track("rpm", lambda: {"unsolved": 10})
+    reporter.track("modulemd", lambda: {"unsolved": 1})
+
+    with mock.patch("ubi_manifest.worker.tasks.depsolver.progress.time") as time_mock:
+        time_mock.time.return_value = 1000.0
+        reporter.set_phase("depsolving")
+
+    assert reports == [
+        {
+            "phase": "depsolving",
+            "updated": 1000.0,
+            "depsolvers": {"modulemd": {"unsolved": 1}, "rpm": {"unsolved": 10}},
+        }
+    ]
+
+
+def test_report_failed():
+    """test that failure of reporting doesn't fail the task"""
+    reporter = ProgressReporter(
+        mock.Mock(side_effect=ConnectionError("redis unavailable")), interval=60
+    )
+
+    with LogCapture() as log:
+        reporter.report()
+
+    log.check(
+        (
+            "ubi_manifest.worker.tasks.depsolver.progress",
+            "WARNING",
+            "Failed to report progress",
+        )
+    )
+
+
+def test_use_progress():
+    """test that progress is reported periodically while the reporter is used"""
+    reports = []
+    reporter = ProgressReporter(reports.append, interval=0.01)
+
+    with use_progress(reporter) as used_reporter:
+        assert used_reporter is reporter
+        reporter.track("rpm", lambda: {"unsolved": 10})
+        reporter.set_phase("depsolving")
+        while len(reports) < 3:
+            time.sleep(0.01)
+
+    # the reporter is stopped
+    count = len(reports)
+    time.sleep(0.05)
+    assert len(reports) == count
+    assert all(report["depsolvers"] == {"rpm": {"unsolved": 10}} for report in reports)
+
+    with use_progress(None) as no_reporter:
+        assert no_reporter is None
+
+
+def test_reporters_of_concurrent_tasks():
+    """test that reporters of concurrently running tasks don't affect each other"""
+    reports_1, reports_2 = [], []
+    reporter_1 = ProgressReporter(reports_1.append, interval=60)
+    reporter_2 = ProgressReporter(reports_2.append, interval=60)
+
+    with use_progress(reporter_1), use_progress(reporter_2):
+        reporter_1.track("rpm", lambda: {"unsolved": 1})
+        reporter_2.track("rpm", lambda: {"unsolved": 2})
+
+    # leaving the block of the other task keeps the reporter tracking its depsolvers
+    reporter_1.set_phase("depsolving")
+    reporter_2.set_phase("depsolving")
+    assert [report["depsolvers"] for report in reports_1] == [{"rpm": {"unsolved": 1}}]
+    assert [report["depsolvers"] for report in reports_2] == [{"rpm": {"unsolved": 2}}]
@@ -1,17 +1,36 @@
+import time
+from concurrent.futures import Future
 from tempfile import NamedTemporaryFile
 
-from attrs import define
-from pubtools.pulplib import Client, ModulemdUnit, RpmUnit, YumRepository
+import fakeredis
+import pytest
+import requests
+from attrs import Factory, define
+from more_executors.futures import f_return_error
+from pubtools.pulplib import (
+    Client,
+    Criteria,
+    ModulemdUnit,
+    RpmDependency,
+    RpmUnit,
+    YumRepository,
+)
 
+from ubi_manifest.worker.tasks.depsolver import content_store, pulp_queries
 from ubi_manifest.worker.tasks.depsolver.models import UbiUnit
 from ubi_manifest.worker.tasks.depsolver.pulp_queries import (
+    AdaptiveBatchSize,
     _search_units,
     _search_units_per_repos,
+    search_all_modulemds,
+    search_all_rpms,
     search_modulemds,
     search_rpms,
 )
+from ubi_manifest.worker.tasks.depsolver.search_cache import SearchCache
 from ubi_manifest.worker.tasks.depsolver.utils import (
     create_or_criteria,
+    criteria_keys,
     make_pulp_client,
 )
 
@@ -223,3 +242,504 @@ def test_search_units_batch_split(pulp):
     assert isinstance(search_result, set)
     # 3 units are properly returned
     assert len(search_result) == 3
+
+
+def test_search_all_rpms(pulp):
+    """test searching for all rpms in repository without content store"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    unit_1 = RpmUnit(name="test-1", version="1.0", release="1", arch="x86_64")
+    unit_2 = RpmUnit(name="test-2", version="1.0", release="1", arch="i386")
+
+    pulp.insert_units(repo, [unit_1, unit_2])
+
+    search_result = search_all_rpms(repo).result()
+    # all units are returned
+    assert sorted(unit.name for unit in search_result) == ["test-1", "test-2"]
+
+
+def test_search_all_rpms_content_store(pulp, tmp_path, monkeypatch):
+    """test searching for all rpms in repository with content store"""
+    monkeypatch.setattr(content_store, "CONTENT_STORE_DIR", str(tmp_path))
+    monkeypatch.setattr(content_store, "repo_revision", lambda repo: "rev-1")
+
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    unit_1 = RpmUnit(name="test-1", version="1.0", release="1", arch="x86_64")
+    pulp.insert_units(repo, [unit_1])
+
+    # the first search queries pulp and stores the content
+    search_result = search_all_rpms(repo).result()
+    assert [unit.name for unit in search_result] == ["test-1"]
+
+    # new content in pulp without new revision of repo is not visible,
+    # content is read from the store
+    unit_2 = RpmUnit(name="test-2", version="1.0", release="1", arch="i386")
+    pulp.insert_units(repo, [unit_2])
+    search_result = search_all_rpms(repo).result()
+    assert [unit.name for unit in search_result] == ["test-1"]
+    assert [unit.associate_source_repo_id for unit in search_result] == ["test_repo"]
+
+    # with new revision of repo, stale content in the store is refreshed
+    monkeypatch.setattr(content_store, "repo_revision", lambda repo: "rev-2")
+    search_result = search_all_rpms(repo).result()
+    assert sorted(unit.name for unit in search_result) == ["test-1", "test-2"]
+
+
+def test_search_units_with_search_cache(pulp):
+    """test that search results are reused from the search cache per criterion"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    unit_1 = RpmUnit(name="test-1", version="1.0", release="1", arch="x86_64")
+    pulp.insert_units(repo, [unit_1])
+
+    def search(names, cache=None):
+        values = [(name,) for name in names]
+        return _search_units(
+            counting_repo,
+            create_or_criteria(["name"], values),
+            RpmUnit,
+            criteria_keys=criteria_keys(["name"], values),
+            search_cache=cache,
+        ).result()
+
+    counting_repo = CountingRepo(repo)
+    search_cache = SearchCache(fakeredis.FakeRedis(), ttl=60, max_entries=100)
+
+    search_result = search(["test-1", "test-2"], search_cache)
+    assert [unit.name for unit in search_result] == ["test-1"]
+
+    # new content in pulp is not visible for cached criteria, only the new
+    # criterion is searched even though it's in a different batch
+    unit_2 = RpmUnit(name="test-2", version="1.0", release="1", arch="x86_64")
+    unit_3 = RpmUnit(name="test-3", version="1.0", release="1", arch="x86_64")
+    pulp.insert_units(repo, [unit_2, unit_3])
+    search_result = search(["test-3", "test-2", "test-1"], search_cache)
+    assert sorted(unit.name for unit in search_result) == ["test-1", "test-3"]
+    assert search_cache.stats() == {"hits": 2, "misses": 3}
+    assert len(counting_repo.searches) == 2
+    assert "test-1" not in counting_repo.searches[1]
+
+    # everything is found in the cache now
+    search(["test-3"], search_cache)
+    assert len(counting_repo.searches) == 2
+
+    # criteria without keys are not cached
+    _search_units(
+        counting_repo,
+        create_or_criteria(["name"], [("test-1",)]),
+        RpmUnit,
+        search_cache=search_cache,
+    ).result()
+    assert len(counting_repo.searches) == 3
+
+    # without the cache, pulp is queried
+    search_result = search(["test-1", "test-2"])
+    assert sorted(unit.name for unit in search_result) == ["test-1", "test-2"]
+
+
+def test_search_units_with_search_cache_duplicates(pulp):
+    """test that unit matching more cached criteria is returned only once"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    unit = RpmUnit(
+        name="test",
+        version="1.0",
+        release="1",
+        arch="x86_64",
+        filename="test-1.0-1.x86_64.rpm",
+    )
+    pulp.insert_units(repo, [unit])
+
+    # the unit matches both criteria
+    criteria, keys = [], []
+    for field, value in (("name", unit.name), ("filename", unit.filename)):
+        criteria += create_or_criteria([field], [(value,)])
+        keys += criteria_keys([field], [(value,)])
+    search_cache = SearchCache(fakeredis.FakeRedis(), ttl=60, max_entries=100)
+
+    for _ in range(2):
+        search_result = _search_units(
+            repo, criteria, RpmUnit, criteria_keys=keys, search_cache=search_cache
+        ).result()
+        assert [unit.name for unit in search_result] == ["test"]
+
+    assert search_cache.stats() == {"hits": 2, "misses": 2}
+
+
+@pytest.fixture(name="batch_sizes")
+def fake_batch_sizes(monkeypatch):
+    batch_sizes = {}
+    monkeypatch.setattr(pulp_queries, "ADAPTIVE_BATCHING", True)
+    monkeypatch.setattr(pulp_queries, "_BATCH_SIZES", batch_sizes)
+    monkeypatch.setattr(pulp_queries, "_BATCH_REQUESTS", None)
+    yield batch_sizes
+
+
+def test_adaptive_batch_size(monkeypatch):
+    """test adjusting of batch size according to finished batches"""
+    monkeypatch.setattr(pulp_queries, "BATCH_TARGET_SECONDS", 10)
+    monkeypatch.setattr(pulp_queries, "BATCH_MAX_UNITS", 100)
+    batch_size = AdaptiveBatchSize(8)
+
+    # fast full batch grows the size
+    batch_size.observe(8, 1, 10)
+    assert batch_size.size == 10
+    # but not over the max size
+    for _ in range(10):
+        batch_size.observe(batch_size.size, 1, 10)
+    assert batch_size.size == 16
+
+    # slow batch shrinks the size
+    batch_size.observe(16, 20, 10)
+    assert batch_size.size == 12
+    # as well as a batch with too many units
+    batch_size.observe(12, 1, 200)
+    assert batch_size.size == 9
+    # batches smaller than the size say nothing about it
+    batch_size.observe(4, 20, 200)
+    batch_size.observe(4, 1, 10)
+    assert batch_size.size == 9
+    # batch created before the size was shrunk shrinks the current size
+    batch_size.observe(16, 20, 10)
+    assert batch_size.size == 6
+
+    # failed batch halves the size
+    batch_size.failed(6)
+    assert batch_size.size == 3
+    # size is never lower than 1
+    for _ in range(5):
+        batch_size.failed(batch_size.size)
+    assert batch_size.size == 1
+
+
+def _server_error():
+    response = requests.Response()
+    response.status_code = 503
+    return requests.exceptions.HTTPError("Pulp DB out of memory", response=response)
+
+
+@define
+class FailingRepo:
+    """Wrapper of repository that fails searches for more than one criterion"""
+
+    repo: YumRepository
+    error: Exception = Factory(_server_error)
+    searches: int = 0
+
+    @property
+    def id(self):
+        return self.repo.id
+
+    def search_content(self, criteria):
+        self.searches += 1
+        if " OR " in str(criteria):
+            return f_return_error(self.error)
+        return self.repo.search_content(criteria)
+
+
+def test_search_units_split_on_failure(pulp, batch_sizes):
+    """test that failed batches are split and retried"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(name=f"test-{num}", version="1.0", release="1", arch="x86_64")
+        for num in range(5)
+    ]
+    pulp.insert_units(repo, units)
+
+    criteria = create_or_criteria(["name"], [(unit.name,) for unit in units])
+    search_result = _search_units(
+        FailingRepo(repo), criteria, RpmUnit, batch_size_override=4
+    ).result()
+
+    # all units are found by retried smaller batches
+    assert sorted(unit.name for unit in search_result) == [
+        f"test-{num}" for num in range(5)
+    ]
+    # batch size is shrunk for following searches of the same type
+    assert batch_sizes[("RpmUnit", None, 4)].size < 4
+
+
+def test_search_units_batch_size_per_field(pulp, batch_sizes, monkeypatch):
+    """test that searches by different fields have separate batch sizes"""
+    monkeypatch.setattr(pulp_queries, "BATCH_TARGET_SECONDS", 10)
+    monkeypatch.setattr(pulp_queries, "BATCH_MAX_UNITS", 3)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(
+            name=f"test-{num}",
+            version="1.0",
+            release="1",
+            arch="x86_64",
+            provides=[RpmDependency(name="lib.a")],
+        )
+        for num in range(4)
+    ]
+    pulp.insert_units(repo, units)
+
+    for field, values in (
+        ("provides.name", [("lib.a",), ("lib.b",)]),
+        ("name", [("test-0",), ("test-1",)]),
+    ):
+        criteria = create_or_criteria([field], values)
+        _search_units(
+            repo,
+            criteria,
+            RpmUnit,
+            batch_size_override=2,
+            criteria_keys=criteria_keys([field], values),
+        ).result()
+
+    # searches by provides return too many units, their size is shrunk
+    assert batch_sizes[("RpmUnit", ("provides.name",), 2)].size == 1
+    # while searches by name are sized separately and grown as they're fast
+    assert batch_sizes[("RpmUnit", ("name",), 2)].size == 3
+
+
+def test_search_units_failure(pulp, batch_sizes):
+    """test that failure of a single criterion search is propagated"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    criteria = create_or_criteria(["name"], [("test",)])
+    ft = _search_units(FailingRepo(repo), [Criteria.or_(*criteria, *criteria)], RpmUnit)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        ft.result()
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        RuntimeError("unexpected"),
+        requests.exceptions.Timeout("Read timed out"),
+        requests.exceptions.HTTPError("Bad request", response=requests.Response()),
+    ],
+)
+def test_search_units_failure_not_split(pulp, batch_sizes, monkeypatch, error):
+    """test that failures not caused by overload of pulp are raised immediately"""
+    if isinstance(error, requests.exceptions.Timeout):
+        # timeouts are retried only while the batch can be split
+        monkeypatch.setattr(pulp_queries, "BATCH_MAX_SPLITS", 0)
+    elif isinstance(error, requests.exceptions.HTTPError):
+        error.response.status_code = 400
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    failing_repo = FailingRepo(repo, error=error)
+    criteria = create_or_criteria(["name"], [(f"test-{num}",) for num in range(4)])
+    ft = _search_units(failing_repo, criteria, RpmUnit, batch_size_override=4)
+
+    with pytest.raises(type(error)):
+        ft.result()
+
+    # the batch is not retried, it's shrunk only on overload of pulp
+    assert failing_repo.searches == 1
+    expected_size = 2 if isinstance(error, requests.exceptions.Timeout) else 4
+    assert batch_sizes[("RpmUnit", None, 4)].size == expected_size
+
+
+def test_search_units_split_limit(pulp, batch_sizes, monkeypatch):
+    """test that failed batch is split at most BATCH_MAX_SPLITS times"""
+    monkeypatch.setattr(pulp_queries, "BATCH_MAX_SPLITS", 1)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    failing_repo = FailingRepo(repo)
+    criteria = create_or_criteria(["name"], [(f"test-{num}",) for num in range(4)])
+    ft = _search_units(failing_repo, criteria, RpmUnit, batch_size_override=4)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        ft.result()
+
+    # the batch and its halves are searched, halves are not split further
+    assert failing_repo.searches == 3
+
+
+@define
+class PendingRepo:
+    """Wrapper of repository whose searches finish only when released"""
+
+    repo: YumRepository
+    pending: list = Factory(list)
+
+    @property
+    def id(self):
+        return self.repo.id
+
+    def search_content(self, criteria):
+        out = Future()
+        self.pending.append((criteria, out))
+        return out
+
+    def release(self):
+        criteria, out = self.pending.pop(0)
+        out.set_result(self.repo.search_content(criteria).result())
+
+
+def _wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+def test_search_units_limit_requests(pulp, batch_sizes, monkeypatch):
+    """test that only limited number of batch searches is issued at once"""
+    monkeypatch.setattr(pulp_queries, "BATCH_MAX_REQUESTS", 2)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(name=f"test-{num}", version="1.0", release="1", arch="x86_64")
+        for num in range(5)
+    ]
+    pulp.insert_units(repo, units)
+
+    pending_repo = PendingRepo(repo)
+    criteria = create_or_criteria(["name"], [(unit.name,) for unit in units])
+    ft = _search_units(pending_repo, criteria, RpmUnit, batch_size_override=1)
+
+    # following batches are issued only when previous ones finish,
+    # so their latency doesn't include waiting for free pulp client
+    _wait_for(lambda: len(pending_repo.pending) == 2)
+    for expected_pending in (2, 2, 2, 1, 0):
+        pending_repo.release()
+        _wait_for(lambda: len(pending_repo.pending) == expected_pending)
+
+    assert sorted(unit.name for unit in ft.result()) == [unit.name for unit in units]
+
+
+def test_search_all_without_adaptive_batching(pulp, batch_sizes):
+    """test that listings of all units don't adjust batch sizes"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    unit_1 = RpmUnit(name="test", version="1.0", release="1", arch="x86_64")
+    unit_2 = ModulemdUnit(
+        name="test", stream="10", version=100, context="abcdef", arch="x86_64"
+    )
+    pulp.insert_units(repo, [unit_1, unit_2])
+
+    assert [unit.name for unit in search_all_rpms(repo).result()] == ["test"]
+    assert [unit.name for unit in search_all_modulemds([repo]).result()] == ["test"]
+    assert batch_sizes == {}
+
+
+@define
+class CountingRepo:
+    """Wrapper of repository that records criteria of all searches"""
+
+    repo: YumRepository
+    searches: list = Factory(list)
+
+    @property
+    def id(self):
+        return self.repo.id
+
+    @property
+    def distributors(self):
+        return self.repo.distributors
+
+    def search_content(self, criteria):
+        self.searches.append(str(criteria))
+        return self.repo.search_content(criteria)
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_search_units_concurrent_pages(pulp, batch_sizes, monkeypatch, concurrency):
+    """test that batches with more pages of results are split into sub-batches"""
+    monkeypatch.setattr(pulp_queries, "SEARCH_CONCURRENCY", concurrency)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(name=f"test-{num}", version="1.0", release="1", arch="x86_64")
+        for num in range(10)
+    ]
+    pulp.insert_units(repo, units)
+
+    counting_repo = CountingRepo(repo)
+    criteria = create_or_criteria(["name"], [(unit.name,) for unit in units])
+    search_result = _search_units(
+        counting_repo, criteria, RpmUnit, batch_size_override=10
+    ).result()
+
+    # all units are returned exactly once
+    assert sorted(unit.name for unit in search_result) == sorted(
+        unit.name for unit in units
+    )
+    assert len(search_result) == 10
+    # results span 4 pages, without concurrency they are followed one by one,
+    # otherwise the first query is followed by 4 concurrent sub-batches
+    expected_searches = 1 if concurrency == 1 else 5
+    assert len(counting_repo.searches) == expected_searches
+
+
+def test_search_units_concurrent_pages_duplicates(pulp, batch_sizes, monkeypatch):
+    """test that units matched by more sub-batches are returned only once"""
+    monkeypatch.setattr(pulp_queries, "SEARCH_CONCURRENCY", 4)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(
+            name=f"test-{num}",
+            version="1.0",
+            release="1",
+            arch="x86_64",
+            filename=f"test-{num}-1.0-1.x86_64.rpm",
+        )
+        for num in range(10)
+    ]
+    pulp.insert_units(repo, units)
+
+    # the first unit is matched by criteria that fall into different sub-batches
+    criteria = create_or_criteria(["name"], [(unit.name,) for unit in units])
+    criteria += create_or_criteria(["filename"], [(units[0].filename,)])
+    search_result = _search_units(repo, criteria, RpmUnit, batch_size_override=11)
+
+    assert sorted(unit.name for unit in search_result.result()) == sorted(
+        unit.name for unit in units
+    )
+
+
+def test_search_units_concurrent_pages_reuse_first_page(pulp, batch_sizes, monkeypatch):
+    """test that criteria answered by the first page are not searched again"""
+    monkeypatch.setattr(pulp_queries, "SEARCH_CONCURRENCY", 4)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(
+            name=f"test-{num}",
+            version="1.0",
+            release="1",
+            arch="x86_64",
+            filename=f"test-{num}-1.0-1.x86_64.rpm",
+        )
+        for num in range(10)
+    ]
+    pulp.insert_units(repo, units)
+
+    counting_repo = CountingRepo(repo)
+    values = [(unit.filename,) for unit in units]
+    search_result = _search_units(
+        counting_repo,
+        create_or_criteria(["filename"], values),
+        RpmUnit,
+        batch_size_override=10,
+        criteria_keys=criteria_keys(["filename"], values),
+    ).result()
+
+    assert sorted(unit.filename for unit in search_result) == sorted(
+        unit.filename for unit in units
+    )
+    # the first page holds 3 of the units, sub-batches search only the other 7
+    first_search, *sub_searches = counting_repo.searches
+    searched_again = [
+        unit.filename
+        for unit in units
+        if any(unit.filename in search for search in sub_searches)
+    ]
+    assert all(filename in first_search for filename in searched_again)
+    assert len(searched_again) == 7
+    assert len(sub_searches) == 4
+
+
+def test_search_units_without_adaptive_batching(pulp, batch_sizes, monkeypatch):
+    """test that batch sizes are not adjusted if adaptive batching is disabled"""
+    monkeypatch.setattr(pulp_queries, "ADAPTIVE_BATCHING", False)
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    units = [
+        RpmUnit(name=f"test-{num}", version="1.0", release="1", arch="x86_64")
+        for num in range(3)
+    ]
+    pulp.insert_units(repo, units)
+
+    criteria = create_or_criteria(["name"], [(unit.name,) for unit in units])
+    search_result = _search_units(repo, criteria, RpmUnit, batch_size_override=2)
+
+    assert len(search_result.result()) == 3
+    assert batch_sizes == {}
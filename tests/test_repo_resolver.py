@@ -0,0 +1,123 @@
+import pytest
+from attrs import Factory, define
+from pubtools.pulplib import Client, Distributor, YumRepository
+
+from ubi_manifest.worker.tasks.depsolver import repo_resolver
+from ubi_manifest.worker.tasks.depsolver.repo_resolver import RepositoryResolver
+
+
+@define
+class CountingClient:
+    """Wrapper of pulp client that counts searches"""
+
+    client: Client
+    calls: list = Factory(list)
+
+    def search_repository(self, criteria):
+        self.calls.append("search_repository")
+        return self.client.search_repository(criteria)
+
+    def search_distributor(self, criteria):
+        self.calls.append("search_distributor")
+        return self.client.search_distributor(criteria)
+
+
+def _insert_repo_group(pulp, name):
+    for repo_id, suffix in (
+        (f"{name}-rpms", "os"),
+        (f"{name}-debug-rpms", "debug"),
+        (f"{name}-source-rpms", "source/SRPMS"),
+    ):
+        relative_url = f"content/{name}/{suffix}"
+        pulp.insert_repository(
+            YumRepository(
+                id=repo_id,
+                relative_url=relative_url,
+                distributors=[
+                    Distributor(
+                        id="yum_distributor",
+                        type_id="yum_distributor",
+                        repo_id=repo_id,
+                        relative_url=relative_url,
+                    )
+                ],
+            )
+        )
+
+
+@pytest.fixture(name="relations_cache")
+def fake_relations_cache(monkeypatch):
+    relations_cache = {}
+    monkeypatch.setattr(repo_resolver, "_RELATIONS_CACHE", relations_cache)
+    yield relations_cache
+
+
+def test_get_repositories(pulp):
+    """test that repositories are fetched in one search and cached"""
+    _insert_repo_group(pulp, "foo")
+    _insert_repo_group(pulp, "bar")
+    client = CountingClient(pulp.client)
+    resolver = RepositoryResolver(client)
+
+    repos = resolver.get_repositories(["foo-rpms", "bar-rpms", "foo-debug-rpms"])
+    assert [repo.id for repo in repos] == ["foo-rpms", "bar-rpms", "foo-debug-rpms"]
+    assert client.calls == ["search_repository"]
+
+    # cached repositories are not fetched again
+    assert resolver.get_repository("bar-rpms").id == "bar-rpms"
+    assert client.calls == ["search_repository"]
+
+    # missing repositories are reported
+    with pytest.raises(ValueError):
+        resolver.get_repository("missing-rpms")
+
+
+@pytest.mark.usefixtures("relations_cache")
+def test_get_related_repositories(pulp):
+    """test that related repositories are resolved in batches"""
+    _insert_repo_group(pulp, "foo")
+    _insert_repo_group(pulp, "bar")
+    pulp.insert_repository(YumRepository(id="lonely-rpms", relative_url="lonely/os"))
+    client = CountingClient(pulp.client)
+    resolver = RepositoryResolver(client)
+
+    repos = resolver.get_repositories(["foo-rpms", "bar-rpms", "lonely-rpms"])
+    debug_repos = resolver.get_related_repositories(repos, "debug")
+    assert {repo_id: repo and repo.id for repo_id, repo in debug_repos.items()} == {
+        "foo-rpms": "foo-debug-rpms",
+        "bar-rpms": "bar-debug-rpms",
+        "lonely-rpms": None,
+    }
+    # one search for repos, one for distributors and one for the related repos
+    assert client.calls == [
+        "search_repository",
+        "search_distributor",
+        "search_repository",
+    ]
+
+    # relations are cached, binary repo is related to itself
+    resolver.get_related_repositories(repos, "debug")
+    binary_repos = resolver.get_related_repositories(repos, "binary")
+    assert {repo_id: repo.id for repo_id, repo in binary_repos.items()} == {
+        "foo-rpms": "foo-rpms",
+        "bar-rpms": "bar-rpms",
+        "lonely-rpms": "lonely-rpms",
+    }
+    assert len(client.calls) == 3
+
+
+def test_relations_cache_across_resolvers(pulp, relations_cache, monkeypatch):
+    """test that relations are cached across resolvers if TTL is set"""
+    monkeypatch.setattr(repo_resolver, "REPO_CACHE_TTL", 60)
+    _insert_repo_group(pulp, "foo")
+
+    for _ in range(2):
+        client = CountingClient(pulp.client)
+        resolver = RepositoryResolver(client)
+        repo = resolver.get_repository("foo-rpms")
+        source_repo = resolver.get_related_repositories([repo], "source")["foo-rpms"]
+        assert source_repo.id == "foo-source-rpms"
+
+    # the second resolver didn't need to search for distributors
+    assert "search_distributor" not in client.calls
+    assert ("foo-rpms", "source") in relations_cache
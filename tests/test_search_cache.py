@@ -0,0 +1,103 @@
+import fakeredis
+import pytest
+from pubtools.pulplib import RpmUnit
+
+from ubi_manifest.worker.tasks.depsolver.models import UbiUnit
+from ubi_manifest.worker.tasks.depsolver.search_cache import SearchCache
+from ubi_manifest.worker.tasks.depsolver.utils import criteria_keys
+
+
+@pytest.fixture(name="search_cache")
+def fake_search_cache():
+    yield SearchCache(fakeredis.FakeRedis(), ttl=60, max_entries=2)
+
+
+def _make_key(search_cache, repo_id, name, field="name"):
+    (fields,) = criteria_keys([field], [(name,)])
+    return search_cache.make_key(repo_id, fields, RpmUnit, ["name"])
+
+
+def _make_units(repo_id, *names):
+    return {
+        UbiUnit(RpmUnit(name=name, version="1", release="1", arch="x86_64"), repo_id)
+        for name in names
+    }
+
+
+def test_make_key(search_cache):
+    """test that cache keys differ for different searches"""
+    assert _make_key(search_cache, "repo", "a") == _make_key(search_cache, "repo", "a")
+    # different criterion or repo give different key
+    assert _make_key(search_cache, "repo", "a") != _make_key(search_cache, "repo", "b")
+    assert _make_key(search_cache, "repo", "a") != _make_key(
+        search_cache, "repo", "a", field="filename"
+    )
+    assert _make_key(search_cache, "repo", "a") != _make_key(
+        search_cache, "other-repo", "a"
+    )
+
+
+def test_get_and_set(search_cache):
+    """test storing units in cache and getting them back"""
+    key_a, key_b = (_make_key(search_cache, "repo", name) for name in ("a", "b"))
+    # nothing is cached yet
+    assert search_cache.get_many([key_a, key_b]) == {}
+    assert search_cache.get_many([]) == {}
+
+    search_cache.set_many(
+        "repo", {key_a: _make_units("repo", "a"), key_b: _make_units("repo")}
+    )
+    search_cache.set_many("repo", {})
+    cached = search_cache.get_many([key_a, key_b])
+    assert [unit.name for unit in cached[key_a]] == ["a"]
+    assert {unit.associate_source_repo_id for unit in cached[key_a]} == {"repo"}
+    # empty results are cached as well
+    assert cached[key_b] == set()
+
+    # both hits and misses are counted
+    assert search_cache.stats() == {"hits": 2, "misses": 2}
+
+
+def test_eviction(search_cache):
+    """test that the least recently used entries are evicted"""
+    keys = [_make_key(search_cache, "repo", name) for name in ("a", "b", "c")]
+
+    search_cache.set_many("repo", {keys[0]: _make_units("repo", "a")})
+    search_cache.set_many("repo", {keys[1]: _make_units("repo", "b")})
+    # use the first entry, so the second one is the least recently used
+    assert search_cache.get_many([keys[0]])
+    search_cache.set_many("repo", {keys[2]: _make_units("repo", "c")})
+
+    assert list(search_cache.get_many(keys)) == [keys[0], keys[2]]
+
+
+def test_invalidate_repo(search_cache):
+    """test invalidation of all entries of one repo"""
+    key_1 = _make_key(search_cache, "repo-1", "a")
+    key_2 = _make_key(search_cache, "repo-2", "a")
+    search_cache.set_many("repo-1", {key_1: _make_units("repo-1", "a")})
+    search_cache.set_many("repo-2", {key_2: _make_units("repo-2", "a")})
+
+    search_cache.invalidate_repo("repo-1")
+
+    assert list(search_cache.get_many([key_1, key_2])) == [key_2]
+
+
+def test_check_revision():
+    """test that entries of repo are invalidated when its revision changes"""
+    redis = fakeredis.FakeRedis()
+    search_cache = SearchCache(redis, ttl=60, max_entries=10)
+    key = _make_key(search_cache, "repo", "a")
+
+    search_cache.check_revision("repo", "rev-1")
+    search_cache.set_many("repo", {key: _make_units("repo", "a")})
+
+    # the same revision in another task keeps the entries
+    search_cache = SearchCache(redis, ttl=60, max_entries=10)
+    search_cache.check_revision("repo", "rev-1")
+    assert search_cache.get_many([key])
+
+    # new revision invalidates them
+    search_cache = SearchCache(redis, ttl=60, max_entries=10)
+    search_cache.check_revision("repo", "rev-2")
+    assert search_cache.get_many([key]) == {}
@@ -0,0 +1,187 @@
+from concurrent.futures import CancelledError, Future
+
+import pytest
+from more_executors.futures import f_return, f_return_error
+from pubtools.pulplib import Matcher, RpmDependency, RpmUnit
+
+from ubi_manifest.worker.tasks.depsolver.pulp_queries import SearchContext, search_rpms
+from ubi_manifest.worker.tasks.depsolver.single_flight import (
+    SingleFlight,
+    unit_field_values,
+)
+from ubi_manifest.worker.tasks.depsolver.utils import (
+    create_or_criteria,
+    criteria_keys,
+)
+
+from .utils import create_and_insert_repo
+
+
+def test_unit_field_values():
+    """test getting values of simple and nested fields of unit"""
+    unit = RpmUnit(
+        name="test",
+        version="1",
+        release="1",
+        arch="x86_64",
+        provides=[RpmDependency(name="a"), RpmDependency(name="b")],
+    )
+    assert unit_field_values(unit, "name") == ["test"]
+    assert unit_field_values(unit, "provides.name") == ["a", "b"]
+    assert unit_field_values(unit, "filename") == []
+
+
+def _search(single_flight, repo_id, fields, values, search_fn):
+    crit = create_or_criteria(fields, values)
+    return single_flight.search(
+        repo_id, crit, criteria_keys(fields, values), RpmUnit, search_fn
+    )
+
+
+def test_single_flight_search():
+    """test that criteria already searched for are not searched again"""
+    single_flight = SingleFlight()
+    searched = []
+
+    units = {
+        name: RpmUnit(
+            name=name,
+            version="1",
+            release="1",
+            arch="x86_64",
+            provides=[RpmDependency(name=f"{name}-prov")],
+        )
+        for name in ("a", "b", "c")
+    }
+
+    def search_fn(criteria, criteria_keys):
+        searched.append(sorted(str(crit) for crit in criteria))
+        names = {fields[0][1] for fields in criteria_keys}
+        return f_return({units[name] for name in names})
+
+    result = _search(single_flight, "repo", ["name"], [("a",), ("b",)], search_fn)
+    assert sorted(unit.name for unit in result.result()) == ["a", "b"]
+
+    # only 'c' is searched, 'b' is picked from results of the first search
+    result = _search(single_flight, "repo", ["name"], [("b",), ("c",)], search_fn)
+    assert sorted(unit.name for unit in result.result()) == ["b", "c"]
+    assert len(searched) == 2
+    assert searched[1] == [str(create_or_criteria(["name"], [("c",)])[0])]
+
+    # nothing is searched for already answered criteria
+    result = _search(single_flight, "repo", ["name"], [("a",)], search_fn)
+    assert [unit.name for unit in result.result()] == ["a"]
+    assert len(searched) == 2
+    assert single_flight.shared == 2
+
+    # different field or repo is a different search
+    _search(single_flight, "repo", ["provides.name"], [("a",)], search_fn)
+    _search(single_flight, "other-repo", ["name"], [("a",)], search_fn)
+    assert len(searched) == 4
+
+
+def test_single_flight_search_issued_outside_lock():
+    """test that criteria are registered before the search is issued"""
+    single_flight = SingleFlight()
+    unit = RpmUnit(name="a", version="1", release="1", arch="x86_64")
+    inner = []
+
+    def search_fn(criteria, criteria_keys):
+        if not inner:
+            # the same search started while the first one is being issued
+            # is answered by the first one
+            inner.append(_search(single_flight, "repo", ["name"], [("a",)], search_fn))
+        return f_return({unit})
+
+    outer = _search(single_flight, "repo", ["name"], [("a",)], search_fn)
+
+    assert [unit.name for unit in outer.result()] == ["a"]
+    assert [unit.name for unit in inner[0].result()] == ["a"]
+    assert single_flight.shared == 1
+
+
+def test_single_flight_search_failed():
+    """test that failure of the search is propagated to searches sharing it"""
+    single_flight = SingleFlight()
+
+    def failing_search_fn(criteria, criteria_keys):
+        return f_return_error(RuntimeError("pulp unavailable"))
+
+    first = _search(single_flight, "repo", ["name"], [("a",)], failing_search_fn)
+    second = _search(single_flight, "repo", ["name"], [("a",)], failing_search_fn)
+
+    for search_ft in (first, second):
+        with pytest.raises(RuntimeError):
+            search_ft.result()
+
+    def raising_search_fn(criteria, criteria_keys):
+        raise RuntimeError("invalid criteria")
+
+    with pytest.raises(RuntimeError):
+        _search(single_flight, "repo", ["name"], [("b",)], raising_search_fn)
+
+    with pytest.raises(RuntimeError):
+        _search(single_flight, "repo", ["name"], [("b",)], failing_search_fn).result()
+
+    def cancelled_search_fn(criteria, criteria_keys):
+        search_ft = Future()
+        search_ft.cancel()
+        return search_ft
+
+    _search(single_flight, "repo", ["name"], [("c",)], cancelled_search_fn)
+    with pytest.raises(CancelledError):
+        _search(single_flight, "repo", ["name"], [("c",)], failing_search_fn).result()
+
+
+def test_single_flight_search_without_keys():
+    """test that criteria without keys are always searched"""
+    single_flight = SingleFlight()
+    searched = []
+
+    def search_fn(criteria, criteria_keys):
+        searched.append(criteria)
+        return f_return(set())
+
+    for _ in range(2):
+        _search(
+            single_flight,
+            "repo",
+            ["name", "stream"],
+            [("a", Matcher.exists())],
+            search_fn,
+        )
+
+    assert len(searched) == 2
+    assert single_flight.shared == 0
+
+
+def test_search_rpms_single_flight(pulp):
+    """test that search_rpms shares searches with the same SearchContext"""
+    repo = create_and_insert_repo(id="test_repo", pulp=pulp)
+    unit_1 = RpmUnit(name="test-1", version="1.0", release="1", arch="x86_64")
+    unit_2 = RpmUnit(name="test-2", version="1.0", release="1", arch="x86_64")
+    pulp.insert_units(repo, [unit_1, unit_2])
+
+    context = SearchContext()
+    values = [("test-1",), ("test-2",)]
+    crit = create_or_criteria(["name"], values)
+    first = search_rpms(
+        crit, [repo], criteria_keys=criteria_keys(["name"], values), context=context
+    )
+    values = [("test-2",)]
+    crit = create_or_criteria(["name"], values)
+    keys = criteria_keys(["name"], values)
+    second = search_rpms(crit, [repo], criteria_keys=keys, context=context)
+    # searches without criteria keys are not shared
+    third = search_rpms(crit, [repo], context=context)
+    # nor searches of other task
+    other_context = SearchContext()
+    fourth = search_rpms(crit, [repo], criteria_keys=keys, context=other_context)
+
+    assert sorted(unit.name for unit in first) == ["test-1", "test-2"]
+    # only the requested unit is returned from the shared search
+    assert [unit.name for unit in second] == ["test-2"]
+    assert [unit.name for unit in third] == ["test-2"]
+    assert [unit.name for unit in fourth] == ["test-2"]
+    assert context.single_flight.shared == 1
+    assert other_context.single_flight.shared == 0
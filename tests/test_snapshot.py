@@ -0,0 +1,74 @@
+from pubtools.pulplib import RpmDependency, RpmUnit
+
+from ubi_manifest.worker.tasks.depsolver.models import UbiUnit
+from ubi_manifest.worker.tasks.depsolver.snapshot import RepoSnapshot
+
+
+def _make_units():
+    unit_1 = RpmUnit(
+        name="gcc",
+        version="10",
+        release="200",
+        arch="x86_64",
+        filename="gcc-10-200.x86_64.rpm",
+        provides=[RpmDependency(name="gcc"), RpmDependency(name="lib.a")],
+    )
+    unit_2 = RpmUnit(
+        name="gcc",
+        version="11",
+        release="200",
+        arch="x86_64",
+        filename="gcc-11-200.x86_64.rpm",
+        provides=[
+            RpmDependency(name="gcc"),
+            RpmDependency(name="lib.a", version="2", flags="EQ"),
+            RpmDependency(name="lib.a", version="3", flags="EQ"),
+        ],
+    )
+    unit_3 = RpmUnit(
+        name="jq",
+        version="1",
+        release="1",
+        arch="x86_64",
+        provides=[],
+    )
+
+    return [UbiUnit(unit, "test_repo") for unit in (unit_1, unit_2, unit_3)]
+
+
+def test_search_by_name():
+    """test searching for units by name in a snapshot"""
+    snapshot = RepoSnapshot(_make_units())
+    # all units are in the snapshot
+    assert len(snapshot) == 3
+
+    result = snapshot.search("name", ["gcc", "unknown"])
+    # both gcc units are found
+    assert sorted(unit.filename for unit in result) == [
+        "gcc-10-200.x86_64.rpm",
+        "gcc-11-200.x86_64.rpm",
+    ]
+
+
+def test_search_by_filename():
+    """test searching for units by filename in a snapshot"""
+    snapshot = RepoSnapshot(_make_units())
+
+    result = snapshot.search("filename", ["gcc-11-200.x86_64.rpm"])
+    # only one unit is found
+    assert len(result) == 1
+    unit = result.pop()
+    assert unit.version == "11"
+    assert unit.associate_source_repo_id == "test_repo"
+
+
+def test_search_by_provides_name():
+    """test searching for units by names of provides in a snapshot"""
+    snapshot = RepoSnapshot(_make_units())
+
+    result = snapshot.search("provides.name", ["lib.a"])
+    # each unit is in the result only once, even if it has more
+    # provides with the same name
+    assert sorted(unit.version for unit in result) == ["10", "11"]
+    # there's nothing providing jq
+    assert snapshot.search("provides.name", ["jq"]) == set()
@@ -1,13 +1,65 @@
 import json
+import threading
 from functools import partial
 from unittest import mock
 
+import fakeredis
 import pytest
-from pubtools.pulplib import Distributor, ModulemdDefaultsUnit, ModulemdUnit, RpmUnit
+from celery.backends.cache import CacheBackend
+from celery.exceptions import Retry
+from pubtools.pulplib import (
+    Distributor,
+    ModulemdDefaultsUnit,
+    ModulemdUnit,
+    RpmUnit,
+    YumRepository,
+)
+from ubiconfig.config_types.modules import Module
 
 from ubi_manifest.worker.tasks import depsolve
+from ubi_manifest.worker.tasks.manifest_store import (
+    content_key,
+    current_key,
+    decode_manifest,
+)
+from ubi_manifest.worker.tasks.depsolver.models import (
+    DepsolverItem,
+    ModularDepsolverItem,
+    PackageToExclude,
+    UbiUnit,
+)
+
+from .utils import MockLoader, create_and_insert_repo
+
+
+def _manifest_repo_ids(redis):
+    """returns sorted ids of repositories whose manifests are saved in redis"""
+    return sorted(
+        key.decode("utf-8").split(":")[2]
+        for key in redis.keys("ubi_manifest:manifest:*:current")
+    )
+
 
-from .utils import MockedRedis, MockLoader, create_and_insert_repo
+def _locks(redis):
+    """returns holders of all locks in redis"""
+    return {
+        key.decode("utf-8"): redis.get(key).decode("utf-8")
+        for key in redis.keys("ubi_manifest:lock:*")
+    }
+
+
+def _load_manifest(redis, repo_id):
+    """returns items of the current manifest of repository saved in redis"""
+    generation = json.loads(redis.get(current_key(repo_id)))["generation"]
+    return decode_manifest(redis.get(content_key(repo_id, generation)))
+
+
+@pytest.fixture(autouse=True)
+def memory_result_backend(monkeypatch):
+    """depsolve_task replaces itself with a chord that needs a result backend"""
+    backend = CacheBackend(app=depsolve.app, backend="memory://")
+    monkeypatch.setattr(depsolve.app._local, "backend", backend, raising=False)
+    yield backend
 
 
 def test_depsolve_task(pulp):
@@ -167,37 +219,41 @@ def test_depsolve_task(pulp):
             with mock.patch(
                 "ubi_manifest.worker.tasks.depsolve.redis.from_url"
             ) as mock_redis_from_url:
-                redis = MockedRedis(data={})
+                redis = fakeredis.FakeRedis()
                 mock_redis_from_url.return_value = redis
 
-                client.return_value = pulp.client
+                # every task makes and closes its own client
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
                 # let run the depsolve task
-                result = depsolve.depsolve_task(["ubi_repo"], "fake-url")
+                result = depsolve.depsolve_task.apply(
+                    args=[["ubi_repo"], "fake-url"]
+                ).get()
                 # we don't return anything useful, everything is saved in redis
                 assert result is None
 
                 # there should 3 keys stored in redis
-                assert sorted(redis.keys()) == [
+                assert _manifest_repo_ids(redis) == [
                     "ubi_debug_repo",
                     "ubi_repo",
                     "ubi_source_repo",
                 ]
 
                 # load json string stored in redis
-                data = redis.get("ubi_repo")
-                content = json.loads(data)
+                content = sorted(
+                    _load_manifest(redis, "ubi_repo"), key=lambda d: d["unit_type"]
+                )
                 # binary repo contains only one rpm
                 assert len(content) == 3
                 unit = content[0]
                 assert unit["src_repo_id"] == "rhel_repo"
-                assert unit["unit_type"] == "ModulemdUnit"
-                assert unit["unit_attr"] == "nsvca"
-                assert unit["value"] == "fake_name:fake_stream:8:b7fad3bf:x86_64"
-                unit = content[1]
-                assert unit["src_repo_id"] == "rhel_repo"
                 assert unit["unit_type"] == "ModulemdDefaultsUnit"
                 assert unit["unit_attr"] == "name:stream"
                 assert unit["value"] == "fake_name:fake_stream"
+                unit = content[1]
+                assert unit["src_repo_id"] == "rhel_repo"
+                assert unit["unit_type"] == "ModulemdUnit"
+                assert unit["unit_attr"] == "nsvca"
+                assert unit["value"] == "fake_name:fake_stream:8:b7fad3bf:x86_64"
                 unit = content[2]
                 assert unit["src_repo_id"] == "rhel_repo"
                 assert unit["unit_type"] == "RpmUnit"
@@ -205,8 +261,9 @@ def test_depsolve_task(pulp):
                 assert unit["value"] == "gcc-10.200.x86_64.rpm"
 
                 # load json string stored in redis
-                data = redis.get("ubi_debug_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_debug_repo"), key=lambda d: d["value"]
+                )
                 # debuginfo repo conains two debug packages
                 assert len(content) == 2
                 unit = content[0]
@@ -222,8 +279,7 @@ def test_depsolve_task(pulp):
                 assert unit["value"] == "gcc_src-debugsource-10.200.x86_64.rpm"
 
                 # load json string stored in redis
-                data = redis.get("ubi_source_repo")
-                content = json.loads(data)
+                content = _load_manifest(redis, "ubi_source_repo")
                 # source repo contain two SRPM packages, no duplicates
                 assert len(content) == 2
                 unit = content[0]
@@ -320,17 +376,20 @@ def test_depsolve_task_empty_manifests(pulp):
             with mock.patch(
                 "ubi_manifest.worker.tasks.depsolve.redis.from_url"
             ) as mock_redis_from_url:
-                redis = MockedRedis(data={})
+                redis = fakeredis.FakeRedis()
                 mock_redis_from_url.return_value = redis
 
-                client.return_value = pulp.client
+                # every task makes and closes its own client
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
                 # let run the depsolve task
-                result = depsolve.depsolve_task(["ubi_repo"], "fake-url")
+                result = depsolve.depsolve_task.apply(
+                    args=[["ubi_repo"], "fake-url"]
+                ).get()
                 # we don't return anything useful, everything is saved in redis
                 assert result is None
 
                 # there should 3 keys stored in redis
-                assert sorted(redis.keys()) == [
+                assert _manifest_repo_ids(redis) == [
                     "ubi_debug_repo",
                     "ubi_repo",
                     "ubi_source_repo",
@@ -342,8 +401,7 @@ def test_depsolve_task_empty_manifests(pulp):
                     "ubi_source_repo",
                 ]:
                     # load json string stored in redis
-                    data = redis.get(repo)
-                    content = json.loads(data)
+                    content = _load_manifest(redis, repo)
                     # content should be empty
                     assert len(content) == 0
 
@@ -736,25 +794,29 @@ def test_multiple_population_sources(pulp):
             with mock.patch(
                 "ubi_manifest.worker.tasks.depsolve.redis.from_url"
             ) as mock_redis_from_url:
-                redis = MockedRedis(data={})
+                redis = fakeredis.FakeRedis()
                 mock_redis_from_url.return_value = redis
 
-                client.return_value = pulp.client
+                # every task makes and closes its own client
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
                 # let run the depsolve task
-                result = depsolve.depsolve_task(["ubi_repo"], "fake-url")
+                result = depsolve.depsolve_task.apply(
+                    args=[["ubi_repo"], "fake-url"]
+                ).get()
                 # we don't return anything useful, everything is saved in redis
                 assert result is None
 
                 # there should 3 keys stored in redis
-                assert sorted(redis.keys()) == [
+                assert _manifest_repo_ids(redis) == [
                     "ubi_debug_repo",
                     "ubi_repo",
                     "ubi_source_repo",
                 ]
 
                 # load json string stored in redis
-                data = redis.get("ubi_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_repo"), key=lambda d: d["value"]
+                )
                 # binary repo contains only 2 rpms but each unit has different src_repo_id
                 assert len(content) == 2
 
@@ -771,8 +833,9 @@ def test_multiple_population_sources(pulp):
                 assert unit["value"] == "gcc-11.200.x86_64.rpm"
 
                 # load json string stored in redis
-                data = redis.get("ubi_debug_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_debug_repo"), key=lambda d: d["value"]
+                )
 
                 # debuginfo repo contains 4 debug packages
                 # `bind`` pkgs from rhel_debug_repo-other* repos different content set and config)
@@ -804,8 +867,9 @@ def test_multiple_population_sources(pulp):
                 assert unit["value"] == "gcc_src-debugsource-11.200.x86_64.rpm"
 
                 # load json string stored in redis
-                data = redis.get("ubi_source_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_source_repo"), key=lambda d: d["value"]
+                )
                 # source repo contain 4 SRPM packages, no duplicates, correct src_repo_ids
                 assert len(content) == 4
                 unit = content[0]
@@ -833,6 +897,325 @@ def test_multiple_population_sources(pulp):
                 assert unit["value"] == "gcc_src_debug-1-0.src.rpm"
 
 
+def test_depsolve_task_chord(pulp):
+    """Test that depsolve task is replaced by chord of subtasks per depsolver item"""
+    _setup_data_multiple_population_sources(pulp)
+
+    redis = fakeredis.FakeRedis()
+
+    with mock.patch("ubi_manifest.worker.tasks.depsolver.utils.Client") as client:
+        with mock.patch("ubiconfig.get_loader", return_value=MockLoader()):
+            with mock.patch("celery.app.task.Task.replace") as mocked_replace:
+                with mock.patch(
+                    "ubi_manifest.worker.tasks.depsolve.redis.from_url",
+                    return_value=redis,
+                ):
+                    client.side_effect = lambda *args, **kwargs: pulp.new_client()
+                    task_id = depsolve.depsolve_task.apply(
+                        args=[["ubi_repo"], "fake-url"]
+                    ).task_id
+
+    mocked_replace.assert_called_once()
+    canvas = mocked_replace.call_args.args[0]
+    # one subtask for each input content set of the output repo
+    assert sorted(task.args[1:3] for task in canvas.tasks) == [
+        ("ubi_repo", "cs_rpm_in"),
+        ("ubi_repo", "cs_rpm_in_other"),
+    ]
+    # subtasks get the plan scoped to their item, so they don't plan again
+    for task in canvas.tasks:
+        plan = json.loads(json.dumps(task.args[0]))
+        whitelisted = [
+            tuple(item[:2]) for item in plan["dep_map"] if item[2]["whitelist"]
+        ]
+        assert whitelisted == [tuple(task.args[1:3])]
+        # item memoization is disabled, inputs are not fingerprinted
+        assert task.args[3] is None
+    assert {task.task for task in canvas.tasks} == {
+        "ubi_manifest.worker.tasks.depsolve.depsolve_item_task"
+    }
+    # ids of subtasks are stored in meta of the task
+    meta = depsolve.app.backend.get_task_meta(task_id)
+    assert meta["status"] == "STARTED"
+    assert meta["result"] == {"subtasks": [task.id for task in canvas.tasks]}
+    # followed by merge of their results
+    assert canvas.body.task == "ubi_manifest.worker.tasks.depsolve.merge_and_save_task"
+    output_repo_ids = ["ubi_debug_repo", "ubi_repo", "ubi_source_repo"]
+    assert canvas.body.args == (output_repo_ids, task_id)
+    # output repositories are locked until the merge is done
+    assert _locks(redis) == {
+        f"ubi_manifest:lock:repo:{repo_id}": task_id for repo_id in output_repo_ids
+    }
+
+
+def test_depsolve_task_locked_repos(pulp):
+    """Test that depsolve task is retried if its output repos are being written"""
+    _setup_data_multiple_population_sources(pulp)
+    # one of output repositories is locked by a task that is still running
+    redis = fakeredis.FakeRedis()
+    redis.set("ubi_manifest:lock:repo:ubi_source_repo", "other-id")
+
+    with mock.patch("ubi_manifest.worker.tasks.depsolver.utils.Client") as client:
+        with mock.patch("ubiconfig.get_loader", return_value=MockLoader()):
+            with mock.patch("celery.app.task.Task.replace") as mocked_replace:
+                with mock.patch(
+                    "celery.app.task.Task.retry", side_effect=Retry()
+                ) as mocked_retry, mock.patch(
+                    "ubi_manifest.worker.tasks.depsolve._make_plan"
+                ) as make_plan:
+                    with mock.patch(
+                        "ubi_manifest.worker.tasks.depsolve.redis.from_url",
+                        return_value=redis,
+                    ):
+                        client.side_effect = lambda *args, **kwargs: pulp.new_client()
+                        depsolve.depsolve_task.apply(args=[["ubi_repo"], "fake-url"])
+
+    # the task is retried later, at most configured number of times,
+    # without planning the depsolving
+    mocked_retry.assert_called_once_with(countdown=60, max_retries=240)
+    make_plan.assert_not_called()
+    mocked_replace.assert_not_called()
+    # locks acquired before the conflict was found are released
+    assert _locks(redis) == {"ubi_manifest:lock:repo:ubi_source_repo": "other-id"}
+
+
+def test_merge_and_save_task_releases_locks():
+    """Test that merge_and_save_task releases locks held by its depsolve task"""
+    redis = fakeredis.FakeRedis()
+    redis.set("ubi_manifest:lock:repo:ubi_repo", "task-id")
+    redis.set("ubi_manifest:lock:repo:ubi_debug_repo", "other-id")
+
+    with mock.patch(
+        "ubi_manifest.worker.tasks.depsolve.redis.from_url", return_value=redis
+    ):
+        depsolve.merge_and_save_task([{}], ["ubi_repo", "ubi_debug_repo"], "task-id")
+
+    # manifests are saved, only the lock held by the task is released
+    assert _manifest_repo_ids(redis) == ["ubi_debug_repo", "ubi_repo"]
+    assert redis.get("ubi_manifest:lock:repo:ubi_repo") is None
+    assert redis.get("ubi_manifest:lock:repo:ubi_debug_repo") == b"other-id"
+
+
+def test_depsolve_task_with_search_cache(pulp, monkeypatch):
+    """Test that depsolve subtasks use search cache if it's enabled"""
+    _setup_data_multiple_population_sources(pulp)
+    monkeypatch.setitem(depsolve.app.conf, "search_cache_ttl", 60)
+    redis = fakeredis.FakeRedis()
+
+    with mock.patch("ubi_manifest.worker.tasks.depsolver.utils.Client") as client:
+        with mock.patch("ubiconfig.get_loader", return_value=MockLoader()):
+            with mock.patch(
+                "ubi_manifest.worker.tasks.depsolve.redis.from_url",
+                return_value=redis,
+            ):
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
+                depsolve.depsolve_task.apply(args=[["ubi_repo"], "fake-url"]).get()
+
+    # searches were cached
+    assert int(redis.hget("ubi_manifest:search:stats", "misses")) > 0
+    # manifests are saved as usual
+    content = _load_manifest(redis, "ubi_repo")
+    assert sorted(item["value"] for item in content) == [
+        "bind-11.200.x86_64.rpm",
+        "gcc-11.200.x86_64.rpm",
+    ]
+
+
+def test_depsolve_task_memoizes_items(pulp, monkeypatch):
+    """Test that manifest items of subtasks are reused if their inputs didn't change"""
+    _setup_data_multiple_population_sources(pulp)
+    monkeypatch.setitem(depsolve.app.conf, "depsolve_memo_ttl", 60)
+    revisions = {}
+    monkeypatch.setattr(
+        depsolve, "repo_revision", lambda repo: revisions.get(repo.id, "rev-1")
+    )
+    redis = fakeredis.FakeRedis()
+
+    def run():
+        with mock.patch(
+            "ubi_manifest.worker.tasks.depsolver.utils.Client"
+        ) as client, mock.patch(
+            "ubiconfig.get_loader", return_value=MockLoader()
+        ), mock.patch(
+            "ubi_manifest.worker.tasks.depsolve.redis.from_url", return_value=redis
+        ), mock.patch(
+            "ubi_manifest.worker.tasks.depsolve._run_plan", wraps=depsolve._run_plan
+        ) as run_plan:
+            client.side_effect = lambda *args, **kwargs: pulp.new_client()
+            depsolve.depsolve_task.apply(args=[["ubi_repo"], "fake-url"]).get()
+
+        content = _load_manifest(redis, "ubi_repo")
+        assert sorted(item["value"] for item in content) == [
+            "bind-11.200.x86_64.rpm",
+            "gcc-11.200.x86_64.rpm",
+        ]
+        return run_plan.call_count
+
+    # both items are depsolved on the first run
+    assert run() == 2
+    # nothing changed, results of both items are reused
+    assert run() == 0
+    # publish of any input repository triggers full depsolving of items
+    revisions["rhel_repo-other-1"] = "rev-2"
+    assert run() == 2
+    assert run() == 0
+    # results are not reused if revision of any input repository is unknown
+    revisions["rhel_repo-other-1"] = None
+    assert run() == 2
+    assert run() == 2
+
+
+@pytest.mark.parametrize("interval, reports", [(10, 2), (0, 0)])
+def test_depsolve_item_task_progress(pulp, monkeypatch, interval, reports):
+    """Test that depsolve subtasks report their progress unless it's disabled"""
+    _setup_data_multiple_population_sources(pulp)
+    monkeypatch.setitem(depsolve.app.conf, "depsolve_progress_interval", interval)
+    redis = fakeredis.FakeRedis()
+    update_state = mock.Mock()
+
+    with mock.patch("ubi_manifest.worker.tasks.depsolver.utils.Client") as client:
+        with mock.patch("ubiconfig.get_loader", return_value=MockLoader()):
+            with mock.patch(
+                "ubi_manifest.worker.tasks.depsolve.redis.from_url",
+                return_value=redis,
+            ), mock.patch.object(
+                depsolve.depsolve_item_task, "update_state", update_state
+            ):
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
+                depsolve.depsolve_task.apply(args=[["ubi_repo"], "fake-url"]).get()
+
+    # progress is reported when depsolving of each item starts
+    assert update_state.call_count == reports
+    for call in update_state.call_args_list:
+        assert call.kwargs["task_id"] is not None
+        assert call.kwargs["state"] == "STARTED"
+        assert call.kwargs["meta"]["progress"]["phase"] == "depsolving"
+
+
+def test_progress_reported_from_reporter_thread(monkeypatch, memory_result_backend):
+    """Test that progress reported by the reporter thread is stored for the task"""
+    monkeypatch.setitem(depsolve.app.conf, "depsolve_progress_interval", 10)
+    task = depsolve.depsolve_item_task
+    # backend of the app is thread-local too, make the task use the fixture's one
+    monkeypatch.setattr(task, "backend", memory_result_backend)
+    task.push_request(id="task-1")
+    try:
+        reporter = depsolve._make_progress_reporter(task)
+    finally:
+        task.pop_request()
+
+    # request of the task isn't visible from other threads
+    thread = threading.Thread(target=reporter.report)
+    thread.start()
+    thread.join()
+
+    meta = memory_result_backend.get_task_meta("task-1")
+    assert meta["status"] == "STARTED"
+    assert meta["result"]["progress"]["phase"] == "planning"
+
+
+def test_depsolve_plan_scoped():
+    """Test that scoped plan keeps all items, but only one of them whitelisted"""
+    repo = YumRepository(id="ubi_repo")
+    plan = depsolve.DepsolvePlan(
+        dep_map={
+            ("ubi_repo", "cs_1"): DepsolverItem({"gcc"}, [], [repo]),
+            ("ubi_repo", "cs_2"): DepsolverItem({"jq"}, [], [repo]),
+        },
+        debug_dep_map={
+            ("ubi_debug_repo", "cs_1"): DepsolverItem({"gcc-debuginfo"}, [], [repo]),
+            ("ubi_debug_repo", "cs_2"): DepsolverItem({"jq-debuginfo"}, [], [repo]),
+        },
+        mod_dep_map={
+            ("ubi_repo", "cs_1"): ModularDepsolverItem(["module_1"], repo, [repo]),
+            ("ubi_repo", "cs_2"): ModularDepsolverItem(["module_2"], repo, [repo]),
+        },
+        repos_map={},
+        debug_repo_ids={"ubi_repo": "ubi_debug_repo"},
+        debug_item_keys={},
+        ubi_repos=[repo],
+        in_source_rpm_repos=[],
+        flags={},
+    )
+
+    scoped = plan.scoped(("ubi_repo", "cs_2"))
+
+    assert {key: item.whitelist for key, item in scoped.dep_map.items()} == {
+        ("ubi_repo", "cs_1"): set(),
+        ("ubi_repo", "cs_2"): {"jq"},
+    }
+    assert {key: item.whitelist for key, item in scoped.debug_dep_map.items()} == {
+        ("ubi_debug_repo", "cs_1"): set(),
+        ("ubi_debug_repo", "cs_2"): {"jq-debuginfo"},
+    }
+    assert {key: item.modulelist for key, item in scoped.mod_dep_map.items()} == {
+        ("ubi_repo", "cs_1"): [],
+        ("ubi_repo", "cs_2"): ["module_2"],
+    }
+    # original plan is not affected
+    assert plan.dep_map[("ubi_repo", "cs_1")].whitelist == {"gcc"}
+    assert plan.mod_dep_map[("ubi_repo", "cs_1")].modulelist == ["module_1"]
+
+
+def test_depsolve_plan_to_dict():
+    """Test that plan is recreated from its json serializable dict"""
+    repos = {
+        repo_id: YumRepository(id=repo_id)
+        for repo_id in ("ubi_repo", "rhel_repo", "rhel_debug_repo", "rhel_srpm_repo")
+    }
+    resolver = mock.Mock()
+    resolver.get_repositories.side_effect = lambda ids: [repos[_id] for _id in ids]
+    resolver.get_repository.side_effect = repos.get
+    plan = depsolve.DepsolvePlan(
+        dep_map={
+            ("ubi_repo", "cs"): DepsolverItem(
+                {"gcc", "jq"},
+                [PackageToExclude("kernel", globbing=True, arch="x86_64")],
+                [repos["rhel_repo"]],
+            ),
+        },
+        debug_dep_map={
+            ("ubi_debug_repo", "cs"): DepsolverItem(
+                {"gcc-debuginfo"}, [], [repos["rhel_debug_repo"]]
+            ),
+        },
+        mod_dep_map={
+            ("ubi_repo", "cs"): ModularDepsolverItem(
+                [Module("perl", "5.30", ["common"]), Module("nodejs", "")],
+                repos["ubi_repo"],
+                [repos["rhel_repo"]],
+            ),
+        },
+        repos_map={"rhel_repo": "ubi_repo"},
+        debug_repo_ids={"ubi_repo": "ubi_debug_repo"},
+        debug_item_keys={"ubi_repo": [("ubi_debug_repo", "cs")]},
+        ubi_repos=[repos["ubi_repo"]],
+        in_source_rpm_repos=[repos["rhel_srpm_repo"]],
+        flags={"base_pkgs_only": True},
+    )
+
+    data = json.loads(json.dumps(plan.to_dict()))
+    loaded = depsolve.DepsolvePlan.from_dict(data, resolver)
+
+    # all repositories are fetched at once
+    assert set(resolver.get_repositories.call_args_list[0].args[0]) == set(repos)
+    assert loaded.dep_map == plan.dep_map
+    assert loaded.debug_dep_map == plan.debug_dep_map
+    mod_item = loaded.mod_dep_map[("ubi_repo", "cs")]
+    assert [(m.name, m.stream, m.profiles) for m in mod_item.modulelist] == [
+        ("perl", "5.30", ["common"]),
+        ("nodejs", "", None),
+    ]
+    assert mod_item.repo is repos["ubi_repo"]
+    assert mod_item.in_pulp_repos == [repos["rhel_repo"]]
+    assert loaded.repos_map == plan.repos_map
+    assert loaded.debug_repo_ids == plan.debug_repo_ids
+    assert loaded.debug_item_keys == plan.debug_item_keys
+    assert loaded.ubi_repos == plan.ubi_repos
+    assert loaded.in_source_rpm_repos == plan.in_source_rpm_repos
+    assert loaded.flags == plan.flags
+
+
 def test_missing_content_config(pulp):
     """Exception is raised where there is no matching ubi content config"""
     _setup_repos_missing_config(pulp)
@@ -842,13 +1225,19 @@ def test_missing_content_config(pulp):
             with mock.patch(
                 "ubi_manifest.worker.tasks.depsolve.redis.from_url"
             ) as mock_redis_from_url:
-                redis = MockedRedis(data={})
+                redis = fakeredis.FakeRedis()
                 mock_redis_from_url.return_value = redis
 
-                client.return_value = pulp.client
+                # every task makes and closes its own client
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
                 # let run the depsolve task
                 with pytest.raises(depsolve.ContentConfigMissing):
-                    _ = depsolve.depsolve_task(["ubi_repo"], "fake-url")
+                    _ = depsolve.depsolve_task.apply(
+                        args=[["ubi_repo"], "fake-url"]
+                    ).get()
+
+    # locks taken before planning are released
+    assert _locks(redis) == {}
 
 
 def _setup_repos_missing_config(pulp):
@@ -935,25 +1324,29 @@ def test_multiple_population_sources_skip_depsolving(pulp):
             with mock.patch(
                 "ubi_manifest.worker.tasks.depsolve.redis.from_url"
             ) as mock_redis_from_url:
-                redis = MockedRedis(data={})
+                redis = fakeredis.FakeRedis()
                 mock_redis_from_url.return_value = redis
 
-                client.return_value = pulp.client
+                # every task makes and closes its own client
+                client.side_effect = lambda *args, **kwargs: pulp.new_client()
                 # let run the depsolve task
-                result = depsolve.depsolve_task(["ubi_repo"], "fake-url")
+                result = depsolve.depsolve_task.apply(
+                    args=[["ubi_repo"], "fake-url"]
+                ).get()
                 # we don't return anything useful, everything is saved in redis
                 assert result is None
 
                 # there should 3 keys stored in redis
-                assert sorted(redis.keys()) == [
+                assert _manifest_repo_ids(redis) == [
                     "ubi_debug_repo",
                     "ubi_repo",
                     "ubi_source_repo",
                 ]
 
                 # load json string stored in redis
-                data = redis.get("ubi_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_repo"), key=lambda d: d["value"]
+                )
                 # binary repo contains only 2 rpms but each unit has different src_repo_id
                 assert len(content) == 2
 
@@ -970,8 +1363,9 @@ def test_multiple_population_sources_skip_depsolving(pulp):
                 assert unit["value"] == "gcc-11.200.x86_64.rpm"
 
                 # load json string stored in redis
-                data = redis.get("ubi_debug_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_debug_repo"), key=lambda d: d["value"]
+                )
 
                 # debuginfo repo is empty because by using flag "base_pkgs_only": True we don't allow
                 # adding additional debug pkgs by guessing their names, but only we allow pkgs defined
@@ -979,8 +1373,9 @@ def test_multiple_population_sources_skip_depsolving(pulp):
                 assert len(content) == 0
 
                 # load json string stored in redis
-                data = redis.get("ubi_source_repo")
-                content = sorted(json.loads(data), key=lambda d: d["value"])
+                content = sorted(
+                    _load_manifest(redis, "ubi_source_repo"), key=lambda d: d["value"]
+                )
                 # source repo contain 1 SRPM package, correct src_repo_ids
                 # SRPM for gcc packge is not available
                 assert len(content) == 1
@@ -1010,3 +1405,103 @@ def test_validate_depsolver_flags(flags, consistent):
     else:
         with pytest.raises(depsolve.InconsistentDepsolverConfig):
             _test_call()
+
+
+def test_merge_output_dictionary():
+    """test merging of outputs with units of all types"""
+    rpm = UbiUnit(
+        RpmUnit(
+            name="foo", version="1", release="1", arch="x86_64", filename="foo.rpm"
+        ),
+        "in_repo",
+    )
+    modulemd = UbiUnit(
+        ModulemdUnit(name="mod", stream="1", version=1, context="c", arch="x86_64"),
+        "in_repo",
+    )
+    defaults = UbiUnit(
+        ModulemdDefaultsUnit(name="mod", stream="1", repo_id="in_repo"), "in_repo"
+    )
+    out = {"repo_1": [rpm, modulemd]}
+    update = {
+        # copies of units already present in the output are skipped
+        "repo_1": [
+            UbiUnit(rpm._unit, "other_repo"),
+            UbiUnit(modulemd._unit, "other_repo"),
+            defaults,
+        ],
+        "repo_2": [rpm],
+    }
+
+    depsolve._merge_output_dictionary(out, update)
+
+    assert out == {"repo_1": [rpm, modulemd, defaults], "repo_2": [rpm]}
+
+
+def test_merge_manifest_items():
+    """test merging of manifest items returned by depsolve subtasks"""
+
+    def item(value, src_repo_id="in_repo"):
+        return {
+            "src_repo_id": src_repo_id,
+            "unit_type": "RpmUnit",
+            "unit_attr": "filename",
+            "value": value,
+        }
+
+    out = {"repo_1": [item("foo.rpm")]}
+    update = {
+        # items of units already present in the output are skipped
+        "repo_1": [item("foo.rpm", "other_repo"), item("bar.rpm")],
+        "repo_2": [item("foo.rpm"), item("foo.rpm", "other_repo")],
+    }
+
+    depsolve._merge_manifest_items(out, update)
+
+    assert out == {
+        "repo_1": [item("foo.rpm"), item("bar.rpm")],
+        "repo_2": [item("foo.rpm")],
+    }
+
+
+def test_feed_debug_whitelist():
+    """test that debuginfo packages of binary rpms are fed to related debug items"""
+    debug_depsolver = mock.Mock()
+    debug_item = DepsolverItem(set(), [], [])
+    units = [
+        UbiUnit(
+            RpmUnit(
+                name="gcc",
+                version="1",
+                release="1",
+                arch="x86_64",
+                sourcerpm="gcc_src-1-1.src.rpm",
+            ),
+            "rhel_repo",
+        ),
+        # rpms without source rpm are skipped
+        UbiUnit(
+            RpmUnit(name="foo", version="1", release="1", arch="x86_64"),
+            "rhel_other_repo",
+        ),
+    ]
+
+    depsolve._feed_debug_whitelist(
+        debug_depsolver,
+        {"ubi_repo": [debug_item], "ubi_other_repo": [debug_item]},
+        {"rhel_repo": "ubi_repo", "rhel_other_repo": "ubi_other_repo"},
+        units,
+    )
+
+    debug_depsolver.extend_whitelist.assert_called_once_with(
+        debug_item, {"gcc-debuginfo", "gcc_src-debugsource"}
+    )
+
+
+def test_manifest_items_invalid_unit():
+    """test that manifest items are validated when they're created"""
+    unit = UbiUnit(RpmUnit(name="gcc", version="1", release="1", arch="x86_64"), "in")
+
+    # unit without filename can't be identified in manifest
+    with pytest.raises(ValueError):
+        depsolve._manifest_items([unit])
@@ -1,9 +1,12 @@
+import json
+from datetime import datetime, timezone
 from unittest import mock
 
 import pytest
 from pubtools.pulplib import (
     Criteria,
     Matcher,
+    ModulemdDefaultsUnit,
     ModulemdDependency,
     ModulemdUnit,
     RpmDependency,
@@ -15,14 +18,20 @@ from ubi_manifest.worker.tasks.depsolver.ubi_config import UbiConfigLoader
 from ubi_manifest.worker.tasks.depsolver.utils import (
     _keep_n_latest_rpms,
     create_or_criteria,
+    criteria_keys,
     flatten_list_of_sets,
     get_criteria_for_modules,
+    get_criteria_keys_for_modules,
     get_modulemd_output_set,
     get_n_latest_from_content,
     is_requirement_resolved,
     parse_blacklist_config,
     parse_bool_deps,
     split_filename,
+    unit_from_dict,
+    unit_identity,
+    unit_key,
+    unit_to_dict,
     vercmp_sort,
 )
 
@@ -425,6 +434,19 @@ def test_create_or_criteria():
     # let's not test internal structure of criteria, that's responsibility of pulplib
 
 
+def test_criteria_keys():
+    """Test keys of criteria are sorted field and value pairs"""
+    fields = ["stream", "name"]
+    values = [("1", "perl"), ("2", "perl"), (Matcher.exists(), "perl")]
+
+    assert criteria_keys(fields, values) == [
+        (("name", "perl"), ("stream", "1")),
+        (("name", "perl"), ("stream", "2")),
+        # criteria with matchers have no key
+        None,
+    ]
+
+
 def test_create_or_criteria_uneven_args():
     """Test wrong number of values in args"""
 
@@ -572,6 +594,13 @@ def test_get_criteria_for_modules():
     )
     criteria = get_criteria_for_modules([unit1, unit2, unit3])
 
+    # keys of criteria match the criteria, the one with matcher has no key
+    assert get_criteria_keys_for_modules([unit1, unit2, unit3]) == [
+        (("name", "perl"), ("stream", "5.30")),
+        (("name", "perl"), ("stream", "6.30")),
+        None,
+    ]
+
 
 @pytest.mark.parametrize(
     "requirement, provider, expected_result",
@@ -694,3 +723,92 @@ def test_get_criteria_for_modules():
 def test_is_requirement_resolved(requirement, provider, expected_result):
     resolved = is_requirement_resolved(requirement, provider)
     assert resolved is expected_result
+
+
+@pytest.mark.parametrize(
+    "unit",
+    [
+        RpmUnit(
+            name="test",
+            version="1.0",
+            release="1",
+            arch="x86_64",
+            filename="test-1.0-1.x86_64.rpm",
+            requires=[RpmDependency(name="lib.a", version="1", flags="GE")],
+            provides=[RpmDependency(name="test")],
+        ),
+        RpmUnit(
+            name="test",
+            version="1.0",
+            release="1",
+            arch="x86_64",
+            cdn_path="/content/origin/rpms/test-1.0-1.x86_64.rpm",
+            cdn_published=datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+            files=["/usr/bin/test"],
+            repository_memberships=["test_repo"],
+            unit_id="test-unit-id",
+        ),
+        ModulemdUnit(
+            name="test",
+            stream="10",
+            version=100,
+            context="abcdef",
+            arch="x86_64",
+            artifacts=["test-0:1.0-1.module+el8.x86_64"],
+            profiles={"common": ["test"]},
+            dependencies=[ModulemdDependency(name="platform", stream="el8")],
+        ),
+        ModulemdDefaultsUnit(
+            name="test", stream="10", repo_id="test_repo", profiles={"10": ["common"]}
+        ),
+    ],
+)
+def test_unit_to_dict_and_back(unit):
+    """test that units can be serialized to a dict and loaded back"""
+    data = unit_to_dict(UbiUnit(unit, "test_repo"))
+    # unset fields are omitted
+    assert None not in data["fields"].values()
+
+    # the dict is JSON serializable
+    loaded = unit_from_dict(json.loads(json.dumps(data)))
+    assert isinstance(loaded, UbiUnit)
+    assert loaded.associate_source_repo_id == "test_repo"
+    # inner unit is equal to the original one
+    assert loaded._unit == unit
+
+
+def test_unit_identity_unsupported():
+    """test that units of unsupported types can't be identified"""
+    with pytest.raises(ValueError):
+        unit_identity(UbiUnit(object(), "in_repo"))
+
+
+def test_unit_key():
+    """test that units are deduplicated by their identity or NEVRA"""
+    rpm = get_ubi_unit(
+        RpmUnit,
+        "test_repo",
+        name="test",
+        version="1.0",
+        release="1",
+        arch="x86_64",
+        filename="test-1.0-1.x86_64.rpm",
+    )
+    assert unit_key(rpm) == ("RpmUnit", "filename", "test-1.0-1.x86_64.rpm")
+
+    # rpms without filename fall back to NEVRA
+    rpm = get_ubi_unit(
+        RpmUnit, "test_repo", name="test", version="1.0", release="1", arch="x86_64"
+    )
+    assert unit_key(rpm) == ("RpmUnit", "nevra", ("test", "0", "1.0", "1", "x86_64"))
+
+    modulemd = get_ubi_unit(
+        ModulemdUnit,
+        "test_repo",
+        name="test",
+        stream="10",
+        version=100,
+        context="abcdef",
+        arch="x86_64",
+    )
+    assert unit_key(modulemd) == ("ModulemdUnit", "nsvca", modulemd.nsvca)
@@ -1,5 +1,4 @@
-from typing import List
-
+import fakeredis
 import ubiconfig
 from attrs import define
 from pubtools.pulplib import RpmDependency, YumRepository
@@ -74,17 +73,15 @@ class MockLoader:
 
 
 @define
-class MockedRedis:
-    data: dict
-
-    def set(self, key: str, value: str, **kwargs) -> None:
-        self.data[key] = value
+class MockAsyncResult:
+    task_id: str
+    state: str
 
-    def get(self, key: str) -> str:
-        return self.data.get(key)
 
-    def keys(self) -> List[str]:
-        return list(self.data.keys())
+def fake_redis_clients():
+    """returns sync and asyncio fake redis clients sharing the same data"""
+    server = fakeredis.FakeServer()
+    return fakeredis.FakeRedis(server=server), fakeredis.FakeAsyncRedis(server=server)
 
 
 def rpmdeps_from_names(*names):
@@ -1,16 +1,59 @@
 import json
-from typing import List
+import uuid
+from email.utils import formatdate
+from typing import List, Optional
 
-import redis
-from fastapi import APIRouter, HTTPException
+from celery import states
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
 from ubi_manifest.worker.tasks.celery import app
 from ubi_manifest.worker.tasks.depsolve import depsolve_task
+from ubi_manifest.worker.tasks.locks import acquire_lock, group_lock_key, release_lock
+from ubi_manifest.worker.tasks.manifest_store import (
+    GenerationExpired,
+    InvalidCursor,
+    get_meta,
+    get_page,
+    load_diff,
+    load_manifest_body,
+    load_manifest_bodies,
+)
 
-from .models import DepsolveItem, DepsolverResult, DepsolverResultItem, TaskState
+from .models import (
+    DepsolveItem,
+    DepsolverResult,
+    DepsolverResultBatchItem,
+    DepsolverResultDiff,
+    DepsolverResultItem,
+    ManifestBatch,
+    TaskState,
+)
 
 router = APIRouter(prefix="/api/v1")
 
+# default and maximal number of items in one page of manifest
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# maximal number of tasks whose states are requested at once
+MAX_TASK_IDS = 1000
+# maximal number of repositories whose manifests are requested at once
+MAX_REPO_IDS = 100
+
+
+def get_redis(request: Request):
+    """
+    Returns asyncio redis client shared by all requests, created at startup of the app.
+    """
+    return request.app.state.redis
+
+
+def get_sync_redis(request: Request):
+    """
+    Returns sync redis client shared by all requests, created at startup of the app.
+    """
+    return request.app.state.sync_redis
+
 
 @router.get("/status")
 def status():
@@ -20,6 +63,7 @@ def status():
 @router.post(
     "/manifest",
     response_model=List[TaskState],
+    response_model_exclude_none=True,
     status_code=201,
     responses={
         201: {
@@ -47,7 +91,9 @@ def status():
         },
     },
 )
-def manifest_post(depsolve_item: DepsolveItem) -> List[TaskState]:
+def manifest_post(
+    depsolve_item: DepsolveItem, redis_client=Depends(get_sync_redis)
+) -> List[TaskState]:
     repo_groups = {}
     # compare provided repo_ids with the config and pick allowed repo groups
     for repo_id in depsolve_item.repo_ids:
@@ -63,13 +109,34 @@ def manifest_post(depsolve_item: DepsolveItem) -> List[TaskState]:
 
     tasks_states = []
     for repo_group_key, repo_group in repo_groups.items():
+        # return the task already queued or running for the group instead
+        # of enqueuing a duplicate one
+        task_id = str(uuid.uuid4())
+        lock_key = group_lock_key(repo_group_key)
+        holder = acquire_lock(
+            redis_client,
+            lock_key,
+            task_id,
+            int(app.conf["depsolve_lock_expiration"]),
+        )
+        if holder is not None:
+            task = app.AsyncResult(holder)
+            tasks_states.append(TaskState(task_id=task.task_id, state=task.state))
+            continue
+
         content_config_url = None
         for group_prefix, url in app.conf.content_config.items():
             if repo_group_key.startswith(group_prefix):
                 content_config_url = url
                 break
 
-        task = depsolve_task.apply_async(args=[repo_group, content_config_url])
+        try:
+            task = depsolve_task.apply_async(
+                args=[repo_group, content_config_url], task_id=task_id
+            )
+        except Exception:
+            release_lock(redis_client, lock_key, task_id)
+            raise
         tasks_states.append(TaskState(task_id=task.task_id, state=task.state))
 
     return tasks_states
@@ -94,10 +161,21 @@ def manifest_post(depsolve_item: DepsolveItem) -> List[TaskState]:
                                 "value": "some-filename.rpm",
                             }
                         ],
+                        "next_cursor": None,
                     }
                 }
             },
         },
+        304: {
+            "description": "Content for repo_id didn't change since the version "
+            "identified by If-None-Match header."
+        },
+        400: {
+            "description": "Invalid cursor",
+            "content": {
+                "application/json": {"example": {"detail": "Invalid cursor: foo"}}
+            },
+        },
         404: {
             "description": "Content for request repository is not available.",
             "content": {
@@ -108,49 +186,374 @@ def manifest_post(depsolve_item: DepsolveItem) -> List[TaskState]:
         },
     },
 )
-def manifest_get(repo_id: str) -> DepsolverResult:
-    redis_client = redis.from_url(app.conf.result_backend)
-    value = redis_client.get(repo_id) or ""
-    if value:
-        content = []
-        for value in json.loads(value):
-            item = DepsolverResultItem(**value)
-            content.append(item)
-        result = DepsolverResult(repo_id=repo_id, content=content)
-        return result
+async def manifest_get(
+    repo_id: str,
+    unit_type: Optional[str] = None,
+    src_repo_id: Optional[str] = None,
+    value_prefix: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+    if_none_match: Optional[str] = Header(default=None),
+    redis_client=Depends(get_redis),
+):
+    """
+    Returns the whole manifest of repository along with its ETag and Last-Modified
+    headers, 304 is returned if the ETag matches If-None-Match header. If any
+    of filters, cursor or limit is set, only one page of the manifest is returned
+    along with the cursor of the next page, the cursor is null when there are
+    no more items.
+    """
+    if any(
+        param is not None
+        for param in (unit_type, src_repo_id, value_prefix, cursor, limit)
+    ):
+        try:
+            page = await get_page(
+                redis_client,
+                repo_id,
+                unit_type=unit_type,
+                src_repo_id=src_repo_id,
+                value_prefix=value_prefix,
+                cursor=cursor,
+                limit=limit or DEFAULT_PAGE_SIZE,
+            )
+        except InvalidCursor as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+        if page is not None:
+            items, next_cursor = page
+            return DepsolverResult(
+                repo_id=repo_id,
+                content=[DepsolverResultItem(**item) for item in items],
+                next_cursor=next_cursor,
+            )
+        raise HTTPException(status_code=404, detail=f"Content for {repo_id} not found")
+
+    meta = await get_meta(redis_client, repo_id)
+    headers = {}
+    if meta is not None:
+        headers = {
+            "ETag": f'"{meta.etag}"',
+            "Last-Modified": formatdate(meta.last_modified, usegmt=True),
+        }
+        if _etag_matches(if_none_match, meta.etag):
+            return Response(status_code=304, headers=headers)
+
+    body = await load_manifest_body(
+        redis_client, repo_id, meta.generation if meta is not None else None
+    )
+    if body is not None:
+        # content is validated and serialized when it's saved, stream it as it is
+        return StreamingResponse(
+            _stream_manifest(repo_id, body),
+            media_type="application/json",
+            headers=headers,
+        )
 
     raise HTTPException(status_code=404, detail=f"Content for {repo_id} not found")
 
 
+@router.get(
+    "/manifest/{repo_id}/diff",
+    response_model=DepsolverResultDiff,
+    status_code=200,
+    responses={
+        200: {
+            "description": "Changes of depsolved content for repo_id",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "repo_id": "foo-bar-repo",
+                        "generation": 2,
+                        "etag": "some-etag",
+                        "added": [
+                            {
+                                "src_repo_id": "source-foo-bar-repo",
+                                "unit_type": "RpmUnit",
+                                "unit_attr": "filename",
+                                "value": "some-filename.rpm",
+                            }
+                        ],
+                        "removed": [],
+                    }
+                }
+            },
+        },
+        404: {
+            "description": "Content for request repository is not available.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Content for foo-repo not found"}
+                }
+            },
+        },
+        410: {
+            "description": "Manifest the diff was requested since is not kept anymore, "
+            "the whole manifest has to be fetched.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Manifest of foo-repo since 1 is not available"
+                    }
+                }
+            },
+        },
+    },
+)
+async def manifest_diff(
+    repo_id: str, since: str, redis_client=Depends(get_redis)
+) -> DepsolverResultDiff:
+    """
+    Returns items added to and removed from manifest of repository since
+    the manifest identified by its generation or ETag.
+    """
+    try:
+        diff = await load_diff(redis_client, repo_id, since)
+    except GenerationExpired as exc:
+        raise HTTPException(status_code=410, detail=str(exc)) from exc
+
+    if diff is None:
+        raise HTTPException(status_code=404, detail=f"Content for {repo_id} not found")
+
+    return DepsolverResultDiff(
+        repo_id=repo_id,
+        generation=diff.generation,
+        etag=diff.etag,
+        added=[DepsolverResultItem(**item) for item in diff.added],
+        removed=[DepsolverResultItem(**item) for item in diff.removed],
+    )
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # If-None-Match uses weak comparison, W/ prefix of tags is ignored
+    return "*" in tags or any(tag.removeprefix("W/") == f'"{etag}"' for tag in tags)
+
+
+def _stream_manifest(repo_id, body):
+    """
+    Yields chunks of serialized manifest wrapped in the DepsolverResult envelope.
+    """
+    yield f'{{"repo_id": {json.dumps(repo_id)}, "content": '.encode("utf-8")
+    yield from body
+    yield b"}"
+
+
+@router.post(
+    "/manifests:batch",
+    response_model=List[DepsolverResultBatchItem],
+    status_code=200,
+    responses={
+        200: {
+            "description": "Depsolved content of requested repositories",
+            "content": {
+                "application/json": {
+                    "example": [
+                        {
+                            "repo_id": "foo-bar-repo",
+                            "found": True,
+                            "content": [
+                                {
+                                    "src_repo_id": "source-foo-bar-repo",
+                                    "unit_type": "RpmUnit",
+                                    "unit_attr": "filename",
+                                    "value": "some-filename.rpm",
+                                }
+                            ],
+                        },
+                        {
+                            "repo_id": "foo-repo",
+                            "found": False,
+                            "content": None,
+                        },
+                    ]
+                }
+            },
+        },
+        400: {
+            "description": "Too many repositories requested",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "At most 100 repositories can be requested"}
+                }
+            },
+        },
+    },
+)
+async def manifests_batch(
+    manifest_batch: ManifestBatch, redis_client=Depends(get_redis)
+) -> StreamingResponse:
+    """
+    Returns manifests of all requested repositories, each of them reported
+    as found or not found.
+    """
+    repo_ids = list(dict.fromkeys(manifest_batch.repo_ids))
+    if len(repo_ids) > MAX_REPO_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_REPO_IDS} repositories can be requested",
+        )
+
+    bodies = await load_manifest_bodies(redis_client, repo_ids)
+    return StreamingResponse(_stream_manifests(bodies), media_type="application/json")
+
+
+def _stream_manifests(bodies):
+    """
+    Yields chunks of serialized manifests wrapped in DepsolverResultBatchItem
+    envelopes, each manifest is decompressed only when it's streamed.
+    """
+    yield b"["
+    for index, (repo_id, body) in enumerate(bodies.items()):
+        separator = ", " if index else ""
+        if body is None:
+            item = {"repo_id": repo_id, "found": False, "content": None}
+            yield (separator + json.dumps(item)).encode("utf-8")
+            continue
+
+        envelope = (
+            f'{separator}{{"repo_id": {json.dumps(repo_id)}, "found": true, "content": '
+        )
+        yield envelope.encode("utf-8")
+        yield from body
+        yield b"}"
+    yield b"]"
+
+
 @router.get(
     "/task/{task_id}",
     response_model=TaskState,
+    response_model_exclude_none=True,
     status_code=200,
     responses={
         200: {
-            "description": "Task with task_id found",
+            "description": "State of task with task_id, PENDING for unknown tasks",
             "content": {
                 "application/json": {
                     "example": {
                         "task_id": "some-task-id",
-                        "state": "PENDING",
+                        "state": "STARTED",
+                        "subtasks": [
+                            {
+                                "task_id": "some-subtask-id",
+                                "state": "STARTED",
+                                "progress": {
+                                    "phase": "depsolving",
+                                    "updated": 1700000000.0,
+                                    "depsolvers": {
+                                        "rpm": {
+                                            "phase": "resolving",
+                                            "unsolved": 120,
+                                            "iteration": 4,
+                                            "queries_in_flight": 2,
+                                            "units_fetched": 1530,
+                                        }
+                                    },
+                                },
+                            }
+                        ],
                     }
                 }
             },
         },
-        404: {
-            "description": "Task with task_id not found",
+    },
+)
+async def task_state(task_id: str, redis_client=Depends(get_redis)) -> TaskState:
+    """
+    Returns state of task read from the result backend of celery. Progress
+    reported by running task is returned as well, along with states and progress
+    of its subtasks.
+    """
+    (meta,) = await _load_task_metas(redis_client, [task_id])
+    subtask_ids = _running_meta(meta).get("subtasks")
+    subtasks = None
+    if subtask_ids:
+        metas = await _load_task_metas(redis_client, subtask_ids)
+        subtasks = [
+            _task_state(subtask_id, subtask_meta)
+            for subtask_id, subtask_meta in zip(subtask_ids, metas)
+        ]
+
+    return _task_state(task_id, meta, subtasks)
+
+
+@router.get(
+    "/tasks",
+    response_model=List[TaskState],
+    response_model_exclude_none=True,
+    status_code=200,
+    responses={
+        200: {
+            "description": "States of tasks, PENDING for unknown tasks",
+            "content": {
+                "application/json": {
+                    "example": [
+                        {"task_id": "some-task-id", "state": "SUCCESS"},
+                        {"task_id": "some-other-task-id", "state": "PENDING"},
+                    ]
+                }
+            },
+        },
+        400: {
+            "description": "Too many tasks requested",
             "content": {
                 "application/json": {
-                    "example": {"detail": "Task some-other-task-id not found"}
+                    "example": {"detail": "At most 1000 tasks can be requested"}
                 }
             },
         },
     },
 )
-def task_state(task_id: str) -> TaskState:
-    task = app.AsyncResult(task_id)
-    if task:
-        return TaskState(task_id=task.task_id, state=task.state)
+async def task_states(
+    ids: List[str] = Query(), redis_client=Depends(get_redis)
+) -> List[TaskState]:
+    """
+    Returns states of all requested tasks, read from the result backend of celery
+    at once. Ids of tasks are passed as repeated or comma separated ids parameter.
+    Progress reported by running tasks is returned as well, states of their
+    subtasks are returned only by the endpoint for single task.
+    """
+    task_ids = list(
+        dict.fromkeys(
+            task_id for value in ids for task_id in value.split(",") if task_id
+        )
+    )
+    if len(task_ids) > MAX_TASK_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_TASK_IDS} tasks can be requested"
+        )
+    if not task_ids:
+        return []
+
+    metas = await _load_task_metas(redis_client, task_ids)
+    return [_task_state(task_id, meta) for task_id, meta in zip(task_ids, metas)]
+
+
+async def _load_task_metas(redis_client, task_ids):
+    """
+    Returns metas of tasks stored by celery, None for unknown tasks.
+    """
+    values = await redis_client.mget(
+        [app.backend.get_key_for_task(task_id) for task_id in task_ids]
+    )
+    return [
+        None if value is None else app.backend.decode_result(value) for value in values
+    ]
+
+
+def _running_meta(meta):
+    # meta stored by update_state() of running task
+    if meta is None or meta["status"] in states.READY_STATES:
+        return {}
+    return meta["result"] if isinstance(meta["result"], dict) else {}
+
 
-    raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+def _task_state(task_id, meta, subtasks=None):
+    return TaskState(
+        task_id=task_id,
+        state=states.PENDING if meta is None else meta["status"],
+        progress=_running_meta(meta).get("progress"),
+        subtasks=subtasks,
+    )
@@ -1,10 +1,26 @@
+from contextlib import asynccontextmanager
+
+import redis
+import redis.asyncio
 from fastapi import FastAPI
 
 from ubi_manifest.app import api
+from ubi_manifest.worker.tasks.celery import app as celery_app
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # clients with connection pools shared by all requests, the sync one
+    # is used by sync endpoints running in the threadpool
+    app.state.redis = redis.asyncio.from_url(celery_app.conf.result_backend)
+    app.state.sync_redis = redis.from_url(celery_app.conf.result_backend)
+    yield
+    await app.state.redis.aclose()
+    app.state.sync_redis.close()
 
 
 def create_app():
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
     app.include_router(api.router)
 
     return app
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel  # pylint: disable=no-name-in-module
 
@@ -10,6 +10,10 @@ class DepsolveItem(BaseModel):
 class TaskState(BaseModel):
     task_id: str
     state: str
+    # progress reported by running task
+    progress: Optional[Dict[str, Any]] = None
+    # states of subtasks of running task
+    subtasks: Optional[List["TaskState"]] = None
 
 
 class DepsolverResultItem(BaseModel):
@@ -22,3 +26,24 @@ class DepsolverResultItem(BaseModel):
 class DepsolverResult(BaseModel):
     repo_id: str
     content: List[DepsolverResultItem]
+    # cursor of the next page, set only for paginated results
+    next_cursor: Optional[str] = None
+
+
+class ManifestBatch(BaseModel):
+    repo_ids: List[str]
+
+
+class DepsolverResultBatchItem(BaseModel):
+    repo_id: str
+    found: bool
+    content: Optional[List[DepsolverResultItem]] = None
+
+
+class DepsolverResultDiff(BaseModel):
+    repo_id: str
+    # generation and ETag of the current manifest the diff leads to
+    generation: int
+    etag: str
+    added: List[DepsolverResultItem]
+    removed: List[DepsolverResultItem]
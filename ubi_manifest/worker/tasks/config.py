@@ -23,6 +23,23 @@ class Config:
     ubi_manifest_data_expiration: int = (
         60 * 60 * 4
     )  # 4 hours default data expiration for redis
+    # compression of manifests stored in redis, 'gzip' or 'none'
+    manifest_compression: str = "gzip"
+    # expiration of cached pulp search results in redis, 0 disables the cache
+    search_cache_ttl: int = 0
+    # max number of cached results, there is one per searched criterion
+    search_cache_max_entries: int = 100000
+    # expiration of memoized manifest items of depsolver items reused when their
+    # config and last publish of their input repos didn't change, 0 disables it
+    depsolve_memo_ttl: int = 0
+    # expiration of locks of repo groups and output repositories held by depsolve tasks
+    depsolve_lock_expiration: int = 60 * 60 * 4
+    # delay before retrying depsolve task whose output repositories are locked
+    depsolve_lock_retry_delay: int = 60
+    # max number of such retries, the task fails when its repositories stay locked
+    depsolve_lock_max_retries: int = 240
+    # interval in seconds of reporting progress of depsolve subtasks, 0 disables it
+    depsolve_progress_interval: int = 10
 
 
 def make_config(celery_app):
@@ -1,26 +1,47 @@
+import hashlib
 import json
 import logging
+import uuid
 from collections import defaultdict
-from typing import Dict, List
+from functools import partial
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Tuple
 
 import redis
-from pubtools.pulplib import ModulemdDefaultsUnit, ModulemdUnit, RpmUnit
-
+from attrs import asdict, define, evolve
+from celery import chord, group, states
+from more_executors import Executors
+from more_executors.futures import f_map
+from pubtools.pulplib import RpmUnit, YumRepository
+from ubiconfig.config_types.modules import Module
+
+from ubi_manifest import VERSION
+from ubi_manifest.app.models import DepsolverResultItem
 from ubi_manifest.worker.tasks.celery import app
+from ubi_manifest.worker.tasks.depsolver.content_store import repo_revision
+from ubi_manifest.worker.tasks.depsolver.item_memo import ItemMemo
 from ubi_manifest.worker.tasks.depsolver.models import (
     DepsolverItem,
     ModularDepsolverItem,
+    PackageToExclude,
     UbiUnit,
 )
 from ubi_manifest.worker.tasks.depsolver.modulemd_depsolver import ModularDepsolver
+from ubi_manifest.worker.tasks.depsolver.progress import ProgressReporter, use_progress
+from ubi_manifest.worker.tasks.depsolver.pulp_queries import SearchContext
+from ubi_manifest.worker.tasks.depsolver.repo_resolver import RepositoryResolver
 from ubi_manifest.worker.tasks.depsolver.rpm_depsolver import Depsolver
+from ubi_manifest.worker.tasks.depsolver.search_cache import SearchCache
 from ubi_manifest.worker.tasks.depsolver.ubi_config import UbiConfigLoader
 from ubi_manifest.worker.tasks.depsolver.utils import (
     make_pulp_client,
     parse_blacklist_config,
     remap_keys,
     split_filename,
+    unit_identity,
 )
+from ubi_manifest.worker.tasks.locks import acquire_locks, release_lock, repo_lock_key
+from ubi_manifest.worker.tasks.manifest_store import save_manifests
 
 _LOG = logging.getLogger(__name__)
 
@@ -33,8 +54,153 @@ class InconsistentDepsolverConfig(Exception):
     pass
 
 
-@app.task
-def depsolve_task(ubi_repo_ids: List[str], content_config_url: str) -> None:
+@define
+class DepsolvePlan:
+    """
+    Depsolver items for all repositories of one repo group.
+    """
+
+    # (ubi repo id, input content set): item
+    dep_map: Dict[Tuple[str, str], DepsolverItem]
+    # (ubi debug repo id, input content set): item
+    debug_dep_map: Dict[Tuple[str, str], DepsolverItem]
+    # (ubi repo id, input content set): item
+    mod_dep_map: Dict[Tuple[str, str], ModularDepsolverItem]
+    # input repo id: ubi repo id
+    repos_map: Dict[str, str]
+    # ubi repo id: ubi debug repo id
+    debug_repo_ids: Dict[str, str]
+    # ubi repo id: keys of debug_dep_map items fed with debuginfo of its output
+    debug_item_keys: Dict[str, List[Tuple[str, str]]]
+    ubi_repos: List[YumRepository]
+    in_source_rpm_repos: List[YumRepository]
+    flags: Dict[str, Any]
+
+    def scoped(self, key: Tuple[str, str]) -> "DepsolvePlan":
+        """
+        Returns plan depsolving only given (ubi repo id, input content set) item.
+        Other items are kept with empty whitelists, so the dependencies are still
+        resolved from all input repositories of the group, the same way as if
+        all items were depsolved together.
+        """
+        ubi_repo_id, input_cs = key
+        debug_key = (self.debug_repo_ids[ubi_repo_id], input_cs)
+        return evolve(
+            self,
+            dep_map={
+                _key: item if _key == key else evolve(item, whitelist=set())
+                for _key, item in self.dep_map.items()
+            },
+            debug_dep_map={
+                _key: evolve(item, whitelist=set(item.whitelist))
+                if _key == debug_key
+                else evolve(item, whitelist=set())
+                for _key, item in self.debug_dep_map.items()
+            },
+            mod_dep_map={
+                _key: item if _key == key else evolve(item, modulelist=[])
+                for _key, item in self.mod_dep_map.items()
+            },
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns json serializable dict of the plan, repositories are referenced by ids.
+        """
+
+        def repo_ids(repos):
+            return [repo.id for repo in repos]
+
+        def rpm_items(dep_map):
+            return [
+                [
+                    *key,
+                    {
+                        "whitelist": sorted(item.whitelist),
+                        "blacklist": [asdict(pkg) for pkg in item.blacklist],
+                        "in_pulp_repos": repo_ids(item.in_pulp_repos),
+                    },
+                ]
+                for key, item in dep_map.items()
+            ]
+
+        return {
+            "dep_map": rpm_items(self.dep_map),
+            "debug_dep_map": rpm_items(self.debug_dep_map),
+            "mod_dep_map": [
+                [
+                    *key,
+                    {
+                        "modulelist": [
+                            [module.name, module.stream, module.profiles]
+                            for module in item.modulelist
+                        ],
+                        "repo": item.repo.id,
+                        "in_pulp_repos": repo_ids(item.in_pulp_repos),
+                    },
+                ]
+                for key, item in self.mod_dep_map.items()
+            ],
+            "repos_map": self.repos_map,
+            "debug_repo_ids": self.debug_repo_ids,
+            "debug_item_keys": {
+                repo_id: [list(key) for key in keys]
+                for repo_id, keys in self.debug_item_keys.items()
+            },
+            "ubi_repos": repo_ids(self.ubi_repos),
+            "in_source_rpm_repos": repo_ids(self.in_source_rpm_repos),
+            "flags": self.flags,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], resolver) -> "DepsolvePlan":
+        """
+        Creates plan from dict created by to_dict(), all referenced repositories
+        are fetched by given resolver at once.
+        """
+        repo_ids = set(data["ubi_repos"] + data["in_source_rpm_repos"])
+        for name in ("dep_map", "debug_dep_map", "mod_dep_map"):
+            for _, _, item in data[name]:
+                repo_ids.update(item["in_pulp_repos"])
+        repo_ids.update(item["repo"] for _, _, item in data["mod_dep_map"])
+        # fetch all repositories in one search, the rest is resolved from cache
+        resolver.get_repositories(repo_ids)
+
+        def rpm_items(items):
+            return {
+                (ubi_repo_id, input_cs): DepsolverItem(
+                    set(item["whitelist"]),
+                    [PackageToExclude(**pkg) for pkg in item["blacklist"]],
+                    resolver.get_repositories(item["in_pulp_repos"]),
+                )
+                for ubi_repo_id, input_cs, item in items
+            }
+
+        return cls(
+            dep_map=rpm_items(data["dep_map"]),
+            debug_dep_map=rpm_items(data["debug_dep_map"]),
+            mod_dep_map={
+                (ubi_repo_id, input_cs): ModularDepsolverItem(
+                    [Module(*module) for module in item["modulelist"]],
+                    resolver.get_repository(item["repo"]),
+                    resolver.get_repositories(item["in_pulp_repos"]),
+                )
+                for ubi_repo_id, input_cs, item in data["mod_dep_map"]
+            },
+            repos_map=data["repos_map"],
+            debug_repo_ids=data["debug_repo_ids"],
+            debug_item_keys={
+                repo_id: [(debug_repo_id, input_cs) for debug_repo_id, input_cs in keys]
+                for repo_id, keys in data["debug_item_keys"].items()
+            },
+            ubi_repos=resolver.get_repositories(data["ubi_repos"]),
+            in_source_rpm_repos=resolver.get_repositories(data["in_source_rpm_repos"]),
+            flags=data["flags"],
+        )
+
+
+@app.task(bind=True)
+def depsolve_task(self, ubi_repo_ids: List[str], content_config_url: str) -> None:
     """
     Run depsolvers for given ubi_repo_ids - it's expected that id of binary
     repositories are provided. Debuginfo and SRPM repos related to those ones
@@ -44,181 +210,497 @@ def depsolve_task(ubi_repo_ids: List[str], content_config_url: str) -> None:
     and value is a list of items, where item is a dict with keys:
     (source_repo_id, unit_type, unit_attr, value). Note that value in redis
     is stored as json string.
+
+    This task only plans the depsolving and replaces itself with a chord of
+    depsolve_item_task for each (ubi repo, input content set) item, that can
+    run on different workers, followed by merge_and_save_task. The plan is
+    passed to the subtasks, so they don't have to plan again.
+
+    The task holds locks of all output repositories until their manifests
+    are saved. The locks are taken before planning, if any of them is held
+    by another task, the task is retried later without planning, at most
+    depsolve_lock_max_retries times. Ids of depsolve_item_task subtasks are
+    stored in the meta of the task while they're running, so their progress
+    can be looked up by id of this task.
     """
     ubi_config_loader = UbiConfigLoader(content_config_url)
-
+    redis_client = redis.from_url(app.conf.result_backend)
     with make_pulp_client(app.conf) as client:
-        depsolver_flags = {}  # (input_cs, ubi_repo_id): {"flag_x": "value"}
-
-        repos_map = {}
-        debug_dep_map = {}
-        dep_map = {}
-        mod_dep_map = {}
-        in_source_rpm_repos = []
-        for ubi_repo_id in ubi_repo_ids:
-            repo = client.get_repository(ubi_repo_id)
-            debuginfo_repo = repo.get_debug_repository()
-            srpm_repo = repo.get_source_repository()
-
-            # create rhel_repo:ubi_repo mapping
-            for _repo, sources in zip(
-                [repo, debuginfo_repo, srpm_repo],
-                [
-                    repo.population_sources,
-                    debuginfo_repo.population_sources,
-                    srpm_repo.population_sources,
-                ],
-            ):
-                for item in sources:
-                    repos_map[item] = _repo.id
-
-            cs_repo_map, cs_debug_repo_map = _get_population_sources_per_cs(
-                client, repo
+        resolver = RepositoryResolver(client)
+        output_repo_ids = _get_output_repo_ids(resolver, ubi_repo_ids)
+        lock_keys = [repo_lock_key(repo_id) for repo_id in output_repo_ids]
+        holder = acquire_locks(
+            redis_client,
+            lock_keys,
+            self.request.id,
+            int(app.conf["depsolve_lock_expiration"]),
+        )
+        if holder is not None:
+            _LOG.info(
+                "Some of repos %s are being depsolved by task %s, retrying later",
+                output_repo_ids,
+                holder,
+            )
+            raise self.retry(
+                countdown=int(app.conf["depsolve_lock_retry_delay"]),
+                max_retries=int(app.conf["depsolve_lock_max_retries"]),
             )
-            # if we have population sources with different content sets and different content configs
-            # we need to make sure that we use correct config for each input repo
-            for input_cs, input_repos in cs_repo_map.items():
-                config = _get_content_config(
-                    ubi_config_loader,
-                    input_cs,
-                    repo.content_set,
-                    repo.ubi_config_version,
-                )
-                whitelist, debuginfo_whitelist = _filter_whitelist(config)
-                blacklist = parse_blacklist_config(config)
-                depsolver_flags[(repo.id, input_cs)] = config.flags.as_dict()
 
-                in_source_rpm_repos.extend(_get_population_sources(client, srpm_repo))
+        try:
+            plan = _make_plan(resolver, ubi_config_loader, ubi_repo_ids)
+            fingerprints = _item_fingerprints(plan)
+        except Exception:
+            for key in lock_keys:
+                release_lock(redis_client, key, self.request.id)
+            raise
+
+    _LOG.info(
+        "Depsolving items of repos %s: %s", ubi_repo_ids, list(plan.dep_map.keys())
+    )
+    subtasks = [
+        depsolve_item_task.s(
+            plan.scoped((ubi_repo_id, input_cs)).to_dict(),
+            ubi_repo_id,
+            input_cs,
+            fingerprints.get((ubi_repo_id, input_cs)),
+        ).set(task_id=str(uuid.uuid4()))
+        for ubi_repo_id, input_cs in plan.dep_map
+    ]
+    self.update_state(
+        state=states.STARTED,
+        meta={"subtasks": [subtask.id for subtask in subtasks]},
+    )
+    header = group(subtasks)
+    return self.replace(
+        chord(header, merge_and_save_task.s(output_repo_ids, self.request.id))
+    )
+
+
+@app.task(bind=True)
+def depsolve_item_task(
+    self,
+    plan: Dict[str, Any],
+    ubi_repo_id: str,
+    input_cs: str,
+    fingerprint: Optional[str] = None,
+) -> Dict[str, List[dict]]:
+    """
+    Run depsolvers for one (ubi repo, input content set) item of plan scoped to it,
+    the plan is a dict created by DepsolvePlan.to_dict(). Returns manifest items
+    of all output repositories, in the same format as they're saved to redis.
 
-                dep_map[(repo.id, input_cs)] = DepsolverItem(
-                    whitelist,
-                    blacklist,
-                    input_repos,
-                )
+    If the item memoization is enabled and fingerprint of inputs of the item
+    is given, manifest items memoized by the last run with the same fingerprint
+    are returned without depsolving. Otherwise the item is depsolved from scratch.
 
-                debug_dep_map[(debuginfo_repo.id, input_cs)] = DepsolverItem(
-                    debuginfo_whitelist,
-                    blacklist,
-                    cs_debug_repo_map[input_cs],
-                )
+    Progress of the depsolvers is periodically stored in the meta of the task.
+    """
+    search_context = SearchContext(search_cache=_make_search_cache())
+    item_memo = _make_item_memo()
+    result = None
+
+    with make_pulp_client(app.conf) as client, use_progress(
+        _make_progress_reporter(self)
+    ) as reporter:
+        if item_memo is not None and fingerprint is not None:
+            result = item_memo.get(ubi_repo_id, input_cs, fingerprint)
+
+        if result is None:
+            if reporter is not None:
+                reporter.set_phase("depsolving")
+            scoped_plan = DepsolvePlan.from_dict(plan, RepositoryResolver(client))
+            out = _run_plan(scoped_plan, search_context, reporter)
+            result = {repo_id: _manifest_items(units) for repo_id, units in out.items()}
+            if item_memo is not None and fingerprint is not None:
+                item_memo.put(ubi_repo_id, input_cs, fingerprint, result)
+        else:
+            _LOG.info(
+                "Inputs of %s:%s didn't change, reusing memoized manifest items",
+                ubi_repo_id,
+                input_cs,
+            )
 
-                # modulemd depsolver vars
-                modulelist = config.modules.whitelist
-                mod_dep_map[(repo.id, input_cs)] = ModularDepsolverItem(
-                    modulelist, repo, input_repos
-                )
+    _LOG.info(
+        "Searches answered by other in-flight searches: %s",
+        search_context.single_flight.shared,
+    )
+    if search_context.search_cache is not None:
+        _LOG.info("Search cache stats: %s", search_context.search_cache.stats())
+
+    return result
 
-        flags = validate_depsolver_flags(depsolver_flags)
-        # run modular depsolver
+
+@app.task
+def merge_and_save_task(
+    results: List[Dict[str, List[dict]]], output_repo_ids: List[str], lock_owner: str
+) -> None:
+    """
+    Merge outputs of depsolve_item_task and save them to redis. Locks of output
+    repositories held by lock_owner task are released afterwards.
+    """
+    out: Dict[str, List[dict]] = {}
+    for result in results:
+        # merge dicts without overwriting any entry
+        _merge_manifest_items(out, result)
+
+    # make sure that there are all ubi repositories in the 'out' dictionary set a keys
+    # repositories with empty manifest are ommited from previous processing
+    for repo_id in output_repo_ids:
+        if repo_id not in out:
+            out[repo_id] = []
+    # save depsolved data to redis
+    _save(out)
+
+    redis_client = redis.from_url(app.conf.result_backend)
+    for repo_id in output_repo_ids:
+        release_lock(redis_client, repo_lock_key(repo_id), lock_owner)
+
+
+def _get_output_repo_ids(resolver, ubi_repo_ids):
+    """
+    Returns sorted ids of all output repositories of given ubi repositories,
+    the same ones as mapped by repos_map of their plan - the ubi repositories
+    and their related debug and source repositories that have population sources.
+    """
+    ubi_repos = resolver.get_repositories(ubi_repo_ids)
+    repos = ubi_repos + [
+        related
+        for repo_type in ("debug", "source")
+        for related in resolver.get_related_repositories(ubi_repos, repo_type).values()
+    ]
+    return sorted({repo.id for repo in repos if repo and repo.population_sources})
+
+
+def _make_plan(resolver, ubi_config_loader, ubi_repo_ids):
+    depsolver_flags = {}  # (input_cs, ubi_repo_id): {"flag_x": "value"}
+
+    repos_map = {}
+    debug_dep_map = {}
+    dep_map = {}
+    mod_dep_map = {}
+    in_source_rpm_repos = []
+
+    ubi_repos = resolver.get_repositories(ubi_repo_ids)
+    debug_repos = resolver.get_related_repositories(ubi_repos, "debug")
+    srpm_repos = resolver.get_related_repositories(ubi_repos, "source")
+    _prefetch_population_sources(
+        resolver, ubi_repos + list(debug_repos.values()) + list(srpm_repos.values())
+    )
+
+    for repo in ubi_repos:
+        debuginfo_repo = debug_repos[repo.id]
+        srpm_repo = srpm_repos[repo.id]
+
+        # create rhel_repo:ubi_repo mapping
+        for _repo, sources in zip(
+            [repo, debuginfo_repo, srpm_repo],
+            [
+                repo.population_sources,
+                debuginfo_repo.population_sources,
+                srpm_repo.population_sources,
+            ],
+        ):
+            for item in sources:
+                repos_map[item] = _repo.id
+
+        cs_repo_map, cs_debug_repo_map = _get_population_sources_per_cs(resolver, repo)
+        # if we have population sources with different content sets and different content configs
+        # we need to make sure that we use correct config for each input repo
+        for input_cs, input_repos in cs_repo_map.items():
+            config = _get_content_config(
+                ubi_config_loader,
+                input_cs,
+                repo.content_set,
+                repo.ubi_config_version,
+            )
+            whitelist, debuginfo_whitelist = _filter_whitelist(config)
+            blacklist = parse_blacklist_config(config)
+            depsolver_flags[(repo.id, input_cs)] = config.flags.as_dict()
+
+            in_source_rpm_repos.extend(_get_population_sources(resolver, srpm_repo))
+
+            dep_map[(repo.id, input_cs)] = DepsolverItem(
+                whitelist,
+                blacklist,
+                input_repos,
+            )
+
+            debug_dep_map[(debuginfo_repo.id, input_cs)] = DepsolverItem(
+                debuginfo_whitelist,
+                blacklist,
+                cs_debug_repo_map[input_cs],
+            )
+
+            # modulemd depsolver vars
+            modulelist = config.modules.whitelist
+            mod_dep_map[(repo.id, input_cs)] = ModularDepsolverItem(
+                modulelist, repo, input_repos
+            )
+
+    return DepsolvePlan(
+        dep_map=dep_map,
+        debug_dep_map=debug_dep_map,
+        mod_dep_map=mod_dep_map,
+        repos_map=repos_map,
+        debug_repo_ids={
+            repo_id: debug_repo.id for repo_id, debug_repo in debug_repos.items()
+        },
+        debug_item_keys=_get_debug_item_keys(resolver, ubi_repos),
+        ubi_repos=ubi_repos,
+        in_source_rpm_repos=in_source_rpm_repos,
+        flags=validate_depsolver_flags(depsolver_flags),
+    )
+
+
+def _run_plan(plan, search_context=None, reporter=None):
+    """
+    Runs depsolvers of all items of plan. Searches of the depsolvers share
+    given search_context, their progress is tracked by given reporter.
+    """
+    with Executors.thread_pool(max_workers=1) as modulemd_executor:
+        # run modular depsolver, rpm depsolvers run concurrently with it
+        # and get its rpm dependencies as soon as they're available
         _LOG.info(
             "Running MODULEMD depsolver for repos: %s",
-            [item[0] for item in mod_dep_map.keys()],
+            [item[0] for item in plan.mod_dep_map.keys()],
         )
-        modulemd_out = _run_modulemd_depsolver(list(mod_dep_map.values()), repos_map)
-        out = modulemd_out["modules_out"]
-        modulemd_rpm_deps = modulemd_out["rpm_dependencies"]
+        modulemd_out_ft = modulemd_executor.submit(
+            _run_modulemd_depsolver,
+            list(plan.mod_dep_map.values()),
+            plan.repos_map,
+            search_context,
+            reporter,
+        )
+        modulemd_rpm_deps = f_map(modulemd_out_ft, itemgetter("rpm_dependencies"))
 
-        # run depsolver for binary repos
+        # run depsolvers for binary and debuginfo repos
         _LOG.info(
-            "Running depsolver for RPM repos: %s", [item[0] for item in dep_map.keys()]
-        )
-        # TODO this blocks task from processing, depsolving of debuginfo packages
-        # could be moved to the Depsolver. It should lead to more async processing
-        # and better performance
-        rpm_out = _run_depsolver(
-            list(dep_map.values()),
-            repos_map,
-            in_source_rpm_repos,
-            modulemd_rpm_deps,
-            flags,
+            "Running depsolver for RPM repos: %s",
+            [item[0] for item in plan.dep_map.keys()],
         )
-
-        _merge_output_dictionary(out, rpm_out)
-        if not flags.get("base_pkgs_only"):
-            _update_debug_whitelist(client, out, debug_dep_map)
-
-        # run depsolver for debuginfo repo
         _LOG.info(
             "Running depsolver for DEBUGINFO repos: %s",
-            [item[0] for item in debug_dep_map.keys()],
+            [item[0] for item in plan.debug_dep_map.keys()],
         )
-        debuginfo_out = _run_depsolver(
-            list(debug_dep_map.values()),
-            repos_map,
-            in_source_rpm_repos,
+        debug_items_per_repo = {}
+        if not plan.flags.get("base_pkgs_only"):
+            debug_items_per_repo = {
+                repo_id: [plan.debug_dep_map[key] for key in keys]
+                for repo_id, keys in plan.debug_item_keys.items()
+            }
+        rpm_out, debuginfo_out = _run_depsolvers(
+            list(plan.dep_map.values()),
+            list(plan.debug_dep_map.values()),
+            debug_items_per_repo,
+            plan.repos_map,
+            plan.in_source_rpm_repos,
             modulemd_rpm_deps,
-            flags,
+            plan.flags,
+            search_context,
+            reporter,
         )
-    # merge 'out' and 'debuginfo_out' dicts without overwriting any entry
+        out = modulemd_out_ft.result()["modules_out"]
+
+    # merge 'out', 'rpm_out' and 'debuginfo_out' dicts without overwriting any entry
+    _merge_output_dictionary(out, rpm_out)
     _merge_output_dictionary(out, debuginfo_out)
+    return out
 
-    # make sure that there are all ubi repositories in the 'out' dictionary set a keys
-    # repositories with empty manifest are ommited from previous processing
-    for repo_id in repos_map.values():
-        if repo_id not in out:
-            out[repo_id] = []
-    # save depsolved data to redis
-    _save(out)
+
+def _make_search_cache():
+    ttl = int(app.conf.get("search_cache_ttl") or 0)
+    if not ttl:
+        return None
+
+    return SearchCache(
+        redis.from_url(app.conf.result_backend),
+        ttl=ttl,
+        max_entries=int(app.conf["search_cache_max_entries"]),
+    )
+
+
+def _make_progress_reporter(task):
+    interval = int(app.conf.get("depsolve_progress_interval") or 0)
+    # progress of tasks called directly, not by a worker, is not reported
+    if not interval or task.request.id is None:
+        return None
+
+    # request of the task is thread-local, the reporter thread has to pass its id
+    task_id = task.request.id
+
+    def report(progress):
+        task.update_state(
+            task_id=task_id, state=states.STARTED, meta={"progress": progress}
+        )
+
+    return ProgressReporter(report, interval)
+
+
+def _make_item_memo():
+    ttl = int(app.conf.get("depsolve_memo_ttl") or 0)
+    if not ttl:
+        return None
+
+    return ItemMemo(redis.from_url(app.conf.result_backend), ttl=ttl)
+
+
+def _item_fingerprints(plan):
+    """
+    Returns mapping of key of each plan item to fingerprint of its inputs,
+    the mapping is empty if the item memoization is disabled.
+
+    Input repositories are fingerprinted by their revision, i.e. the last publish,
+    which is known from the repositories fetched for planning, no content is listed.
+    Items are resolved from all input repositories of the plan, so a publish of any
+    of them invalidates memoized manifest items of all items.
+    """
+    if not int(app.conf.get("depsolve_memo_ttl") or 0):
+        return {}
+
+    revisions = {repo.id: repo_revision(repo) for repo in _input_repos(plan)}
+    return {key: _plan_fingerprint(plan, key, revisions) for key in plan.dep_map}
+
+
+def _input_repos(plan):
+    return plan.in_source_rpm_repos + [
+        repo
+        for dep_map in (plan.dep_map, plan.debug_dep_map, plan.mod_dep_map)
+        for item in dep_map.values()
+        for repo in item.in_pulp_repos
+    ]
+
+
+def _plan_fingerprint(plan, key, revisions):
+    """
+    Returns fingerprint of all inputs of given plan item - content configs and flags
+    of all items of the plan and revisions of all input repositories.
+    None is returned if revision of any input repository is unknown.
+    """
+
+    def repo_ids(repos):
+        return sorted(repo.id for repo in repos)
+
+    if None in revisions.values():
+        return None
+
+    items = {
+        name: sorted(
+            [
+                list(_key),
+                sorted(item.whitelist),
+                [asdict(pkg) for pkg in item.blacklist],
+                repo_ids(item.in_pulp_repos),
+            ]
+            for _key, item in dep_map.items()
+        )
+        for name, dep_map in (("rpm", plan.dep_map), ("debug", plan.debug_dep_map))
+    }
+    items["modular"] = sorted(
+        [
+            list(_key),
+            [
+                [module.name, module.stream, module.profiles]
+                for module in item.modulelist
+            ],
+            item.repo.id,
+            repo_ids(item.in_pulp_repos),
+        ]
+        for _key, item in plan.mod_dep_map.items()
+    )
+
+    data = json.dumps(
+        {
+            "version": VERSION,
+            "item": list(key),
+            "flags": plan.flags,
+            "items": items,
+            "repos_map": plan.repos_map,
+            "debug_item_keys": plan.debug_item_keys,
+            "revisions": revisions,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _get_debug_item_keys(resolver, ubi_repos):
+    """
+    Returns mapping of ubi repo id to keys of debuginfo depsolver items whose
+    whitelists are extended with debuginfo packages related to the output of the repo.
+    """
+    out = {}
+    debug_repos = resolver.get_related_repositories(ubi_repos, "debug")
+    for ubi_repo in ubi_repos:
+        debug_repo = debug_repos[ubi_repo.id]
+        debug_in_repos = resolver.get_repositories(debug_repo.population_sources)
+        rpm_in_repos = resolver.get_related_repositories(debug_in_repos, "binary")
+        out[ubi_repo.id] = [
+            (debug_repo.id, rpm_in_repo.content_set)
+            for rpm_in_repo in rpm_in_repos.values()
+        ]
+
+    return out
 
 
-def _update_debug_whitelist(client, output_set, debug_dep_map):
+def _get_debuginfo_pkg_names(pkg_list):
     # generate missing debuginfo packages
     # TODO this seems to generate too many debuginfo packages - fix after tests with real data
-    for ubi_repo_id, pkg_list in output_set.items():
-        debuginfo_to_add = set()
-        for pkg in pkg_list:
-            # inspired with pungi depsolver
-            if pkg.isinstance_inner_unit(RpmUnit) and pkg.sourcerpm:
-                source_name = split_filename(pkg.sourcerpm)[0]
-                debuginfo_to_add.add(f"{pkg.name}-debuginfo")
-                debuginfo_to_add.add(f"{source_name}-debugsource")
-
-        _repo_out = client.get_repository(ubi_repo_id)
-        _repo_debug_out = _repo_out.get_debug_repository()
-        for _repo_in_id in _repo_debug_out.population_sources:
-            # update whitelist for given ubi depsolver item
-            rpm_in_repo = client.get_repository(_repo_in_id).get_binary_repository()
-            debug_dep_map[
-                (_repo_debug_out.id, rpm_in_repo.content_set)
-            ].whitelist.update(debuginfo_to_add)
-
-
-def _save(data: Dict[str, List[UbiUnit]]) -> None:
-    redis_client = redis.from_url(app.conf.result_backend)
+    debuginfo_to_add = set()
+    for pkg in pkg_list:
+        # inspired with pungi depsolver
+        if pkg.isinstance_inner_unit(RpmUnit) and pkg.sourcerpm:
+            source_name = split_filename(pkg.sourcerpm)[0]
+            debuginfo_to_add.add(f"{pkg.name}-debuginfo")
+            debuginfo_to_add.add(f"{source_name}-debugsource")
 
-    data_for_redis = {}
-    for repo_id, units in data.items():
-        items = []
-        for unit in units:
-            if unit.isinstance_inner_unit(RpmUnit):
-                item = {
-                    "src_repo_id": unit.associate_source_repo_id,
-                    "unit_type": "RpmUnit",
-                    "unit_attr": "filename",
-                    "value": unit.filename,
-                }
-            elif unit.isinstance_inner_unit(ModulemdUnit):
-                item = {
-                    "src_repo_id": unit.associate_source_repo_id,
-                    "unit_type": "ModulemdUnit",
-                    "unit_attr": "nsvca",
-                    "value": unit.nsvca,
-                }
-            elif unit.isinstance_inner_unit(ModulemdDefaultsUnit):
-                item = {
-                    "src_repo_id": unit.associate_source_repo_id,
-                    "unit_type": "ModulemdDefaultsUnit",
-                    "unit_attr": "name:stream",
-                    "value": f"{unit.name}:{unit.stream}",
-                }
-            items.append(item)
-
-        data_for_redis[repo_id] = items
-    # save data to redis as key:json_string
-    for key, values in data_for_redis.items():
-        redis_client.set(
-            key, json.dumps(values), ex=app.conf["ubi_manifest_data_expiration"]
-        )
+    return debuginfo_to_add
+
+
+def _feed_debug_whitelist(debug_depsolver, debug_items_per_repo, repos_map, units):
+    """
+    Extend whitelists of running debuginfo depsolver with debuginfo packages
+    related to given binary rpms.
+    """
+    units_per_repo = defaultdict(list)
+    for unit in units:
+        units_per_repo[repos_map.get(unit.associate_source_repo_id)].append(unit)
+
+    for ubi_repo_id, pkg_list in units_per_repo.items():
+        debuginfo_to_add = _get_debuginfo_pkg_names(pkg_list)
+        if not debuginfo_to_add:
+            continue
+        for item in debug_items_per_repo.get(ubi_repo_id) or []:
+            debug_depsolver.extend_whitelist(item, debuginfo_to_add)
+
+
+def _manifest_items(units: List[UbiUnit]) -> List[dict]:
+    """
+    Returns manifest items of given units, as they're saved to redis.
+    """
+    items = []
+    for unit in units:
+        unit_type, unit_attr, value = unit_identity(unit)
+        item = {
+            "src_repo_id": unit.associate_source_repo_id,
+            "unit_type": unit_type,
+            "unit_attr": unit_attr,
+            "value": value,
+        }
+        # validate items once here, they are served by api without validation
+        DepsolverResultItem(**item)
+        items.append(item)
+
+    return items
+
+
+def _save(data: Dict[str, List[dict]]) -> None:
+    redis_client = redis.from_url(app.conf.result_backend)
+    save_manifests(
+        redis_client,
+        data,
+        int(app.conf["ubi_manifest_data_expiration"]),
+        app.conf["manifest_compression"],
+    )
 
 
 def _filter_whitelist(ubi_config):
@@ -236,24 +718,86 @@ def _filter_whitelist(ubi_config):
     return whitelist, debuginfo_whitelist
 
 
-def _get_population_sources(client, repo):
-    return [client.get_repository(repo_id) for repo_id in repo.population_sources]
+def _get_population_sources(resolver, repo):
+    return resolver.get_repositories(repo.population_sources)
 
 
-def _run_depsolver(
-    depsolver_items, repos_map, in_source_rpm_repos, modulemd_deps, flags
+def _prefetch_population_sources(resolver, repos):
+    """
+    Fetch population sources of all given repositories and debug repositories
+    related to them at once, so they are resolved from cache later.
+    """
+    source_ids = {repo_id for repo in repos for repo_id in repo.population_sources}
+    sources = resolver.get_repositories(source_ids)
+    resolver.get_related_repositories(sources, "debug")
+    resolver.get_related_repositories(sources, "binary")
+
+
+def _run_depsolvers(
+    depsolver_items,
+    debug_depsolver_items,
+    debug_items_per_repo,
+    repos_map,
+    in_source_rpm_repos,
+    modulemd_deps,
+    flags,
+    search_context=None,
+    reporter=None,
 ):
+    """
+    Run depsolvers for binary and debuginfo repos concurrently. Binary rpms are
+    streamed to the debuginfo depsolver as soon as they're depsolved, their
+    debuginfo/debugsource packages are added to the debuginfo whitelists.
+    """
+    stream_debuginfo = not flags.get("base_pkgs_only")
     with Depsolver(
-        depsolver_items, in_source_rpm_repos, modulemd_deps, **flags
-    ) as depsolver:
-        depsolver.run()
-        exported = depsolver.export()
-        out = remap_keys(repos_map, exported)
-    return out
+        depsolver_items,
+        in_source_rpm_repos,
+        modulemd_deps,
+        search_context=search_context,
+        **flags,
+    ) as depsolver, Depsolver(
+        debug_depsolver_items,
+        in_source_rpm_repos,
+        modulemd_deps,
+        search_context=search_context,
+        open_whitelist=stream_debuginfo,
+        **flags,
+    ) as debug_depsolver, Executors.thread_pool(
+        max_workers=1
+    ) as executor:
+        if stream_debuginfo:
+            depsolver.subscribe(
+                partial(
+                    _feed_debug_whitelist,
+                    debug_depsolver,
+                    debug_items_per_repo,
+                    repos_map,
+                )
+            )
+
+        if reporter is not None:
+            reporter.track("rpm", depsolver.progress)
+            reporter.track("debuginfo", debug_depsolver.progress)
+        debug_ft = executor.submit(debug_depsolver.run)
+        try:
+            depsolver.run()
+        finally:
+            # let the debuginfo depsolver finish even if the binary one failed
+            debug_depsolver.close_whitelist()
+        debug_ft.result()
+
+        out = remap_keys(repos_map, depsolver.export())
+        debug_out = remap_keys(repos_map, debug_depsolver.export())
+    return out, debug_out
 
 
-def _run_modulemd_depsolver(modular_items, repos_map):
-    with ModularDepsolver(modular_items) as depsolver:
+def _run_modulemd_depsolver(
+    modular_items, repos_map, search_context=None, reporter=None
+):
+    with ModularDepsolver(modular_items, search_context) as depsolver:
+        if reporter is not None:
+            reporter.track("modulemd", depsolver.progress)
         depsolver.run()
         out = depsolver.export()
         out["modules_out"] = remap_keys(repos_map, out["modules_out"])
@@ -262,30 +806,43 @@ def _run_modulemd_depsolver(modular_items, repos_map):
 
 def _merge_output_dictionary(out, update):
     """
-    Appends to lists in out.values() instead of overwriting them
-    WARNING: This works correctly only with RpmUnit values
+    Appends to lists in out.values() instead of overwriting them,
+    units already present in out are skipped.
     """
     for key, data in update.items():
         if key in out:
-            filenames = [
-                item.filename
-                for item in out[key]
-                # ModulemdUnits don't have filename attr.
-                if item.isinstance_inner_unit(RpmUnit)
-            ]
-            for item in data:
-                if item.filename not in filenames:
-                    out[key].append(item)
+            present = {unit_identity(item) for item in out[key]}
+            out[key].extend(item for item in data if unit_identity(item) not in present)
         else:
             out[key] = data
 
 
-def _get_population_sources_per_cs(client, repo):
+def _merge_manifest_items(out, update):
+    """
+    Appends manifest items to lists in out.values() instead of overwriting them,
+    items of units already present in out are skipped.
+    """
+    for key, items in update.items():
+        merged = out.setdefault(key, [])
+        present = {_item_identity(item) for item in merged}
+        for item in items:
+            identity = _item_identity(item)
+            if identity not in present:
+                present.add(identity)
+                merged.append(item)
+
+
+def _item_identity(item):
+    return item["unit_type"], item["unit_attr"], item["value"]
+
+
+def _get_population_sources_per_cs(resolver, repo):
     rpm_sources = defaultdict(list)
     debug_sources = defaultdict(list)
-    for repo_id in repo.population_sources:
-        input_rpm_repo = client.get_repository(repo_id)
-        input_debug_repo = input_rpm_repo.get_debug_repository()
+    input_rpm_repos = resolver.get_repositories(repo.population_sources)
+    input_debug_repos = resolver.get_related_repositories(input_rpm_repos, "debug")
+    for input_rpm_repo in input_rpm_repos:
+        input_debug_repo = input_debug_repos[input_rpm_repo.id]
 
         # intentionally using input_rpm_repo.content_set as key in both dictionaries
         rpm_sources[input_rpm_repo.content_set].append(input_rpm_repo)
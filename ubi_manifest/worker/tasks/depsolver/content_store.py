@@ -0,0 +1,126 @@
+"""
+Module for persistent on-disk store of repository content reused across depsolve tasks
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from threading import Lock
+from typing import Dict, List, Optional
+
+from pubtools.pulplib import YumRepository
+
+from .models import UbiUnit
+from .utils import unit_from_dict, unit_to_dict
+
+_LOG = logging.getLogger(__name__)
+
+# directory of the content store, the store is disabled if not set
+CONTENT_STORE_DIR = os.getenv("UBI_MANIFEST_CONTENT_STORE_DIR", "")
+CONTENT_STORE_FILENAME = "content.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    repo_id TEXT PRIMARY KEY,
+    revision TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    repo_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS units_repo_id ON units (repo_id);
+"""
+
+# directory: ContentStore, stores are created once per worker process
+_STORES: Dict[str, "ContentStore"] = {}
+_STORES_LOCK = Lock()
+
+
+class ContentStore:
+    """
+    Sqlite backed store of content of repositories. Content of each repository
+    is stored along with a revision marker of the repository, stored content
+    is returned only if the revision marker is the same as requested.
+    """
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self._path = os.path.join(directory, CONTENT_STORE_FILENAME)
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections can't be shared across threads, every call gets its own
+        return sqlite3.connect(self._path, timeout=60)
+
+    def get(self, repo_id: str, revision: str) -> Optional[List[UbiUnit]]:
+        """
+        Returns stored content of repository or None if the content
+        is missing or stale.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT revision FROM repos WHERE repo_id = ?", (repo_id,)
+            ).fetchone()
+            if row is None or row[0] != revision:
+                return None
+
+            rows = conn.execute(
+                "SELECT data FROM units WHERE repo_id = ?", (repo_id,)
+            ).fetchall()
+
+        _LOG.debug("Loaded %s units of %s from content store", len(rows), repo_id)
+        return [unit_from_dict(json.loads(data)) for (data,) in rows]
+
+    def put(self, repo_id: str, revision: str, units: List[UbiUnit]) -> None:
+        """
+        Replaces stored content of repository with given units.
+        """
+        rows = [(repo_id, json.dumps(unit_to_dict(unit))) for unit in units]
+        with closing(self._connect()) as conn:
+            # commit or rollback the whole replacement at once
+            with conn:
+                conn.execute("DELETE FROM units WHERE repo_id = ?", (repo_id,))
+                conn.executemany(
+                    "INSERT INTO units (repo_id, data) VALUES (?, ?)", rows
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO repos (repo_id, revision, updated) "
+                    "VALUES (?, ?, ?)",
+                    (repo_id, revision, time.time()),
+                )
+
+        _LOG.debug("Stored %s units of %s to content store", len(rows), repo_id)
+
+
+def repo_revision(repo: YumRepository) -> Optional[str]:
+    """
+    Returns revision marker of repository - the last publish time of its
+    distributors. None is returned if the repository was never published.
+    """
+    published = [
+        dist.last_publish for dist in repo.distributors or [] if dist.last_publish
+    ]
+    if not published:
+        return None
+
+    return max(published).isoformat()
+
+
+def get_content_store() -> Optional[ContentStore]:
+    """
+    Returns content store located in CONTENT_STORE_DIR or None if it's not configured.
+    The store is created, along with its schema, only on the first call.
+    """
+    directory = CONTENT_STORE_DIR
+    if not directory:
+        return None
+
+    with _STORES_LOCK:
+        if directory not in _STORES:
+            _STORES[directory] = ContentStore(directory)
+
+        return _STORES[directory]
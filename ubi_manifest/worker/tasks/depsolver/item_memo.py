@@ -0,0 +1,63 @@
+"""
+Module for item-level memoization of depsolve subtasks in redis, so items
+whose inputs didn't change don't have to be depsolved again on the next run
+"""
+import json
+import logging
+from typing import Dict, List, Optional
+
+_LOG = logging.getLogger(__name__)
+
+KEY_PREFIX = "ubi_manifest:depsolve-memo"
+
+
+class ItemMemo:
+    """
+    Redis backed memo of manifest items depsolved by depsolve subtasks. There is
+    one entry for each (ubi repo id, input content set) item holding the fingerprint
+    of inputs the items were depsolved from, the entry is returned only if
+    the fingerprint is the same. Items are always depsolved from scratch
+    when any input changed.
+    """
+
+    def __init__(self, redis_client, ttl: int) -> None:
+        self._redis = redis_client
+        self._ttl = ttl
+
+    @staticmethod
+    def make_key(ubi_repo_id: str, input_cs: str) -> str:
+        """
+        Returns key of entry of given item.
+        """
+        return f"{KEY_PREFIX}:{ubi_repo_id}:{input_cs}"
+
+    def get(
+        self, ubi_repo_id: str, input_cs: str, fingerprint: str
+    ) -> Optional[Dict[str, List[dict]]]:
+        """
+        Returns memoized manifest items of item or None if there are no items
+        or they were depsolved from different inputs.
+        """
+        data = self._redis.get(self.make_key(ubi_repo_id, input_cs))
+        if data is None:
+            return None
+
+        entry = json.loads(data)
+        if entry["fingerprint"] != fingerprint:
+            _LOG.debug("Inputs of %s:%s changed since last run", ubi_repo_id, input_cs)
+            return None
+
+        return entry["result"]
+
+    def put(
+        self,
+        ubi_repo_id: str,
+        input_cs: str,
+        fingerprint: str,
+        result: Dict[str, List[dict]],
+    ) -> None:
+        """
+        Memoizes manifest items of item along with the fingerprint of its inputs.
+        """
+        data = json.dumps({"fingerprint": fingerprint, "result": result})
+        self._redis.set(self.make_key(ubi_repo_id, input_cs), data, ex=self._ttl)
@@ -4,15 +4,20 @@ Module for depsolving modulemds in ubi repositories
 import logging
 import os
 from itertools import chain
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set, Union
 
 from more_executors import Executors
 from more_executors.futures import f_proxy
 from pubtools.pulplib import YumRepository
 
 from .models import ModularDepsolverItem, UbiUnit
-from .pulp_queries import search_modulemd_defaults, search_modulemds
-from .utils import get_criteria_for_modules, get_modulemd_output_set, split_filename
+from .pulp_queries import SearchContext, search_modulemd_defaults, search_modulemds
+from .utils import (
+    get_criteria_for_modules,
+    get_criteria_keys_for_modules,
+    get_modulemd_output_set,
+    split_filename,
+)
 
 _LOG = logging.getLogger(__name__)
 
@@ -24,8 +29,14 @@ class ModularDepsolver:
     Class for depsolving modulemd units
     """
 
-    def __init__(self, modular_items: List[ModularDepsolverItem]) -> None:
+    def __init__(
+        self,
+        modular_items: List[ModularDepsolverItem],
+        search_context: Optional[SearchContext] = None,
+    ) -> None:
         self._modular_items: List[ModularDepsolverItem] = modular_items
+        # state shared by searches of the task running the depsolver
+        self._search_context = search_context
         self._input_repos: List[YumRepository] = list(
             chain.from_iterable(item.in_pulp_repos for item in self._modular_items)
         )
@@ -54,6 +65,11 @@ class ModularDepsolver:
         # set of binary and debuginfo rpm dependencies to be resolved
         self.rpm_dependencies: Set(str) = set()
 
+        # progress of depsolving, see progress()
+        self._phase = "pending"
+        self._iteration = 0
+        self._unsolved = 0
+
     def __enter__(self):
         self._executor.__enter__()
         return self
@@ -61,28 +77,49 @@ class ModularDepsolver:
     def __exit__(self, *args, **kwargs):
         self._executor.__exit__(*args, **kwargs)
 
+    def progress(self) -> Dict[str, Union[str, int]]:
+        """
+        Returns snapshot of progress of depsolving: current phase, number of modular
+        dependencies being searched for, depth of resolution of dependencies and
+        number of modules and modulemd defaults found.
+        """
+        return {
+            "phase": self._phase,
+            "unsolved": self._unsolved,
+            "iteration": self._iteration,
+            "units_fetched": len(self.modules) + len(self.default_modulemds),
+        }
+
     def run(self):
         """
         Run depsolver for each moudular dependency - recursively resolve all of
         its modular dependencies and add binary and debug dependencies to list.
         """
+        self._phase = "resolving"
         for item in self._modular_items:
             modulemds_criteria = get_criteria_for_modules(item.modulelist)
             for module in item.modulelist:
                 self._update_searched_modules(module)
             modules = f_proxy(
                 self._executor.submit(
-                    search_modulemds, modulemds_criteria, item.in_pulp_repos
+                    search_modulemds,
+                    modulemds_criteria,
+                    item.in_pulp_repos,
+                    criteria_keys=get_criteria_keys_for_modules(item.modulelist),
+                    context=self._search_context,
                 )
             )
             # recurrently resolve dependencies for found modules
             self._depsolve_modules(modules)
 
+        self._phase = "done"
+
     def _depsolve_modules(self, modules):
         """
         Update modulemd output set with latest versions of modules, then find
         dependencies for the modules and depsolve them.
         """
+        self._iteration += 1
         filtered_modules = get_modulemd_output_set(modules)
         self.modules.extend(filtered_modules)
 
@@ -94,6 +131,8 @@ class ModularDepsolver:
                     search_modulemd_defaults,
                     modulemd_defaults_criteria,
                     self._input_repos,
+                    criteria_keys=get_criteria_keys_for_modules(filtered_modules),
+                    context=self._search_context,
                 )
             )
         )
@@ -109,12 +148,17 @@ class ModularDepsolver:
                     modules_to_search.append(dependency)
                     self._update_searched_modules(dependency)
 
+        self._unsolved = len(modules_to_search)
         # If there are some unresolved dependencies, get them and depsolve them recursively
         if modules_to_search:
             modulemds_criteria = get_criteria_for_modules(modules_to_search)
             new_modules = f_proxy(
                 self._executor.submit(
-                    search_modulemds, modulemds_criteria, self._input_repos
+                    search_modulemds,
+                    modulemds_criteria,
+                    self._input_repos,
+                    criteria_keys=get_criteria_keys_for_modules(modules_to_search),
+                    context=self._search_context,
                 )
             )
             self._depsolve_modules(new_modules)
@@ -0,0 +1,93 @@
+"""
+Module for periodic reporting of progress of depsolvers running within one task
+"""
+import logging
+import time
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, Optional
+
+_LOG = logging.getLogger(__name__)
+
+
+class ProgressReporter:
+    """
+    Reports progress of the task and of all depsolvers tracked by it, every
+    interval seconds and whenever the phase of the task changes. Progress
+    of each depsolver is a dict returned by its progress() method.
+    """
+
+    def __init__(self, report: Callable[[dict], None], interval: float) -> None:
+        self._report = report
+        self._interval = interval
+        self._lock = Lock()
+        # name: callable returning progress of depsolver
+        self._sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._stopped = Event()
+        self._thread: Optional[Thread] = None
+        self._phase = "planning"
+
+    def track(self, name: str, source: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Includes progress returned by source in reports under given name.
+        """
+        with self._lock:
+            self._sources[name] = source
+
+    def set_phase(self, phase: str) -> None:
+        """
+        Sets phase of the task and reports it right away.
+        """
+        self._phase = phase
+        self.report()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns progress of the task and all tracked depsolvers.
+        """
+        with self._lock:
+            sources = dict(self._sources)
+
+        return {
+            "phase": self._phase,
+            "updated": time.time(),
+            "depsolvers": {name: source() for name, source in sorted(sources.items())},
+        }
+
+    def report(self) -> None:
+        """
+        Reports current progress, failures are only logged, they don't fail the task.
+        """
+        try:
+            self._report(self.snapshot())
+        except Exception:  # pylint: disable=broad-except
+            _LOG.warning("Failed to report progress", exc_info=True)
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._run, name="progress-reporter", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.report()
+
+
+@contextmanager
+def use_progress(reporter: Optional[ProgressReporter]):
+    """
+    Context manager that runs given reporter, if any, while the block is executed.
+    The reporter is passed explicitly to depsolvers of the task, which are tracked
+    by its track() method.
+    """
+    if reporter is not None:
+        reporter.start()
+    try:
+        yield reporter
+    finally:
+        if reporter is not None:
+            reporter.stop()
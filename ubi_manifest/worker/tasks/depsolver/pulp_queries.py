@@ -1,12 +1,46 @@
+import logging
 import os
+import time
+from functools import partial
+from threading import Lock
+from typing import Optional
 
-from more_executors.futures import f_flat_map, f_map, f_proxy, f_return, f_sequence
+import requests
+from more_executors import Executors
+from more_executors.futures import (
+    f_flat_map,
+    f_map,
+    f_proxy,
+    f_return,
+    f_sequence,
+)
 from pubtools.pulplib import Criteria, ModulemdDefaultsUnit, ModulemdUnit, RpmUnit
 
+from . import content_store
 from .models import UbiUnit
-from .utils import flatten_list_of_sets
+from .search_cache import SearchCache
+from .single_flight import SingleFlight, filter_units
+from .utils import flatten_list_of_sets, unit_key
+
+_LOG = logging.getLogger(__name__)
 
 BATCH_SIZE = int(os.getenv("UBI_MANIFEST_BATCH_SIZE", "250"))
+# adjust batch sizes according to observed latency, result size and errors,
+# disabled by default as grown batches may overload pulp
+ADAPTIVE_BATCHING = bool(int(os.getenv("UBI_MANIFEST_ADAPTIVE_BATCHING", "0")))
+# batches taking longer than this are shrunk, much faster ones are grown
+BATCH_TARGET_SECONDS = float(os.getenv("UBI_MANIFEST_BATCH_TARGET_SECONDS", "30"))
+# batches returning more units than this are shrunk
+BATCH_MAX_UNITS = int(os.getenv("UBI_MANIFEST_BATCH_MAX_UNITS", "5000"))
+# batch size may grow up to configured size multiplied by this factor
+BATCH_MAX_GROWTH = int(os.getenv("UBI_MANIFEST_BATCH_MAX_GROWTH", "2"))
+# max depth of splitting of a failed batch into halves
+BATCH_MAX_SPLITS = int(os.getenv("UBI_MANIFEST_BATCH_MAX_SPLITS", "3"))
+# max number of adaptive batch searches issued at once, it shouldn't exceed number
+# of request threads of pulp client so measured latency excludes waiting in its queue
+BATCH_MAX_REQUESTS = int(os.getenv("UBI_MANIFEST_BATCH_MAX_REQUESTS", "4"))
+# max number of concurrent sub-searches of a batch whose results span more pages
+SEARCH_CONCURRENCY = int(os.getenv("UBI_MANIFEST_SEARCH_CONCURRENCY", "4"))
 
 RPM_FIELDS = ["name", "filename", "sourcerpm", "requires", "provides"]
 MODULEMD_FIELDS = [
@@ -26,82 +60,504 @@ UNIT_FIELDS = {
     # using fields limit to query doesn't work for modulemd_defaults unit
 }
 
+# sorted fields identifying a unit within a repository, see unit_identity()
+IDENTITY_FIELDS = {
+    RpmUnit: ("filename",),
+    ModulemdUnit: ("arch", "context", "name", "stream", "version"),
+    ModulemdDefaultsUnit: ("name", "stream"),
+}
+
 
-def _search_units(repo, criteria_list, content_type_cls, batch_size_override=None):
+class SearchContext:
     """
-    Search for units of one content type associated with given repository by criteria.
+    State shared by searches of one task. It's passed explicitly to search functions,
+    so tasks or depsolvers running concurrently in one worker don't share it.
     """
-    units = set()
-    batch_size = batch_size_override or BATCH_SIZE
-    unit_fields = UNIT_FIELDS.get(content_type_cls, None)
+
+    def __init__(self, search_cache: Optional[SearchCache] = None) -> None:
+        # cache of search results shared across tasks, None if disabled
+        self.search_cache = search_cache
+        # registry of searches issued within the task
+        self.single_flight = SingleFlight()
+
+
+class AdaptiveBatchSize:
+    """
+    Batch size for one type of query, it's adjusted according to
+    observed latency, size of results and errors of finished batches.
+    """
+
+    def __init__(self, initial_size: int) -> None:
+        self._max_size = max(initial_size * BATCH_MAX_GROWTH, 1)
+        self._lock = Lock()
+        self.size = initial_size
+
+    def observe(self, batch_len: int, elapsed: float, units_count: int) -> None:
+        """
+        Update batch size according to finished batch, only full-size batches
+        are considered.
+        """
+        with self._lock:
+            if batch_len < self.size:
+                return
+            if elapsed > BATCH_TARGET_SECONDS or units_count > BATCH_MAX_UNITS:
+                self.size = max(self.size * 3 // 4, 1)
+            elif elapsed < BATCH_TARGET_SECONDS / 4:
+                self.size = min(self.size + max(self.size // 4, 1), self._max_size)
+
+    def failed(self, batch_len: int) -> None:
+        """
+        Halve batch size after failed batch.
+        """
+        with self._lock:
+            self.size = max(min(self.size, batch_len) // 2, 1)
+
+
+# (unit type, queried fields, configured batch size): AdaptiveBatchSize
+# sizes are remembered for the whole life of worker process
+_BATCH_SIZES = {}
+_BATCH_SIZES_LOCK = Lock()
+# executor issuing at most BATCH_MAX_REQUESTS adaptive batch searches at once
+_BATCH_REQUESTS = None
+
+
+def _get_batch_size(content_type_cls, query_fields, configured_size):
+    """
+    Returns batch size of searches of given unit type by given fields. Searches
+    by different fields are sized separately, their results may differ in size
+    by orders of magnitude, e.g. rpms searched by name and by provides.name.
+    """
+    with _BATCH_SIZES_LOCK:
+        key = (content_type_cls.__name__, query_fields, configured_size)
+        if key not in _BATCH_SIZES:
+            _BATCH_SIZES[key] = AdaptiveBatchSize(configured_size)
+
+        return _BATCH_SIZES[key]
+
+
+def _get_batch_requests():
+    global _BATCH_REQUESTS  # pylint: disable=global-statement
+    with _BATCH_SIZES_LOCK:
+        if _BATCH_REQUESTS is None:
+            _BATCH_REQUESTS = (
+                Executors.sync(name="ubi-manifest-batch-requests")
+                .with_flat_map(lambda page_f: page_f)
+                .with_throttle(BATCH_MAX_REQUESTS)
+            )
+
+        return _BATCH_REQUESTS
+
+
+def _query_fields(criteria_keys):
+    """
+    Returns fields queried by criteria with given keys, None if they're unknown.
+    """
+    for key in criteria_keys or []:
+        if key is not None:
+            return tuple(field for field, _ in key)
+    return None
+
+
+def _is_overload(exception):
+    """
+    Whether the search failure suggests the batch was too heavy for pulp,
+    i.e. it timed out or pulp responded with a server error.
+    """
+    if isinstance(exception, requests.exceptions.Timeout):
+        return True
+    if isinstance(exception, requests.exceptions.HTTPError):
+        return exception.response is not None and exception.response.status_code >= 500
+    return False
+
+
+def _batch_criteria(criteria_batch, content_type_cls, unit_fields):
+    return Criteria.and_(
+        Criteria.with_unit_type(content_type_cls, unit_fields=unit_fields),
+        Criteria.or_(*criteria_batch),
+    )
+
+
+def _search_batch(
+    repo,
+    criteria_batch,
+    content_type_cls,
+    unit_fields,
+    fan_out=True,
+    page_f=None,
+    criteria_keys=None,
+):
+    """
+    Search for units matching any of criteria in one batch, all pages of results are
+    followed. The first page may be given by page_f if it's already requested.
+
+    Pages of one search can be only fetched one after another. So if results
+    of the batch span more pages, the batch is split into narrower sub-batches
+    (at most SEARCH_CONCURRENCY) that are searched concurrently instead. Criteria
+    whose only unit is already on the first page, known by their criteria_keys,
+    are not searched again. Results are merged with units of the first page,
+    deduplicated by unit_key().
+    """
+    # unit key: unit, shared by pages of the batch and by its sub-batches
+    units_by_key = {}
+
+    def add_units(page):
+        _merge_units(units_by_key, [{UbiUnit(unit, repo.id) for unit in page.data}])
 
     def handle_results(page):
-        for unit in page.data:
-            unit = UbiUnit(unit, repo.id)
-            units.add(unit)
+        add_units(page)
         if page.next:
             return f_flat_map(page.next, handle_results)
+        return f_return(set(units_by_key.values()))
+
+    def handle_first_page(page):
+        if not (
+            page.next and fan_out and min(SEARCH_CONCURRENCY, len(criteria_batch)) > 1
+        ):
+            return handle_results(page)
+
+        # following pages of the whole batch are covered by sub-batches,
+        # units of the first page are reused
+        page.next.cancel()
+        add_units(page)
+        remaining = [
+            criterion
+            for criterion, fields in zip(
+                criteria_batch, criteria_keys or [None] * len(criteria_batch)
+            )
+            if not _is_answered(fields, content_type_cls, units_by_key.values())
+        ]
+        concurrency = min(SEARCH_CONCURRENCY, len(remaining))
+        fts = [
+            _search_batch(
+                repo,
+                remaining[idx::concurrency],
+                content_type_cls,
+                unit_fields,
+                False,
+            )
+            for idx in range(concurrency)
+        ]
+        return f_map(f_sequence(fts), partial(_merge_units, units_by_key))
+
+    if page_f is None:
+        page_f = repo.search_content(
+            _batch_criteria(criteria_batch, content_type_cls, unit_fields)
+        )
+    return f_flat_map(page_f, handle_first_page)
+
+
+def _is_answered(fields, content_type_cls, units):
+    """
+    Whether all units matching criterion given by its (field, value) pairs are
+    among given units. That's known only for criteria on fields identifying a unit,
+    e.g. filename of rpm, which match at most one unit of a repository.
+    """
+    if fields is None:
+        return False
+    identity_fields = IDENTITY_FIELDS.get(content_type_cls)
+    if tuple(field for field, _ in fields) != identity_fields:
+        return False
+    return bool(filter_units(units, [fields]))
+
+
+def _merge_units(units_by_key, list_of_sets):
+    """
+    Merges units of sub-batches into units_by_key, unit matching criteria
+    of more sub-batches is kept only once.
+    """
+    for units in list_of_sets:
+        for unit in units:
+            units_by_key.setdefault(unit_key(unit), unit)
+
+    return set(units_by_key.values())
+
+
+def _search_batch_adaptive(
+    repo,
+    criteria_batch,
+    content_type_cls,
+    unit_fields,
+    batch_size,
+    depth=0,
+    criteria_keys=None,
+):
+    """
+    Search for one batch and update batch size according to the outcome.
+    Batch failed due to overload of pulp is split in halves which are retried
+    separately, up to BATCH_MAX_SPLITS times.
+    """
+    # latency of the first request of the batch, measured from the moment
+    # it's actually issued
+    latency = []
+
+    def search_first_page():
+        start = time.monotonic()
+
+        def timed(page):
+            latency.append(time.monotonic() - start)
+            return page
+
+        return f_map(
+            repo.search_content(
+                _batch_criteria(criteria_batch, content_type_cls, unit_fields)
+            ),
+            timed,
+        )
+
+    def on_success(units):
+        batch_size.observe(len(criteria_batch), latency[0], len(units))
         return f_return(units)
 
-    criteria_split = []
+    def on_error(exception):
+        if not _is_overload(exception):
+            raise exception
 
-    for start in range(0, len(criteria_list), batch_size):
-        criteria_split.append(criteria_list[start : start + batch_size])
-    fts = []
+        batch_size.failed(len(criteria_batch))
+        if len(criteria_batch) == 1 or depth >= BATCH_MAX_SPLITS:
+            raise exception
+
+        _LOG.warning(
+            "Search for batch of %s criteria in %s failed, retrying in halves: %s",
+            len(criteria_batch),
+            repo.id,
+            exception,
+        )
+        half = len(criteria_batch) // 2
+        keys = criteria_keys or [None] * len(criteria_batch)
+        fts = [
+            _search_batch_adaptive(
+                repo,
+                criteria_batch[part],
+                content_type_cls,
+                unit_fields,
+                batch_size,
+                depth + 1,
+                keys[part],
+            )
+            for part in (slice(None, half), slice(half, None))
+        ]
+        return f_map(f_sequence(fts), flatten_list_of_sets)
+
+    page_f = _get_batch_requests().submit(search_first_page)
+    units_f = _search_batch(
+        repo,
+        criteria_batch,
+        content_type_cls,
+        unit_fields,
+        page_f=page_f,
+        criteria_keys=criteria_keys,
+    )
+    # mapped futures are flattened separately, flat_map would call on_error again
+    # with the error of the future returned by on_error
+    return f_flat_map(f_map(units_f, on_success, error_fn=on_error), lambda ft: ft)
+
+
+def _search_units(
+    repo,
+    criteria_list,
+    content_type_cls,
+    batch_size_override=None,
+    adaptive=True,
+    criteria_keys=None,
+    search_cache=None,
+):
+    """
+    Search for units of one content type associated with given repository by criteria.
+    Listings of all units should be searched with adaptive=False, they don't tell
+    anything about the cost of batches. Criteria with known keys are looked up
+    in given search cache one by one, only the missing ones are searched in pulp.
+    """
+    batch_size = batch_size_override or BATCH_SIZE
+    unit_fields = UNIT_FIELDS.get(content_type_cls, None)
+
+    adaptive_size = None
+    if ADAPTIVE_BATCHING and adaptive:
+        adaptive_size = _get_batch_size(
+            content_type_cls, _query_fields(criteria_keys), batch_size
+        )
+        batch_size = adaptive_size.size
 
-    for criteria_batch in criteria_split:
-        _criteria = Criteria.and_(
-            Criteria.with_unit_type(content_type_cls, unit_fields=unit_fields),
-            Criteria.or_(*criteria_batch),
+    fts = []
+    # (criterion, cache key, criterion key) of criteria to be searched in pulp
+    to_search = [
+        (criterion, None, fields)
+        for criterion, fields in zip(
+            criteria_list, criteria_keys or [None] * len(criteria_list)
         )
+    ]
+
+    if search_cache is not None and criteria_keys is not None:
+        search_cache.check_revision(repo.id, content_store.repo_revision(repo))
+        to_search = [
+            (
+                criterion,
+                search_cache.make_key(repo.id, fields, content_type_cls, unit_fields)
+                if fields is not None
+                else None,
+                fields,
+            )
+            for criterion, _, fields in to_search
+        ]
+        cached = search_cache.get_many([key for _, key, _ in to_search if key])
+        fts.extend(f_return(units) for units in cached.values())
+        to_search = [item for item in to_search if item[1] not in cached]
 
-        page_f = repo.search_content(_criteria)
-        handled_f = f_flat_map(page_f, handle_results)
+    for start in range(0, len(to_search), batch_size):
+        batch = to_search[start : start + batch_size]
+        criteria_batch = [criterion for criterion, _, _ in batch]
+        batch_keys = [fields for _, _, fields in batch]
+
+        if adaptive_size is not None:
+            handled_f = _search_batch_adaptive(
+                repo,
+                criteria_batch,
+                content_type_cls,
+                unit_fields,
+                adaptive_size,
+                criteria_keys=batch_keys,
+            )
+        else:
+            handled_f = _search_batch(
+                repo,
+                criteria_batch,
+                content_type_cls,
+                unit_fields,
+                criteria_keys=batch_keys,
+            )
+
+        cache_entries = [(key, fields) for _, key, fields in batch if key]
+        if cache_entries:
+            handled_f = f_map(
+                handled_f,
+                partial(_store_in_cache, search_cache, repo.id, cache_entries),
+            )
 
         fts.append(handled_f)
 
-    return f_map(f_sequence(fts), flatten_list_of_sets)
+    # unit matching more criteria may be found in more cache entries
+    return f_map(f_sequence(fts), partial(_merge_units, {}))
+
+
+def _store_in_cache(search_cache, repo_id, cache_entries, units):
+    # units of the batch are split to entries of criteria they match
+    search_cache.set_many(
+        repo_id,
+        {key: filter_units(units, [fields]) for key, fields in cache_entries},
+    )
+    return units
 
 
 def _search_units_per_repos(
-    or_criteria, repos, content_type_cls, batch_size_override=None
+    or_criteria,
+    repos,
+    content_type_cls,
+    batch_size_override=None,
+    adaptive=True,
+    criteria_keys=None,
+    context=None,
 ):
+    search_cache, single_flight = None, None
+    if context is not None:
+        search_cache = context.search_cache
+        # only searches with known criteria keys can be shared
+        if criteria_keys is not None:
+            single_flight = context.single_flight
     units = []
     for repo in repos:
-        units.append(
-            _search_units(
-                repo,
-                or_criteria,
-                content_type_cls,
-                batch_size_override=batch_size_override,
-            )
+        search_fn = partial(
+            _search_units,
+            repo,
+            content_type_cls=content_type_cls,
+            batch_size_override=batch_size_override,
+            adaptive=adaptive,
+            search_cache=search_cache,
         )
+        if single_flight is not None:
+            units.append(
+                single_flight.search(
+                    repo.id, or_criteria, criteria_keys, content_type_cls, search_fn
+                )
+            )
+        else:
+            units.append(search_fn(or_criteria, criteria_keys=criteria_keys))
 
     return f_proxy(f_map(f_sequence(units), flatten_list_of_sets))
 
 
-def search_modulemds(or_criteria, repos, batch_size_override=None):
+def search_modulemds(
+    or_criteria, repos, batch_size_override=None, criteria_keys=None, context=None
+):
     return _search_units_per_repos(
         or_criteria,
         repos,
         content_type_cls=ModulemdUnit,
         batch_size_override=batch_size_override,
+        criteria_keys=criteria_keys,
+        context=context,
     )
 
 
-def search_rpms(or_criteria, repos, batch_size_override=None):
+def _search_all(repos, content_type_cls):
+    return _search_units_per_repos(
+        [Criteria.true()], repos, content_type_cls=content_type_cls, adaptive=False
+    )
+
+
+def search_all_modulemds(repos):
+    """
+    Search for all modulemds in given repositories.
+    """
+    return _search_all(repos, ModulemdUnit)
+
+
+def search_rpms(
+    or_criteria, repos, batch_size_override=None, criteria_keys=None, context=None
+):
+    """
+    Search for rpms matching any of criteria in given repositories. If criteria_keys
+    of the criteria are given, identical searches sharing given SearchContext
+    are coalesced and results are cached in its search cache.
+    """
     return _search_units_per_repos(
         or_criteria,
         repos,
         content_type_cls=RpmUnit,
         batch_size_override=batch_size_override,
+        criteria_keys=criteria_keys,
+        context=context,
     )
 
 
-def search_modulemd_defaults(or_criteria, repos, batch_size_override=None):
+def search_modulemd_defaults(
+    or_criteria, repos, batch_size_override=None, criteria_keys=None, context=None
+):
     return _search_units_per_repos(
         or_criteria,
         repos,
         content_type_cls=ModulemdDefaultsUnit,
         batch_size_override=batch_size_override,
+        criteria_keys=criteria_keys,
+        context=context,
     )
+
+
+def search_all_rpms(repo):
+    """
+    Search for all rpms in given repository. If the content store is configured,
+    content is read from the store unless it's stale, otherwise it's queried from
+    pulp and the store is refreshed.
+    """
+    store = content_store.get_content_store()
+    revision = content_store.repo_revision(repo)
+    if store is None or revision is None:
+        return _search_all([repo], RpmUnit)
+
+    units = store.get(repo.id, revision)
+    if units is not None:
+        return f_proxy(f_return(set(units)))
+
+    def refresh_store(units):
+        store.put(repo.id, revision, list(units))
+        return units
+
+    return f_proxy(f_map(_search_all([repo], RpmUnit), refresh_store))
@@ -0,0 +1,149 @@
+"""
+Module for resolving repositories and their related repositories in batches
+"""
+import logging
+import os
+import re
+import time
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pubtools.pulplib import Criteria, Matcher, YumRepository
+
+_LOG = logging.getLogger(__name__)
+
+# relations of repositories are cached across tasks for this number of seconds,
+# the cache is disabled if set to 0
+REPO_CACHE_TTL = int(os.getenv("UBI_MANIFEST_REPO_CACHE_TTL", "0"))
+
+# suffixes of relative urls of repositories within one group,
+# the same as used by YumRepository.get_*_repository()
+RELATED_SUFFIXES = {
+    "binary": "/os",
+    "debug": "/debug",
+    "source": "/source/SRPMS",
+}
+_SUFFIX_REGEX = r"(/os|/source/SRPMS|/debug)$"
+
+# (repo id, repo type): (related repo id or None, expiration time)
+_RELATIONS_CACHE: Dict[Tuple[str, str], Tuple[Optional[str], float]] = {}
+_RELATIONS_CACHE_LOCK = Lock()
+
+
+def _get_cached_relation(key):
+    with _RELATIONS_CACHE_LOCK:
+        cached = _RELATIONS_CACHE.get(key)
+        if cached is None or cached[1] < time.monotonic():
+            return False, None
+        return True, cached[0]
+
+
+def _cache_relation(key, related_id):
+    with _RELATIONS_CACHE_LOCK:
+        _RELATIONS_CACHE[key] = (related_id, time.monotonic() + REPO_CACHE_TTL)
+
+
+class RepositoryResolver:
+    """
+    Resolves repositories by ids and their binary/debug/source related repositories.
+    Missing repositories are always fetched from pulp in one batch and all resolved
+    repositories are cached for the whole life of the resolver, which is meant to be
+    one task. Only relations between repositories are cached across tasks, as
+    repository objects are bound to the client of the task.
+    """
+
+    def __init__(self, client) -> None:
+        self._client = client
+        self._repos: Dict[str, YumRepository] = {}
+        # (repo id, repo type): related repo id or None
+        self._relations: Dict[Tuple[str, str], Optional[str]] = {}
+
+    def get_repositories(self, repo_ids: Iterable[str]) -> List[YumRepository]:
+        """
+        Returns repositories with given ids, the ones that are not cached
+        yet are fetched in one search.
+        """
+        repo_ids = list(repo_ids)
+        missing = sorted(set(repo_ids) - set(self._repos))
+        if missing:
+            _LOG.debug("Fetching %s repositories", len(missing))
+            page = self._client.search_repository(Criteria.with_id(missing)).result()
+            for repo in page:
+                self._repos[repo.id] = repo
+
+        not_found = [repo_id for repo_id in repo_ids if repo_id not in self._repos]
+        if not_found:
+            raise ValueError(f"Repositories not found: {', '.join(not_found)}")
+
+        return [self._repos[repo_id] for repo_id in repo_ids]
+
+    def get_repository(self, repo_id: str) -> YumRepository:
+        """
+        Returns repository with given id.
+        """
+        return self.get_repositories([repo_id])[0]
+
+    def get_related_repositories(
+        self, repos: Iterable[YumRepository], repo_type: str
+    ) -> Dict[str, Optional[YumRepository]]:
+        """
+        Returns mapping of repo id to its related repository of given type
+        ('binary', 'debug' or 'source') or None if there is no such repository.
+        Relations that are not known yet are searched for in one distributor search.
+        """
+        repos = list(repos)
+        suffix = RELATED_SUFFIXES[repo_type]
+        # relative url of related repo: ids of repos waiting for it
+        wanted_urls: Dict[str, List[str]] = {}
+
+        for repo in repos:
+            key = (repo.id, repo_type)
+            if key in self._relations:
+                continue
+
+            relative_url = str(repo.relative_url or "")
+            if relative_url.endswith(suffix):
+                self._relations[key] = repo.id
+                continue
+
+            found, related_id = _get_cached_relation(key)
+            if found:
+                self._relations[key] = related_id
+                continue
+
+            url = re.sub(_SUFFIX_REGEX, "", relative_url) + suffix
+            wanted_urls.setdefault(url, []).append(repo.id)
+
+        if wanted_urls:
+            self._search_relations(wanted_urls, repo_type)
+
+        related_ids = {repo.id: self._relations[(repo.id, repo_type)] for repo in repos}
+        self.get_repositories({_id for _id in related_ids.values() if _id})
+
+        return {
+            repo_id: self._repos[related_id] if related_id else None
+            for repo_id, related_id in related_ids.items()
+        }
+
+    def _search_relations(self, wanted_urls, repo_type):
+        criteria = Criteria.and_(
+            Criteria.with_field("relative_url", Matcher.in_(sorted(wanted_urls))),
+            Criteria.with_field("type_id", "yum_distributor"),
+        )
+        page = self._client.search_distributor(criteria).result()
+
+        found_ids: Dict[str, List[str]] = {}
+        for distributor in page:
+            found_ids.setdefault(distributor.relative_url, []).append(
+                distributor.repo_id
+            )
+
+        for url, repo_ids in wanted_urls.items():
+            # relation is ambiguous if there are more matching distributors
+            candidates = found_ids.get(url) or []
+            related_id = candidates[0] if len(candidates) == 1 else None
+            for repo_id in repo_ids:
+                key = (repo_id, repo_type)
+                self._relations[key] = related_id
+                if REPO_CACHE_TTL:
+                    _cache_relation(key, related_id)
@@ -1,18 +1,37 @@
 import logging
 import os
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from collections import defaultdict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import partial
 from itertools import chain
-from typing import List, Set
+from queue import Queue
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Set, Union
 
 from more_executors import Executors
-from more_executors.futures import f_proxy
-from pubtools.pulplib import Criteria, YumRepository
+from more_executors.futures import f_flat_map, f_map, f_proxy, f_return, f_sequence
+from pubtools.pulplib import YumRepository
 
 from .models import DepsolverItem, UbiUnit
-from .pulp_queries import search_modulemds, search_rpms
+from .pulp_queries import (
+    SearchContext,
+    search_all_modulemds,
+    search_all_rpms,
+    search_rpms,
+)
+from .snapshot import RepoSnapshot
 from .utils import (
     _is_blacklisted,
+    copy_outcome,
     create_or_criteria,
+    criteria_keys,
+    flatten_list_of_sets,
     get_n_latest_from_content,
     is_requirement_resolved,
     parse_bool_deps,
@@ -27,6 +46,13 @@ BATCH_SIZE_RPM = int(os.getenv("UBI_MANIFEST_BATCH_SIZE_RPM", "25"))
 BATCH_SIZE_RPM_SPECIFIC = int(os.getenv("UBI_MANIFEST_BATCH_SIZE_RPM_SPECIFIC", "500"))
 BATCH_SIZE_RESOLVER = int(os.getenv("UBI_MANIFEST_BATCH_SIZE_RESOLVER", "150"))
 MAX_WORKERS = int(os.getenv("UBI_MANIFEST_DEPSOLVER_WORKERS", "8"))
+# max number of what_provides batches being resolved at once
+MAX_BATCHES_IN_FLIGHT = int(
+    os.getenv("UBI_MANIFEST_DEPSOLVER_BATCHES_IN_FLIGHT", str(MAX_WORKERS // 2))
+)
+# download whole content of input repos once and depsolve locally instead of
+# querying pulp for each batch of requirements
+SNAPSHOT_MODE = bool(int(os.getenv("UBI_MANIFEST_DEPSOLVER_SNAPSHOT", "0")))
 
 
 class Depsolver:
@@ -34,18 +60,28 @@ class Depsolver:
         self,
         repos: List[DepsolverItem],
         srpm_repos,
-        modulemd_dependencies: Set[str],
+        modulemd_dependencies: Union[Set[str], Future],
+        search_context: Optional[SearchContext] = None,
         **kwargs,
     ) -> None:
         self.repos: List[DepsolverItem] = repos
-        self.modulemd_dependencies: Set[str] = modulemd_dependencies
+        # modulemd dependencies can be passed as a future of set of filenames,
+        # so that the modulemd depsolver can run concurrently
+        if not isinstance(modulemd_dependencies, Future):
+            modulemd_dependencies = f_return(modulemd_dependencies)
+        self.modulemd_dependencies: Future = modulemd_dependencies
         self.output_set: Set[UbiUnit] = set()
         self.srpm_output_set: Set[UbiUnit] = set()
 
         self._srpm_repos: List[Future[YumRepository]] = srpm_repos
+        # state shared by searches of the task running the depsolver
+        self._search_context = search_context
 
         self._provides: Set = set()  # set of all rpm.provides we've visited
         self._requires: Set = set()  # set of all rpm.requires we've visited
+        # index of visited provides - name: list of provides with that name,
+        # it's updated incrementally as new content comes in
+        self._provides_index: Dict[str, List] = defaultdict(list)
 
         # set of solvables (pkg, lib, ...) that we use for checking remaining requires
         self._unsolved: Set = set()
@@ -58,12 +94,91 @@ class Depsolver:
         )
         self._base_pkgs_only = kwargs.get("base_pkgs_only") or False
 
+        self._snapshot_mode = kwargs.get("snapshot", SNAPSHOT_MODE)
+        # repo_id: Future[RepoSnapshot]
+        self._snapshots: Dict[str, Future] = {}
+        self._snapshots_lock = Lock()
+
+        # callbacks called with binary rpms added to the output set
+        self._subscribers: List[Callable[[Set[UbiUnit]], None]] = []
+        # names of packages found by whitelist
+        self._base_pkg_names: Set[str] = set()
+        # if open, whitelists may be extended while running, see extend_whitelist()
+        self._whitelist_feed: Optional[Queue] = (
+            Queue() if kwargs.get("open_whitelist") else None
+        )
+
+        # progress of depsolving, see progress()
+        self._progress_lock = Lock()
+        self._phase = "pending"
+        self._iteration = 0
+        self._queries_in_flight = 0
+        self._units_fetched = 0
+
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
         self._executor.__exit__(*args, **kwargs)
 
+    def subscribe(self, callback: Callable[[Set[UbiUnit]], None]) -> None:
+        """
+        Register callback that is called with binary rpms as soon as they're
+        added to the output set. Callbacks are called from the thread running run().
+        """
+        self._subscribers.append(callback)
+
+    def extend_whitelist(self, item: DepsolverItem, pkg_names: Set[str]) -> None:
+        """
+        Add packages to whitelist of item while the depsolver is running.
+        Depsolver has to be created with open_whitelist=True, run() then
+        doesn't finish until close_whitelist() is called.
+        """
+        if self._whitelist_feed is None:
+            raise RuntimeError("Whitelist of the depsolver is not open")
+
+        self._whitelist_feed.put((item, set(pkg_names)))
+
+    def close_whitelist(self) -> None:
+        """
+        Signal that no more packages will be added to whitelists.
+        """
+        if self._whitelist_feed is not None:
+            self._whitelist_feed.put(None)
+
+    def progress(self) -> Dict[str, Union[str, int]]:
+        """
+        Returns snapshot of progress of depsolving: current phase, number of
+        unsolved requirements, number of resolved batches of requirements,
+        number of rpm queries in flight and number of units fetched by them.
+        """
+        with self._progress_lock:
+            return {
+                "phase": self._phase,
+                "unsolved": len(self._unsolved),
+                "iteration": self._iteration,
+                "queries_in_flight": self._queries_in_flight,
+                "units_fetched": self._units_fetched,
+            }
+
+    def _track_query(self, ft):
+        with self._progress_lock:
+            self._queries_in_flight += 1
+        ft.add_done_callback(self._query_done)
+        return ft
+
+    def _query_done(self, ft):
+        with self._progress_lock:
+            self._queries_in_flight -= 1
+            if ft.exception() is None:
+                self._units_fetched += len(ft.result())
+
+    def _add_to_output(self, units):
+        self.output_set.update(units)
+        if units:
+            for callback in self._subscribers:
+                callback(set(units))
+
     def _get_pkgs_from_all_modules(self, repos):
         # search for modulemds in all input repos
         # and extract filenames only
@@ -74,15 +189,59 @@ class Depsolver:
 
             return modular_rpm_filenames
 
-        modules = search_modulemds([Criteria.true()], repos)
+        modules = search_all_modulemds(repos)
         return f_proxy(self._executor.submit(extract_modular_filenames))
 
-    def get_base_packages(self, repos, pkgs_list, blacklist):
-        crit = create_or_criteria(["name"], [(rpm,) for rpm in pkgs_list])
+    def _get_snapshot(self, repo):
+        with self._snapshots_lock:
+            snapshot_ft = self._snapshots.get(repo.id)
+            if snapshot_ft is not None:
+                return snapshot_ft
+            # registered before loading, concurrent callers wait for this load
+            snapshot_ft = self._snapshots[repo.id] = Future()
+
+        # content may be loaded from the content store synchronously, it's done
+        # outside the lock so that snapshots of other repos are loaded concurrently
+        try:
+            loaded_ft = f_map(search_all_rpms(repo), RepoSnapshot)
+        except Exception as exception:
+            snapshot_ft.set_exception(exception)
+            raise
+        loaded_ft.add_done_callback(partial(copy_outcome, snapshot_ft))
+        return snapshot_ft
+
+    def _search_rpms(self, field, values, repos, batch_size):
+        """
+        Search for rpms in given repos whose field matches any of values.
+        In snapshot mode the search is done locally on snapshots of repos.
+        """
+        if self._snapshot_mode:
+            snapshots_ft = f_sequence([self._get_snapshot(repo) for repo in repos])
+            return self._track_query(
+                f_proxy(
+                    f_map(
+                        snapshots_ft,
+                        lambda snapshots: flatten_list_of_sets(
+                            [snapshot.search(field, values) for snapshot in snapshots]
+                        ),
+                    )
+                )
+            )
 
-        content = f_proxy(
-            self._executor.submit(search_rpms, crit, repos, BATCH_SIZE_RPM)
+        fields, values = [field], [(value,) for value in values]
+        crit = create_or_criteria(fields, values)
+        return self._track_query(
+            search_rpms(
+                crit,
+                repos,
+                batch_size,
+                criteria_keys(fields, values),
+                context=self._search_context,
+            )
         )
+
+    def get_base_packages(self, repos, pkgs_list, blacklist):
+        content = self._search_rpms("name", pkgs_list, repos, BATCH_SIZE_RPM)
         newest_rpms = get_n_latest_from_content(content, blacklist, self._modular_rpms)
         return newest_rpms
 
@@ -90,19 +249,35 @@ class Depsolver:
         """
         Search for modulemd dependencies
         """
-        crit = create_or_criteria(["filename"], [(rpm,) for rpm in pkgs_list])
-
-        content = f_proxy(
-            self._executor.submit(search_rpms, crit, repos, BATCH_SIZE_RPM_SPECIFIC)
+        content = self._search_rpms(
+            "filename", pkgs_list, repos, BATCH_SIZE_RPM_SPECIFIC
         )
         return content
 
+    def _get_modulemd_deps_packages(self, repos, source, modulemd_dependencies):
+        """
+        Search for either binary or source rpms of modulemd dependencies
+        """
+        filenames = {
+            item
+            for item in modulemd_dependencies or []
+            if (".src.rpm" in item) == source
+        }
+        if not filenames:
+            return f_return(set())
+
+        return self.get_modulemd_packages(repos, filenames)
+
     def extract_and_resolve(self, content):
         """
         Extracts provides and requires from content and sets internal
         state of self accordingly.
+
+        Only the new requires and the new provides are matched against
+        the capability index, previously visited ones are already resolved.
         """
         _requires = set()
+        new_provides = defaultdict(list)
         for rpm in content:
             for item in rpm.requires:
                 # skip scriplet requires
@@ -115,23 +290,35 @@ class Depsolver:
                     _requires.add(item)
 
             for item in rpm.provides:
-                # add to global provides
+                if item in self._provides:
+                    continue
+                # add to global provides and to the index
                 self._provides.add(item)
+                self._provides_index[item.name].append(item)
+                new_provides[item.name].append(item)
 
         # update global requires
         self._requires |= _requires
-        # add new requires to unsolved
-        self._unsolved |= _requires
 
-        for prov in self._provides:
-            solved = set()
-            for req in self._unsolved:
-                if prov.name != req.name:
-                    continue
-                if is_requirement_resolved(req, prov):
-                    solved.add(req)
+        # match new requires against all provides we've visited so far
+        for req in _requires:
+            if not self._is_provided(req, self._provides_index):
+                self._unsolved.add(req)
+
+        # match remaining unsolved requires against new provides only
+        if new_provides:
+            solved = {
+                req for req in self._unsolved if self._is_provided(req, new_provides)
+            }
             self._unsolved -= solved
 
+    @staticmethod
+    def _is_provided(requirement, provides_index):
+        for prov in provides_index.get(requirement.name) or []:
+            if is_requirement_resolved(requirement, prov):
+                return True
+        return False
+
     def what_provides(self, list_of_requires, repos, blacklist):
         """
         Get the latest rpms that provides requirements from list_of_requires in given repos
@@ -139,26 +326,22 @@ class Depsolver:
         # TODO this may pull more than more packages (with different names)
         # for given requirement. It should be decided which one should get into
         # the output. Currently we'll get all matching the query.
-        crit = create_or_criteria(
-            ["provides.name"], [(item.name,) for item in list_of_requires]
-        )
-
-        content = f_proxy(
-            self._executor.submit(search_rpms, crit, repos, BATCH_SIZE_RPM)
+        content = self._search_rpms(
+            "provides.name",
+            [item.name for item in list_of_requires],
+            repos,
+            BATCH_SIZE_RPM,
         )
         newest_rpms = get_n_latest_from_content(content, blacklist, self._modular_rpms)
 
         return newest_rpms
 
     def get_source_pkgs(self, binary_rpms, blacklist):
-        crit = create_or_criteria(
-            ["filename"], [(rpm.sourcerpm,) for rpm in binary_rpms if rpm.sourcerpm]
-        )
-
-        content = f_proxy(
-            self._executor.submit(
-                search_rpms, crit, self._srpm_repos, BATCH_SIZE_RPM_SPECIFIC
-            )
+        content = self._search_rpms(
+            "filename",
+            [rpm.sourcerpm for rpm in binary_rpms if rpm.sourcerpm],
+            self._srpm_repos,
+            BATCH_SIZE_RPM_SPECIFIC,
         )
 
         return {rpm for rpm in content if not _is_blacklisted(rpm, blacklist)}
@@ -173,7 +356,13 @@ class Depsolver:
             C. request new content that provides remaining requirements
             D. content that provides requirements is added to self.output_set
         3. During phase 1. and 2. source RPM packages are queried for already acquired RPMS.
+        4. If whitelist is open, phases 1. and 2. are repeated for packages added
+           by extend_whitelist() until close_whitelist() is called.
+
+        In snapshot mode, whole rpm content of each repo is downloaded once
+        and all the queries above are done locally on the snapshots.
         """
+        self._phase = "base_packages"
         pulp_repos = list(
             chain.from_iterable([repo.in_pulp_repos for repo in self.repos])
         )
@@ -194,68 +383,41 @@ class Depsolver:
             for repo in self.repos
         ]
 
-        source_rpm_fts = []
-
-        if self.modulemd_dependencies:
-            # Divide modular dependencies into binary and modular rpms
-            binary_modular_deps = set()
-            source_modular_deps = set()
-            for item in self.modulemd_dependencies:
-                if ".src.rpm" in item:
-                    source_modular_deps.add(item)
-                else:
-                    binary_modular_deps.add(item)
+        # modular dependencies may be still being depsolved, their rpms
+        # are searched for as soon as they're available
+        content_fts.append(
+            f_flat_map(
+                self.modulemd_dependencies,
+                partial(self._get_modulemd_deps_packages, pulp_repos, False),
+            )
+        )
+        source_rpm_fts = [
+            f_flat_map(
+                self.modulemd_dependencies,
+                partial(self._get_modulemd_deps_packages, self._srpm_repos, True),
+            )
+        ]
 
-            # Get moduelmd binary rpm dependencies
-            if binary_modular_deps:
-                content_fts.append(
-                    self._executor.submit(
-                        self.get_modulemd_packages, pulp_repos, binary_modular_deps
-                    )
-                )
+        base_content, base_source_rpm_fts = self._add_base_content(
+            content_fts, merged_blacklist
+        )
+        source_rpm_fts.extend(base_source_rpm_fts)
 
-            # Get modulemd source rpm dependencies
-            if source_modular_deps:
-                source_rpm_fts.append(
-                    self._executor.submit(
-                        self.get_modulemd_packages,
-                        self._srpm_repos,
-                        source_modular_deps,
-                    )
-                )
+        if not self._base_pkgs_only:
+            self._phase = "resolving"
+            source_rpm_fts.extend(
+                self._resolve(base_content, pulp_repos, merged_blacklist)
+            )
 
-        for content in as_completed(content_fts):
-            self.output_set.update(content.result())
-            ft = self._executor.submit(
-                self.get_source_pkgs, content.result(), merged_blacklist
+        if self._whitelist_feed is not None:
+            self._phase = "extending_whitelist"
+            source_rpm_fts.extend(
+                self._consume_whitelist_feed(pulp_repos, merged_blacklist)
             )
-            source_rpm_fts.append(ft)
 
         self._log_missing_base_pkgs()
 
-        to_resolve = set(self.output_set)
-        while True and not self._base_pkgs_only:
-            # extract provides and requires
-            self.extract_and_resolve(to_resolve)
-            # we are finished if _ensolved is empty
-            if not self._unsolved:
-                break
-
-            batch = []
-            # making batch as the query for provides.name in rpm units is slow in general
-            # we'll better do it is smaller batches
-            for _ in range(self._batch_size()):
-                batch.append(self._unsolved.pop())
-            # get new content that provides current batch of requires
-            resolved = self.what_provides(batch, pulp_repos, merged_blacklist)
-            # new content needs resolving deps
-            to_resolve = set(resolved)
-            # add contetnt to the output set
-            self.output_set.update(resolved)
-            # submit query for source rpms
-            ft = self._executor.submit(self.get_source_pkgs, resolved, merged_blacklist)
-            source_rpm_fts.append(ft)
-
+        self._phase = "source_rpms"
         # wait for srpm queries and store them the output set
         for srpm_content in as_completed(source_rpm_fts):
             for srpm in srpm_content.result():
@@ -269,6 +431,129 @@ class Depsolver:
             if deps_not_found:
                 self._log_warnings(deps_not_found, pulp_repos, merged_blacklist)
 
+        self._phase = "done"
+
+    def _add_base_content(self, content_fts, merged_blacklist):
+        """
+        Add content of finished base package queries to the output set
+        and query source rpms for it.
+
+        Returns the added content and list of futures of source rpm queries.
+        """
+        added = set()
+        source_rpm_fts = []
+        for content in as_completed(content_fts):
+            units = content.result()
+            added.update(units)
+            self._base_pkg_names.update(unit.name for unit in units)
+            self._add_to_output(units)
+            ft = self._executor.submit(self.get_source_pkgs, units, merged_blacklist)
+            source_rpm_fts.append(ft)
+
+        return added, source_rpm_fts
+
+    def _consume_whitelist_feed(self, pulp_repos, merged_blacklist):
+        """
+        Depsolve packages added by extend_whitelist() until close_whitelist()
+        is called. Packages added meanwhile are searched for together.
+
+        Returns list of futures of source rpm queries.
+        """
+        source_rpm_fts = []
+        closed = False
+        while not closed:
+            entries = [self._whitelist_feed.get()]
+            while not self._whitelist_feed.empty():
+                entries.append(self._whitelist_feed.get())
+
+            # id(item): (item, new package names)
+            new_names = {}
+            for entry in entries:
+                if entry is None:
+                    closed = True
+                    continue
+                item, pkg_names = entry
+                pkg_names = pkg_names - item.whitelist
+                item.whitelist.update(pkg_names)
+                new_names.setdefault(id(item), (item, set()))[1].update(pkg_names)
+
+            content_fts = [
+                self._executor.submit(
+                    self.get_base_packages,
+                    item.in_pulp_repos,
+                    pkg_names,
+                    item.blacklist,
+                )
+                for item, pkg_names in new_names.values()
+                if pkg_names
+            ]
+
+            content, base_source_rpm_fts = self._add_base_content(
+                content_fts, merged_blacklist
+            )
+            source_rpm_fts.extend(base_source_rpm_fts)
+            if content and not self._base_pkgs_only:
+                source_rpm_fts.extend(
+                    self._resolve(content, pulp_repos, merged_blacklist)
+                )
+
+        return source_rpm_fts
+
+    def _resolve(self, to_resolve, pulp_repos, merged_blacklist):
+        """
+        Resolve dependencies of to_resolve content. Several what_provides batches
+        are kept in flight at once, results of each batch are fed back to the
+        unsolved requirements as soon as the batch completes. Runs until there
+        is nothing unsolved and nothing pending.
+
+        Returns list of futures of source rpm queries for the resolved content.
+        """
+        source_rpm_fts = []
+        # future: batch of requires being resolved by it
+        pending = {}
+        resolved_nevras = {_nevra(item) for item in self.output_set}
+        # extract provides and requires
+        self.extract_and_resolve(to_resolve)
+        while self._unsolved or pending:
+            while self._unsolved and len(pending) < max(MAX_BATCHES_IN_FLIGHT, 1):
+                batch = []
+                # making batch as the query for provides.name in rpm units is slow in general
+                # we'll better do it is smaller batches
+                for _ in range(self._batch_size()):
+                    batch.append(self._unsolved.pop())
+                # get new content that provides current batch of requires
+                ft = self._executor.submit(
+                    self.what_provides, batch, pulp_repos, merged_blacklist
+                )
+                pending[ft] = batch
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for ft in done:
+                pending.pop(ft)
+                self._iteration += 1
+                # concurrent batches may return the same packages, skip those
+                # that are already in the output set
+                resolved = [
+                    item for item in ft.result() if _nevra(item) not in resolved_nevras
+                ]
+                resolved_nevras.update(_nevra(item) for item in resolved)
+                # add content to the output set
+                self._add_to_output(resolved)
+                # submit query for source rpms
+                source_rpm_fts.append(
+                    self._executor.submit(
+                        self.get_source_pkgs, resolved, merged_blacklist
+                    )
+                )
+                # new content needs resolving deps
+                self.extract_and_resolve(resolved)
+
+            # don't query again for requires that are already being resolved
+            for batch in pending.values():
+                self._unsolved.difference_update(batch)
+
+        return source_rpm_fts
+
     def _batch_size(self):
         if len(self._unsolved) < BATCH_SIZE_RESOLVER:
             batch_size = len(self._unsolved)
@@ -341,11 +626,20 @@ class Depsolver:
                 )
 
     def _log_missing_base_pkgs(self):
-        found_pkg_names = {item.name for item in self.output_set}
-
         for item in self.repos:
-            missing = item.whitelist - found_pkg_names
+            missing = item.whitelist - self._base_pkg_names
             if missing:
                 repos = [repo.id for repo in item.in_pulp_repos]
                 for pkg_name in missing:
                     _LOG.warning("'%s' not found in %s.", pkg_name, repos)
+
+
+def _nevra(item):
+    return (
+        item.name,
+        item.epoch,
+        item.version,
+        item.release,
+        item.arch,
+        item.associate_source_repo_id,
+    )
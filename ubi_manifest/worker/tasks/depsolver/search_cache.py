@@ -0,0 +1,162 @@
+"""
+Module for caching results of pulp searches in redis across depsolve tasks
+"""
+import hashlib
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from .models import UbiUnit
+from .utils import unit_from_dict, unit_to_dict
+
+_LOG = logging.getLogger(__name__)
+
+KEY_PREFIX = "ubi_manifest:search"
+
+
+class SearchCache:
+    """
+    Redis backed cache of results of pulp searches. There's one entry per criterion,
+    keyed by repository id, the (field, value) pairs of the criterion and the list
+    of queried fields, so a criterion is found in the cache no matter which batch
+    it was searched in. Each entry expires after `ttl` seconds, the least recently
+    used entries are evicted when there are more than `max_entries` of them.
+    """
+
+    def __init__(self, redis_client, ttl: int, max_entries: int) -> None:
+        self._redis = redis_client
+        self._ttl = ttl
+        self._max_entries = max_entries
+        # repositories whose revision was already checked by this instance
+        self._checked_repos: Set[str] = set()
+
+    @staticmethod
+    def _lru_key() -> str:
+        return f"{KEY_PREFIX}:lru"
+
+    @staticmethod
+    def _repo_keys_key(repo_id: str) -> str:
+        return f"{KEY_PREFIX}:repo-keys:{repo_id}"
+
+    @staticmethod
+    def _repo_revision_key(repo_id: str) -> str:
+        return f"{KEY_PREFIX}:repo-revision:{repo_id}"
+
+    @staticmethod
+    def _stats_key() -> str:
+        return f"{KEY_PREFIX}:stats"
+
+    @staticmethod
+    def make_key(
+        repo_id: str,
+        criterion_key: Tuple[Tuple[str, str], ...],
+        content_type_cls,
+        unit_fields: Optional[List],
+    ) -> str:
+        """
+        Returns cache key for search of one criterion given by its sorted
+        (field, value) pairs, see criteria_keys().
+        """
+        fingerprint = json.dumps(
+            {
+                "unit_type": content_type_cls.__name__,
+                "fields": sorted(unit_fields or []),
+                "criterion": criterion_key,
+            }
+        )
+        digest = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+        return f"{KEY_PREFIX}:{repo_id}:{digest}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, Set[UbiUnit]]:
+        """
+        Returns cached units of given keys, keys without entry are omitted.
+        """
+        if not keys:
+            return {}
+
+        out = {
+            key: {unit_from_dict(item) for item in json.loads(data)}
+            for key, data in zip(keys, self._redis.mget(keys))
+            if data is not None
+        }
+
+        pipe = self._redis.pipeline()
+        pipe.hincrby(self._stats_key(), "hits", len(out))
+        pipe.hincrby(self._stats_key(), "misses", len(keys) - len(out))
+        if out:
+            now = time.time()
+            pipe.zadd(self._lru_key(), {key: now for key in out})
+        pipe.execute()
+        return out
+
+    def set_many(self, repo_id: str, entries: Dict[str, Set[UbiUnit]]) -> None:
+        """
+        Stores units of given keys in the cache and evicts the least recently
+        used entries if the cache is full.
+        """
+        if not entries:
+            return
+
+        repo_keys_key = self._repo_keys_key(repo_id)
+        now = time.time()
+
+        pipe = self._redis.pipeline()
+        for key, units in entries.items():
+            data = json.dumps([unit_to_dict(unit) for unit in units])
+            pipe.set(key, data, ex=self._ttl)
+        pipe.zadd(self._lru_key(), {key: now for key in entries})
+        pipe.sadd(repo_keys_key, *entries)
+        pipe.expire(repo_keys_key, self._ttl)
+        pipe.execute()
+
+        self._evict()
+
+    def _evict(self) -> None:
+        overflow = self._redis.zcard(self._lru_key()) - self._max_entries
+        if overflow <= 0:
+            return
+
+        keys = self._redis.zrange(self._lru_key(), 0, overflow - 1)
+        pipe = self._redis.pipeline()
+        pipe.delete(*keys)
+        pipe.zrem(self._lru_key(), *keys)
+        pipe.execute()
+        _LOG.debug("Evicted %s entries from search cache", len(keys))
+
+    def invalidate_repo(self, repo_id: str) -> None:
+        """
+        Removes all cached entries of given repository.
+        """
+        repo_keys_key = self._repo_keys_key(repo_id)
+        keys = list(self._redis.smembers(repo_keys_key))
+
+        pipe = self._redis.pipeline()
+        if keys:
+            pipe.delete(*keys)
+            pipe.zrem(self._lru_key(), *keys)
+        pipe.delete(repo_keys_key)
+        pipe.execute()
+        _LOG.debug("Invalidated %s search cache entries of %s", len(keys), repo_id)
+
+    def check_revision(self, repo_id: str, revision: Optional[str]) -> None:
+        """
+        Invalidates cached entries of given repository if its revision
+        changed since the entries were stored.
+        """
+        if revision is None or repo_id in self._checked_repos:
+            return
+
+        self._checked_repos.add(repo_id)
+        stored = self._redis.getset(self._repo_revision_key(repo_id), revision)
+        if stored is not None and stored.decode("utf-8") != revision:
+            self.invalidate_repo(repo_id)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns hit and miss counters of the cache.
+        """
+        stats = self._redis.hgetall(self._stats_key())
+        return {
+            name: int(stats.get(name.encode("utf-8"), 0)) for name in ("hits", "misses")
+        }
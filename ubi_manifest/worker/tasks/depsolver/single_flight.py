@@ -0,0 +1,122 @@
+"""
+Module for coalescing identical pulp searches issued within one depsolve task
+"""
+from concurrent.futures import Future
+from functools import partial
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from more_executors.futures import f_map, f_return, f_sequence
+
+from .utils import copy_outcome, flatten_list_of_sets
+
+
+def unit_field_values(unit, field: str) -> List[Any]:
+    """
+    Returns all values of possibly nested field of unit, e.g. names of
+    all provides for 'provides.name'.
+    """
+    values = [unit]
+    for attr in field.split("."):
+        nested: List[Any] = []
+        for value in values:
+            value = getattr(value, attr, None)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                nested.extend(value)
+            elif value is not None:
+                nested.append(value)
+        values = nested
+
+    return values
+
+
+def filter_units(units, fields_list):
+    """
+    Returns units matching any of criteria given by their (field, value) pairs.
+    """
+    return {
+        unit
+        for unit in units
+        if any(
+            all(value in unit_field_values(unit, field) for field, value in fields)
+            for fields in fields_list
+        )
+    }
+
+
+class SingleFlight:
+    """
+    Registry of searches issued within one task. Searches for the same repository,
+    unit type and criterion share one future, so every criterion is sent to pulp
+    at most once per task, no matter whether the first search is still running.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        # (repo id, unit type, criterion fields): future of the search answering it
+        self._futures: Dict[tuple, Future] = {}
+        self.shared = 0
+
+    def search(
+        self,
+        repo_id: str,
+        criteria_list,
+        criteria_keys: List[Optional[Tuple[Tuple[str, str], ...]]],
+        content_type_cls,
+        search_fn,
+    ):
+        """
+        Returns future of units matching any of criteria. criteria_keys are
+        (field, value) pairs of respective criteria as returned by criteria_keys(),
+        criteria with None key are always searched. Only criteria not searched yet
+        are passed to search_fn along with their keys, the rest is taken from
+        results of already issued searches.
+        """
+        new_criteria = []
+        new_criteria_keys: List[Optional[Tuple[Tuple[str, str], ...]]] = []
+        new_keys = set()
+        # id of future: (future, list of criterion fields to be picked from its results)
+        shared: Dict[int, Tuple[Future, list]] = {}
+        # resolved by the new search once it's issued
+        placeholder_ft: Future = Future()
+
+        with self._lock:
+            for criterion, fields in zip(criteria_list, criteria_keys):
+                if fields is None:
+                    new_criteria.append(criterion)
+                    new_criteria_keys.append(fields)
+                    continue
+
+                key = (repo_id, content_type_cls.__name__, fields)
+                search_ft = self._futures.get(key)
+                if search_ft is not None:
+                    shared.setdefault(id(search_ft), (search_ft, []))[1].append(fields)
+                    self.shared += 1
+                elif key not in new_keys:
+                    new_criteria.append(criterion)
+                    new_criteria_keys.append(fields)
+                    new_keys.add(key)
+
+            for key in new_keys:
+                self._futures[key] = placeholder_ft
+
+        # issuing the search may block, it's done outside the lock so that
+        # concurrent searches can still find already registered criteria
+        fts: List[Future] = []
+        if new_criteria:
+            try:
+                new_search_ft = search_fn(new_criteria, criteria_keys=new_criteria_keys)
+            except Exception as exception:
+                placeholder_ft.set_exception(exception)
+                raise
+            new_search_ft.add_done_callback(partial(copy_outcome, placeholder_ft))
+            fts.append(new_search_ft)
+
+        # shared searches may answer other criteria as well, keep only requested units
+        for shared_ft, fields_list in shared.values():
+            fts.append(f_map(shared_ft, partial(filter_units, fields_list=fields_list)))
+
+        if not fts:
+            return f_return(set())
+
+        return f_map(f_sequence(fts), flatten_list_of_sets)
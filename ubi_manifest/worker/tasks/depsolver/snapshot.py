@@ -0,0 +1,45 @@
+"""
+Module for local depsolving on snapshots of repository content
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from .models import UbiUnit
+
+# fields of rpm units that can be searched for in a snapshot
+SNAPSHOT_FIELDS = ("name", "filename", "provides.name")
+
+
+class RepoSnapshot:
+    """
+    In-memory snapshot of all rpms of one repository, indexed by name,
+    filename and names of provides.
+    """
+
+    def __init__(self, units: Iterable[UbiUnit]) -> None:
+        self._indexes: Dict[str, Dict[str, List[UbiUnit]]] = {
+            field: defaultdict(list) for field in SNAPSHOT_FIELDS
+        }
+        self._size = 0
+        for unit in units:
+            self._size += 1
+            self._indexes["name"][unit.name].append(unit)
+            if unit.filename:
+                self._indexes["filename"][unit.filename].append(unit)
+            for prov_name in {prov.name for prov in unit.provides or []}:
+                self._indexes["provides.name"][prov_name].append(unit)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def search(self, field: str, values: Iterable[str]) -> Set[UbiUnit]:
+        """
+        Returns all units whose field matches any of given values,
+        equivalent of search with OR criteria on given field in pulp.
+        """
+        index = self._indexes[field]
+        out = set()
+        for value in values:
+            out.update(index.get(value) or [])
+
+        return out
@@ -1,15 +1,27 @@
 import os
 import re
 from collections import defaultdict, deque
+from concurrent.futures import CancelledError, Future
+from datetime import datetime
 from itertools import chain
 from logging import getLogger
-from typing import Dict, List, Tuple
-
-from pubtools.pulplib import Client, Criteria, Matcher, RpmDependency
+from typing import Any, Dict, List, Tuple
+
+import attrs
+from pubtools.pulplib import (
+    Client,
+    Criteria,
+    Matcher,
+    ModulemdDefaultsUnit,
+    ModulemdDependency,
+    ModulemdUnit,
+    RpmDependency,
+    RpmUnit,
+)
 from rpm import labelCompare as label_compare  # pylint: disable=no-name-in-module
 from ubiconfig import UbiConfig
 
-from ubi_manifest.worker.tasks.depsolver.models import PackageToExclude
+from ubi_manifest.worker.tasks.depsolver.models import PackageToExclude, UbiUnit
 
 _LOG = getLogger(__name__)
 
@@ -17,6 +29,18 @@ OPEN_END_ONE_OR_MORE_PAR_REGEX = re.compile(r"^\(+|\)+$")
 OPERATOR_BOOL_REGEX = re.compile(r"if|else|and|or|unless|with|without")
 OPERATOR_NUM_REGEX = re.compile(r"<|<=|=|>|>=")
 
+UNIT_TYPES = {
+    klass.__name__: klass for klass in (RpmUnit, ModulemdUnit, ModulemdDefaultsUnit)
+}
+# fields of units holding lists of nested attrs objects
+NESTED_UNIT_FIELDS = {
+    "requires": RpmDependency,
+    "provides": RpmDependency,
+    "dependencies": ModulemdDependency,
+}
+# fields of units holding datetimes, stored as ISO 8601 strings
+DATETIME_UNIT_FIELDS = ("cdn_published",)
+
 RELATION_CMP_MAP = {
     "GT": lambda x, y: label_compare(x, y) > 0,
     "GE": lambda x, y: label_compare(x, y) >= 0,
@@ -63,6 +87,69 @@ def create_or_criteria(fields, values):
     return or_criteria
 
 
+def criteria_keys(fields, values):
+    """
+    Returns keys of criteria created by create_or_criteria(fields, values), i.e.
+    sorted (field, value) pairs of each criterion. Key is None for criterion
+    whose values aren't all plain strings, e.g. matchers.
+    """
+    keys = []
+    for val_tuple in values:
+        if all(isinstance(value, str) for value in val_tuple):
+            keys.append(tuple(sorted(zip(fields, val_tuple))))
+        else:
+            keys.append(None)
+
+    return keys
+
+
+def copy_outcome(target: Future, source: Future) -> None:
+    """
+    Resolves target future with the result or exception of finished source future.
+    """
+    if source.cancelled():
+        # futures mapped from cancelled future are never resolved
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def unit_identity(unit):
+    """
+    Returns (unit_type, unit_attr, value) tuple identifying unit in manifest.
+    """
+    if unit.isinstance_inner_unit(RpmUnit):
+        return "RpmUnit", "filename", unit.filename
+    if unit.isinstance_inner_unit(ModulemdUnit):
+        return "ModulemdUnit", "nsvca", unit.nsvca
+    if unit.isinstance_inner_unit(ModulemdDefaultsUnit):
+        return "ModulemdDefaultsUnit", "name:stream", f"{unit.name}:{unit.stream}"
+
+    raise ValueError(f"Unsupported unit type: {unit}")
+
+
+def unit_key(unit):
+    """
+    Returns key deduplicating units of one repository, it's the same as identity
+    of unit in manifest, rpms without filename are identified by NEVRA.
+    """
+    if unit.isinstance_inner_unit(RpmUnit) and unit.filename is None:
+        return (
+            "RpmUnit",
+            "nevra",
+            (
+                unit.name,
+                unit.epoch,
+                unit.version,
+                unit.release,
+                unit.arch,
+            ),
+        )
+    return unit_identity(unit)
+
+
 def flatten_list_of_sets(list_of_sets):
     out = set()
     for one_set in list_of_sets:
@@ -310,11 +397,10 @@ def get_modulemd_output_set(modules):
     return out
 
 
-def get_criteria_for_modules(modules):
-    """
-    Creates OR criteria that search for all modules by name and stream. If the
-    module has empty stream field, all modules with the corresponding name will be matched.
-    """
+MODULE_CRITERIA_FIELDS = ("name", "stream")
+
+
+def _criteria_values_for_modules(modules):
     criteria_values = []
     for module in modules:
         if module.stream:
@@ -332,6 +418,57 @@ def get_criteria_for_modules(modules):
                 )
             )
 
-    fields = ("name", "stream")
-    or_criteria = create_or_criteria(fields, criteria_values)
-    return or_criteria
+    return criteria_values
+
+
+def get_criteria_for_modules(modules):
+    """
+    Creates OR criteria that search for all modules by name and stream. If the
+    module has empty stream field, all modules with the corresponding name will be matched.
+    """
+    return create_or_criteria(
+        MODULE_CRITERIA_FIELDS, _criteria_values_for_modules(modules)
+    )
+
+
+def get_criteria_keys_for_modules(modules):
+    """
+    Returns keys of criteria created by get_criteria_for_modules(modules).
+    """
+    return criteria_keys(MODULE_CRITERIA_FIELDS, _criteria_values_for_modules(modules))
+
+
+def unit_to_dict(unit: UbiUnit) -> Dict[str, Any]:
+    """
+    Converts UbiUnit to json serializable dict, unset fields of the unit are omitted.
+    """
+    inner = unit._unit  # pylint: disable=protected-access
+    fields = {
+        key: value
+        for key, value in attrs.asdict(inner, recurse=True).items()
+        if value is not None
+    }
+    for key in DATETIME_UNIT_FIELDS:
+        if key in fields:
+            fields[key] = fields[key].isoformat()
+    return {
+        "unit_type": type(inner).__name__,
+        "src_repo_id": unit.associate_source_repo_id,
+        "fields": fields,
+    }
+
+
+def unit_from_dict(data: Dict[str, Any]) -> UbiUnit:
+    """
+    Creates UbiUnit from dict created by unit_to_dict.
+    """
+    fields = dict(data["fields"])
+    for key, klass in NESTED_UNIT_FIELDS.items():
+        if fields.get(key) is not None:
+            fields[key] = [klass(**item) for item in fields[key]]
+    for key in DATETIME_UNIT_FIELDS:
+        if fields.get(key) is not None:
+            fields[key] = datetime.fromisoformat(fields[key])
+
+    unit = UNIT_TYPES[data["unit_type"]](**fields)
+    return UbiUnit(unit, data["src_repo_id"])
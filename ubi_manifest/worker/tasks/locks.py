@@ -0,0 +1,90 @@
+"""
+Module for redis backed locks held by depsolve tasks
+"""
+import logging
+from typing import Iterable, List, Optional
+
+from celery import states
+
+from ubi_manifest.worker.tasks.celery import app
+
+_LOG = logging.getLogger(__name__)
+
+KEY_PREFIX = "ubi_manifest:lock"
+
+
+def group_lock_key(repo_group_key: str) -> str:
+    """
+    Returns key of lock of repo group, held by the task depsolving the group.
+    """
+    return f"{KEY_PREFIX}:group:{repo_group_key}"
+
+
+def repo_lock_key(repo_id: str) -> str:
+    """
+    Returns key of lock of output repository, held by the task writing its manifest.
+    """
+    return f"{KEY_PREFIX}:repo:{repo_id}"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def acquire_lock(redis_client, key: str, task_id: str, ttl: int) -> Optional[str]:
+    """
+    Makes task_id the holder of lock with given key. Returns id of another task
+    holding the lock if that task is still queued or running, None if the lock
+    was acquired. Locks of finished tasks are taken over, so a task that failed
+    without releasing its locks doesn't block others until the locks expire.
+    The takeover is done in a transaction watching the lock, it's retried if the
+    lock changed meanwhile, so two tasks can't take over the same lock.
+    """
+    if redis_client.set(key, task_id, nx=True, ex=ttl):
+        return None
+
+    def take_over(pipe):
+        holder = _decode(pipe.get(key))
+        if holder is not None and holder != task_id:
+            if app.AsyncResult(holder).state not in states.READY_STATES:
+                return holder
+            _LOG.debug("Taking over lock %s of finished task %s", key, holder)
+
+        pipe.multi()
+        pipe.set(key, task_id, ex=ttl)
+        return None
+
+    return redis_client.transaction(take_over, key, value_from_callable=True)
+
+
+def release_lock(redis_client, key: str, task_id: str) -> None:
+    """
+    Releases lock with given key if it's held by task_id, in a transaction
+    watching the lock, so a lock taken over by another task is never released.
+    """
+
+    def release(pipe):
+        if _decode(pipe.get(key)) == task_id:
+            pipe.multi()
+            pipe.delete(key)
+
+    redis_client.transaction(release, key)
+
+
+def acquire_locks(
+    redis_client, keys: Iterable[str], task_id: str, ttl: int
+) -> Optional[str]:
+    """
+    Acquires all locks with given keys or none of them. Returns id of a task
+    holding any of the locks, None if all locks were acquired.
+    """
+    acquired: List[str] = []
+    for key in keys:
+        holder = acquire_lock(redis_client, key, task_id, ttl)
+        if holder is not None:
+            for acquired_key in acquired:
+                release_lock(redis_client, acquired_key, task_id)
+            return holder
+        acquired.append(key)
+
+    return None
@@ -0,0 +1,664 @@
+"""
+Module for storing depsolved manifests in redis. Manifests are saved by workers
+with sync redis client and read by the API with asyncio redis client.
+"""
+import base64
+import binascii
+import bisect
+import gzip
+import hashlib
+import json
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from attrs import asdict, define
+
+KEY_PREFIX = "ubi_manifest:manifest"
+# counter of generations of saved manifests
+GENERATION_KEY = f"{KEY_PREFIX}:generation"
+# number of the latest generations of manifest of repository kept in redis
+KEEP_GENERATIONS = 2
+
+# (unit_type, unit_attr, src_repo_id)
+Partition = Tuple[str, str, str]
+# partition and its chunks - first value, start and end of chunk in the payload
+IndexEntry = Tuple[Partition, List[Tuple[str, int, int]]]
+# number of values of partition of manifest stored in one chunk
+CHUNK_SIZE = 1000
+
+# header of stored manifests is the magic, format version, compression of chunks
+# and length of the index of partitions following the header
+MAGIC = b"UBIM"
+# items are partitioned by unit type, unit attribute and source repository, so these
+# are stored once per partition in the index, followed by the payload of separately
+# compressed chunks of json lists of sorted values of the partitions
+FORMAT_VERSION = 1
+COMPRESSIONS = {"none": 0, "gzip": 1}
+_HEADER_SIZE = len(MAGIC) + 6
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class GenerationExpired(LookupError):
+    pass
+
+
+@define
+class ManifestMeta:
+    """
+    Metadata of the current generation of manifest of repository.
+    """
+
+    generation: int
+    # hash of content of the manifest
+    etag: str
+    # time of the last change of content of the manifest
+    last_modified: float
+
+
+@define
+class ManifestDiff:
+    """
+    Items added to and removed from manifest of repository since an older generation.
+    """
+
+    generation: int
+    etag: str
+    added: List[dict]
+    removed: List[dict]
+
+
+def _parse_meta(data) -> ManifestMeta:
+    return ManifestMeta(**json.loads(data))
+
+
+def _load_meta(data) -> Optional[ManifestMeta]:
+    return None if data is None else _parse_meta(data)
+
+
+def legacy_content_key(repo_id: str) -> str:
+    """
+    Returns key of manifest of repository saved before generations were introduced.
+    """
+    return repo_id
+
+
+def current_key(repo_id: str) -> str:
+    """
+    Returns key of metadata of the current generation of manifest of repository.
+    """
+    return f"{KEY_PREFIX}:{repo_id}:current"
+
+
+def generations_key(repo_id: str) -> str:
+    """
+    Returns key of sorted set of generations of manifest of repository kept in redis.
+    """
+    return f"{KEY_PREFIX}:{repo_id}:generations"
+
+
+def content_key(repo_id: str, generation: int) -> str:
+    """
+    Returns key of the whole manifest of repository.
+    """
+    return f"{KEY_PREFIX}:{repo_id}:{generation}:content"
+
+
+def etag_key(repo_id: str, generation: int) -> str:
+    """
+    Returns key of hash of content of manifest of repository.
+    """
+    return f"{KEY_PREFIX}:{repo_id}:{generation}:etag"
+
+
+def partitions_key(repo_id: str, generation: int) -> str:
+    """
+    Returns key of header of manifest of repository with index of its partitions.
+    """
+    return f"{KEY_PREFIX}:{repo_id}:{generation}:partitions"
+
+
+def _partition_items(items: List[dict]) -> Dict[Partition, List[str]]:
+    out = defaultdict(list)
+    for item in items:
+        partition = (item["unit_type"], item["unit_attr"], item["src_repo_id"])
+        out[partition].append(item["value"])
+    return out
+
+
+def _compress(payload: bytes, compression: str) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(payload, mtime=0)
+    return payload
+
+
+def _load_chunk(data: bytes, compression: int) -> List[str]:
+    if compression == COMPRESSIONS["gzip"]:
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def _encode(items: List[dict], compression: str) -> Tuple[bytes, int]:
+    """
+    Returns manifest serialized in the current format and length of its header,
+    including the index of partitions.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression of manifests: {compression}")
+
+    partitioned = _partition_items(items)
+    index = []
+    chunks = []
+    offset = 0
+    for partition in sorted(partitioned):
+        # the same order as of values read by ZRANGEBYLEX
+        values = sorted(partitioned[partition], key=lambda value: value.encode("utf-8"))
+        refs = []
+        for start in range(0, len(values), CHUNK_SIZE):
+            chunk_values = values[start : start + CHUNK_SIZE]
+            chunk = _compress(
+                json.dumps(chunk_values, separators=(",", ":")).encode("utf-8"),
+                compression,
+            )
+            refs.append([chunk_values[0], offset, offset + len(chunk)])
+            chunks.append(chunk)
+            offset += len(chunk)
+        index.append([*partition, refs])
+
+    index_data = json.dumps(index, separators=(",", ":")).encode("utf-8")
+    header = (
+        MAGIC
+        + bytes([FORMAT_VERSION, COMPRESSIONS[compression]])
+        + len(index_data).to_bytes(4, "big")
+        + index_data
+    )
+    return header + b"".join(chunks), len(header)
+
+
+def _parse_header(data: bytes) -> Tuple[int, List[IndexEntry], int]:
+    """
+    Returns compression of chunks, index of partitions and offset of payload
+    of manifest in the current format.
+    """
+    version, compression = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported version of manifest format: {version}")
+    if compression not in COMPRESSIONS.values():
+        raise ValueError(f"Unsupported compression of manifest: {compression}")
+
+    index_len = int.from_bytes(data[len(MAGIC) + 2 : _HEADER_SIZE], "big")
+    index = [
+        ((unit_type, unit_attr, src), refs)
+        for unit_type, unit_attr, src, refs in json.loads(
+            data[_HEADER_SIZE : _HEADER_SIZE + index_len]
+        )
+    ]
+    return compression, index, _HEADER_SIZE + index_len
+
+
+def _make_item(partition: Partition, value: str) -> dict:
+    return {
+        "src_repo_id": partition[2],
+        "unit_type": partition[0],
+        "unit_attr": partition[1],
+        "value": value,
+    }
+
+
+def encode_manifest(items: List[dict], compression: str = "gzip") -> bytes:
+    """
+    Returns manifest serialized in the current format. Items are ordered
+    by unit type, source repository and value.
+    """
+    return _encode(items, compression)[0]
+
+
+def decode_manifest(data) -> List[dict]:
+    """
+    Returns items of manifest stored in the current or legacy json format.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if not data.startswith(MAGIC):
+        # manifests saved before the header was introduced
+        return json.loads(data)
+
+    compression, index, payload = _parse_header(data)
+    return [
+        _make_item(partition, value)
+        for partition, refs in index
+        for _, start, end in refs
+        for value in _load_chunk(data[payload + start : payload + end], compression)
+    ]
+
+
+def manifest_body(data) -> Iterator[bytes]:
+    """
+    Returns iterator of parts of json list of items of manifest. Manifests
+    in the current format are decoded and serialized chunk by chunk.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if not data.startswith(MAGIC):
+        return iter([json.dumps(decode_manifest(data)).encode("utf-8")])
+
+    return _body(data, *_parse_header(data))
+
+
+def _body(
+    data: bytes, compression: int, index: List[IndexEntry], payload: int
+) -> Iterator[bytes]:
+    separator = b"["
+    for partition, refs in index:
+        for _, start, end in refs:
+            values = _load_chunk(data[payload + start : payload + end], compression)
+            items = [_make_item(partition, value) for value in values]
+            # items of chunk without the enclosing brackets
+            yield separator + json.dumps(items)[1:-1].encode("utf-8")
+            separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+def manifest_etag(items: List[dict]) -> str:
+    """
+    Returns hash of content of manifest, independent of the order of items.
+    """
+    data = json.dumps(sorted(json.dumps(item, sort_keys=True) for item in items))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def save_manifests(
+    redis_client,
+    manifests: Dict[str, List[dict]],
+    ttl: int,
+    compression: str = "gzip",
+) -> int:
+    """
+    Saves manifests of repositories as a new generation and returns it. Each manifest
+    is stored once in the current format, see encode_manifest(). Its header with index
+    of partitions is stored separately as well, so pages of the manifest can be read
+    without loading all of it. The new generation becomes current for all the
+    repositories at once, older generations are removed except for the
+    KEEP_GENERATIONS latest.
+    The current generation is stored along with hash of the manifest and time
+    of its last change.
+    """
+    generation = int(redis_client.incr(GENERATION_KEY))
+    now = time.time()
+    etags = {repo_id: manifest_etag(items) for repo_id, items in manifests.items()}
+    previous = dict(
+        zip(
+            manifests,
+            redis_client.mget([current_key(repo_id) for repo_id in manifests]),
+        )
+    )
+
+    pipe = redis_client.pipeline(transaction=False)
+    for repo_id, items in manifests.items():
+        data, header_size = _encode(items, compression)
+        pipe.set(partitions_key(repo_id, generation), data[:header_size], ex=ttl)
+        pipe.set(content_key(repo_id, generation), data, ex=ttl)
+        pipe.set(etag_key(repo_id, generation), etags[repo_id], ex=ttl)
+    pipe.execute()
+
+    # readers see either the previous or the new generation of all repositories
+    pipe = redis_client.pipeline(transaction=True)
+    for repo_id in manifests:
+        etag = etags[repo_id]
+        last_modified = now
+        previous_meta = _load_meta(previous[repo_id])
+        if previous_meta is not None and previous_meta.etag == etag:
+            # content didn't change
+            last_modified = previous_meta.last_modified
+        meta = ManifestMeta(generation, etag, last_modified)
+        pipe.set(current_key(repo_id), json.dumps(asdict(meta)), ex=ttl)
+        pipe.zadd(generations_key(repo_id), {generation: generation})
+        pipe.expire(generations_key(repo_id), ttl)
+        pipe.delete(legacy_content_key(repo_id))
+    pipe.execute()
+
+    _remove_old_generations(redis_client, list(manifests))
+    return generation
+
+
+def _remove_old_generations(redis_client, repo_ids: List[str]) -> None:
+    pipe = redis_client.pipeline(transaction=False)
+    for repo_id in repo_ids:
+        pipe.zrange(generations_key(repo_id), 0, -KEEP_GENERATIONS - 1)
+    old_generations = [
+        (repo_id, int(generation))
+        for repo_id, generations in zip(repo_ids, pipe.execute())
+        for generation in generations
+    ]
+    if not old_generations:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for repo_id, generation in old_generations:
+        pipe.delete(
+            content_key(repo_id, generation),
+            etag_key(repo_id, generation),
+            partitions_key(repo_id, generation),
+        )
+        pipe.zrem(generations_key(repo_id), generation)
+    pipe.execute()
+
+
+async def get_meta(redis_client, repo_id: str) -> Optional[ManifestMeta]:
+    """
+    Returns metadata of the current generation of manifest of repository or None
+    if there is none.
+    """
+    return _load_meta(await redis_client.get(current_key(repo_id)))
+
+
+async def current_generation(redis_client, repo_id: str) -> Optional[int]:
+    """
+    Returns current generation of manifest of repository or None if there is none.
+    """
+    meta = await get_meta(redis_client, repo_id)
+    return None if meta is None else meta.generation
+
+
+async def load_manifest(
+    redis_client, repo_id: str, generation: Optional[int] = None
+) -> Optional[List[dict]]:
+    """
+    Returns items of the whole manifest of repository of given generation, the current
+    one by default, or None if it's missing.
+    """
+    data = await _load_content(redis_client, repo_id, generation)
+    return None if data is None else decode_manifest(data)
+
+
+async def load_manifest_body(
+    redis_client, repo_id: str, generation: Optional[int] = None
+) -> Optional[Iterator[bytes]]:
+    """
+    Returns iterator of chunks of json list of items of the whole manifest
+    of repository of given generation, the current one by default, or None
+    if it's missing. See manifest_body().
+    """
+    data = await _load_content(redis_client, repo_id, generation)
+    return None if data is None else manifest_body(data)
+
+
+async def _load_content(redis_client, repo_id: str, generation: Optional[int]):
+    if generation is None:
+        generation = await current_generation(redis_client, repo_id)
+
+    if generation is None:
+        return await redis_client.get(legacy_content_key(repo_id))
+    return await redis_client.get(content_key(repo_id, generation))
+
+
+async def load_manifest_bodies(
+    redis_client, repo_ids: List[str]
+) -> Dict[str, Optional[Iterator[bytes]]]:
+    """
+    Returns serialized current manifests of repositories, None for missing ones.
+    All manifests are read in one transaction, so they're consistent, and
+    in one round trip. Each manifest is decompressed only when its iterator
+    is consumed, see manifest_body().
+    """
+    repo_ids = list(dict.fromkeys(repo_ids))
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for repo_id in repo_ids:
+            # content of the latest kept generation, which is the current one
+            pipe.sort(
+                generations_key(repo_id),
+                by="nosort",
+                start=0,
+                num=1,
+                get=f"{KEY_PREFIX}:{repo_id}:*:content",
+                desc=True,
+            )
+            pipe.get(legacy_content_key(repo_id))
+        values = await pipe.execute()
+
+    out: Dict[str, Optional[Iterator[bytes]]] = {}
+    for repo_id, contents, legacy in zip(repo_ids, values[::2], values[1::2]):
+        data = contents[0] if contents else legacy
+        out[repo_id] = None if data is None else _lazy_body(data)
+    return out
+
+
+def _lazy_body(data) -> Iterator[bytes]:
+    yield from manifest_body(data)
+
+
+async def load_diff(redis_client, repo_id: str, since: str) -> Optional[ManifestDiff]:
+    """
+    Returns items added to and removed from the current manifest of repository since
+    the generation identified by its number or ETag, or None if there is no current
+    manifest. GenerationExpired is raised if the generation is not kept anymore.
+    """
+    meta = await get_meta(redis_client, repo_id)
+    if meta is None:
+        return None
+
+    # the ETag may be passed as it is returned in the header
+    since = since.strip().removeprefix("W/").strip('"')
+    if since in (str(meta.generation), meta.etag):
+        return ManifestDiff(meta.generation, meta.etag, [], [])
+
+    expired = GenerationExpired(f"Manifest of {repo_id} since {since} is not available")
+    generation = await _find_generation(redis_client, repo_id, since)
+    if generation is None:
+        raise expired
+
+    old_data, data = await redis_client.mget(
+        content_key(repo_id, generation), content_key(repo_id, meta.generation)
+    )
+    if old_data is None:
+        raise expired
+    if data is None:
+        return None
+
+    old_items = decode_manifest(old_data)
+    items = decode_manifest(data)
+    old_keys = {_item_key(item) for item in old_items}
+    keys = {_item_key(item) for item in items}
+    return ManifestDiff(
+        meta.generation,
+        meta.etag,
+        added=[item for item in items if _item_key(item) not in old_keys],
+        removed=[item for item in old_items if _item_key(item) not in keys],
+    )
+
+
+async def _find_generation(redis_client, repo_id: str, since: str) -> Optional[int]:
+    if since.isdigit():
+        return int(since)
+
+    generations = [
+        int(generation)
+        for generation in await redis_client.zrange(generations_key(repo_id), 0, -1)
+    ]
+    etags = await redis_client.mget(
+        [etag_key(repo_id, generation) for generation in generations]
+    )
+    # the latest generation with the ETag, content may be the same in several ones
+    for generation, etag in reversed(list(zip(generations, etags))):
+        if etag is not None and etag.decode("utf-8") == since:
+            return generation
+
+    return None
+
+
+def _item_key(item: dict) -> Tuple[str, str, str, str]:
+    return (item["unit_type"], item["unit_attr"], item["src_repo_id"], item["value"])
+
+
+def encode_cursor(generation: Optional[int], partition: Partition, value: str) -> str:
+    """
+    Returns cursor pointing after given item of given generation of manifest.
+    """
+    data = json.dumps([generation, *partition, value]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[int], Partition, str]:
+    """
+    Returns generation of manifest, partition and value of item the cursor
+    points after.
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        generation, unit_type, unit_attr, src_repo_id, value = data
+        if generation is not None:
+            generation = int(generation)
+    except (binascii.Error, UnicodeError, TypeError, ValueError) as exc:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from exc
+
+    return generation, (str(unit_type), str(unit_attr), str(src_repo_id)), str(value)
+
+
+def _value_range(
+    after: Optional[str], value_prefix: Optional[str]
+) -> Tuple[bytes, bytes]:
+    # lexicographical range of ZRANGEBYLEX, 0xff byte is never part of utf-8 string
+    prefix = (value_prefix or "").encode("utf-8")
+    if after is not None:
+        min_ = b"(" + after.encode("utf-8")
+    else:
+        min_ = b"[" + prefix if prefix else b"-"
+    max_ = b"[" + prefix + b"\xff" if prefix else b"+"
+    return min_, max_
+
+
+async def get_page(
+    redis_client,
+    repo_id: str,
+    unit_type: Optional[str] = None,
+    src_repo_id: Optional[str] = None,
+    value_prefix: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000,
+) -> Optional[Tuple[List[dict], Optional[str]]]:
+    """
+    Returns page of items of manifest matching given filters and cursor pointing
+    to the next page, the cursor is None if there are no more items. Items are
+    ordered by unit type, source repository and value. All pages are read from
+    the generation of manifest that was current when the first page was read.
+    None is returned if manifest of repository is missing.
+    """
+    after_partition: Optional[Partition] = None
+    after_value = None
+    if cursor:
+        generation, after_partition, after_value = decode_cursor(cursor)
+    else:
+        generation = await current_generation(redis_client, repo_id)
+
+    if generation is not None:
+        data = await redis_client.get(partitions_key(repo_id, generation))
+    else:
+        data = await redis_client.get(legacy_content_key(repo_id))
+    if data is None:
+        if cursor:
+            raise InvalidCursor(f"Cursor expired: {cursor}")
+        return None
+
+    if generation is not None:
+        compression, index, payload = _parse_header(data)
+        partitions = [partition for partition, _ in index]
+        fetch = _chunked_fetch(
+            redis_client, content_key(repo_id, generation), compression, index, payload
+        )
+    else:
+        # manifests saved before generations were introduced are paged in memory
+        partitioned = {
+            partition: sorted(values, key=lambda value: value.encode("utf-8"))
+            for partition, values in _partition_items(decode_manifest(data)).items()
+        }
+        partitions = sorted(partitioned)
+        fetch = _in_memory_fetch(partitioned)
+
+    items: List[dict] = []
+    for partition in partitions:
+        if unit_type is not None and partition[0] != unit_type:
+            continue
+        if src_repo_id is not None and partition[2] != src_repo_id:
+            continue
+        if after_partition is not None and partition < after_partition:
+            continue
+
+        start = after_value if partition == after_partition else None
+        count = limit - len(items)
+        values = await fetch(partition, *_value_range(start, value_prefix), count)
+        items.extend(_make_item(partition, value) for value in values)
+
+        if len(items) == limit:
+            return items, encode_cursor(generation, partition, values[-1])
+
+    return items, None
+
+
+# fetches values of partition in range of ZRANGEBYLEX limited to count of values
+Fetch = Callable[[Partition, bytes, bytes, int], Awaitable[List[str]]]
+
+
+def _select(values: List[str], min_: bytes, max_: bytes, count: int) -> List[str]:
+    # values of sorted list in range of ZRANGEBYLEX limited to count of values
+    keys = [value.encode("utf-8") for value in values]
+    if min_ == b"-":
+        start = 0
+    elif min_.startswith(b"("):
+        start = bisect.bisect_right(keys, min_[1:])
+    else:
+        start = bisect.bisect_left(keys, min_[1:])
+    end = len(keys) if max_ == b"+" else bisect.bisect_right(keys, max_[1:])
+    return values[start:end][:count]
+
+
+def _chunked_fetch(
+    redis_client,
+    key: str,
+    compression: int,
+    index: List[IndexEntry],
+    payload: int,
+) -> Fetch:
+    refs_of = dict(index)
+    firsts_of = {
+        partition: [first.encode("utf-8") for first, _, _ in refs]
+        for partition, refs in index
+    }
+
+    async def fetch(partition, min_, max_, count):
+        refs, firsts = refs_of[partition], firsts_of[partition]
+        # the chunk that may contain the lowest value in range
+        start = 0 if min_ == b"-" else max(bisect.bisect_right(firsts, min_[1:]) - 1, 0)
+        end = len(firsts) if max_ == b"+" else bisect.bisect_right(firsts, max_[1:])
+        # enough chunks for count of values, the first one may be used partially
+        end = min(end, start + count // CHUNK_SIZE + 2)
+        if start >= end:
+            return []
+
+        # chunks of partition are stored one after another, they're read at once
+        offset = refs[start][1]
+        data = await redis_client.getrange(
+            key, payload + offset, payload + refs[end - 1][2] - 1
+        )
+        if not data:
+            # the manifest expired meanwhile
+            return []
+        values = [
+            value
+            for _, chunk_start, chunk_end in refs[start:end]
+            for value in _load_chunk(
+                data[chunk_start - offset : chunk_end - offset], compression
+            )
+        ]
+        return _select(values, min_, max_, count)
+
+    return fetch
+
+
+def _in_memory_fetch(partitioned: Dict[Partition, List[str]]) -> Fetch:
+    async def fetch(partition, min_, max_, count):
+        return _select(partitioned[partition], min_, max_, count)
+
+    return fetch